@@ -0,0 +1,363 @@
+from functools import lru_cache
+import numpy as np
+import struct
+
+# APU in two layers. The control layer is what the CPU can observe: length
+# counters, sweep, envelopes and the channel on bits in NR52. It is brought
+# up to date from the cycle counter on register access, one frame sequencer
+# step (512 Hz) at a time, and skips ahead in one go while every channel is
+# off. The synthesis layer only exists when audio is wanted: every register
+# write and sequencer step that changes the sound appends a timestamped
+# snapshot of the sound registers to a log, and render() turns the log into
+# samples afterwards, one NumPy block per stretch between two snapshots.
+#
+# The frame sequencer runs off the APU's own power-on time rather than DIV.
+
+CLOCK_HZ = 4194304
+SEQUENCER_CYCLES = 8192     # 512 Hz
+
+# registers, as offsets into 0xFF00. Channel n uses NRn0 - NRn4 at
+# 0x10 + 5 * n (NR20 and NR40 don't exist).
+NR10, NR30, NR50, NR51, NR52 = 0x10, 0x1A, 0x24, 0x25, 0x26
+WAVE = 0x30
+# bits that always read back as 1, 0x10 - 0x2F
+READ_MASKS = bytes([
+    0x80, 0x3F, 0x00, 0xFF, 0xBF,   # NR10 - NR14
+    0xFF, 0x3F, 0x00, 0xFF, 0xBF,   # NR20 - NR24
+    0x7F, 0xFF, 0x9F, 0xFF, 0xBF,   # NR30 - NR34
+    0xFF, 0xFF, 0x00, 0x00, 0xBF,   # NR40 - NR44
+    0x00, 0x00, 0x70,               # NR50 - NR52
+]) + bytes([0xFF] * 9)
+
+DUTY = np.array([
+    [0, 0, 0, 0, 0, 0, 0, 1],       # 12.5%
+    [1, 0, 0, 0, 0, 0, 0, 1],       # 25%
+    [1, 0, 0, 0, 0, 1, 1, 1],       # 50%
+    [0, 1, 1, 1, 1, 1, 1, 0],       # 75%
+], dtype=np.float32) * 2 - 1
+WAVE_VOLUME = (0.0, 1.0, 0.5, 0.25)     # NR32 output level
+
+
+@lru_cache(maxsize=None)
+def _lfsr(width7):
+    # one period of the noise channel's output, from a freshly reset LFSR.
+    # Built once per process, the arrays are only ever read.
+    lfsr = 0x7FFF
+    out = []
+    for _ in range(127 if width7 else 32767):
+        bit = (lfsr ^ (lfsr >> 1)) & 1
+        lfsr = (lfsr >> 1) | (bit << 14)
+        if width7:
+            lfsr = (lfsr & ~0x40) | (bit << 6)
+        out.append(~lfsr & 1)
+    return np.array(out, dtype=np.float32) * 2 - 1
+
+
+class APU:
+    # savestate section: power, sequencer step, next step's cycle, per
+    # channel on/length/volume/envelope timer, ch1 sweep timer, shadow
+    # frequency, sweep enabled. The registers themselves are in memory.
+    STATE = struct.Struct("<?Bq4?4H4B4BBH?")
+
+    def __init__(self, memory, clock, synthesize=False, sample_rate=48000, buffer_seconds=1.0):
+        self.io = memory.data
+        self.clock = clock
+        # =Control=
+        self.power = True
+        self.step = 0
+        self.next_step = SEQUENCER_CYCLES
+        self.on = [False] * 4
+        self.length = [0] * 4
+        self.volume = [0] * 4
+        self.env_timer = [0] * 4
+        self.sweep_timer = 0
+        self.shadow = 0
+        self.sweep_enabled = False
+        # =Synthesis=
+        # log of (cycle, triggered channel bits, NR10 - 0xFF3F, on, volume)
+        self.synthesize = synthesize
+        self.sample_rate = sample_rate
+        self.sample_cycles = CLOCK_HZ / sample_rate
+        self.log = []
+        self.rendered = 0           # cycle render() got up to
+        self.sample_time = 0.0      # cycle of the next sample
+        self.snapshot = self._snapshot()
+        self.phase = [0.0] * 4      # waveform position per channel
+        self.noise = (_lfsr(False), _lfsr(True)) if synthesize else None
+        # ring buffer of stereo float samples
+        self.buffer = np.zeros((int(sample_rate * buffer_seconds), 2), dtype=np.float32)
+        self.written = 0
+        self.read_pos = 0
+
+        for reg in range(0x10, 0x40):
+            memory.register_io(0xFF00 | reg, read=self._read, write=self._write)
+        memory.register_io(0xFF00 | NR52, read=self._read_nr52, write=self._write)
+        # state the boot ROM leaves behind
+        self.io[0xFF00 | NR50] = 0x77
+        self.io[0xFF00 | NR51] = 0xF3
+        self.io[0xFF00 | NR52] = 0x80
+
+    # =Registers=
+    def _read(self, addr):
+        reg = addr & 0xFF
+        if reg >= WAVE:
+            return self.io[addr]
+        return self.io[addr] | READ_MASKS[reg - 0x10]
+
+    def _read_nr52(self, addr):
+        self.sync()
+        on = self.on
+        return (0xF0 if self.power else 0x70) | on[0] | on[1] << 1 | on[2] << 2 | on[3] << 3
+
+    def _write(self, addr, value):
+        now = self.clock()
+        self.sync(now)
+        reg = addr & 0xFF
+        io = self.io
+        triggered = 0
+        if reg == NR52:
+            power = bool(value & 0x80)
+            if not power and self.power:
+                io[0xFF10:0xFF26] = bytes(0x16)
+                self.on = [False] * 4
+            elif power and not self.power:
+                self.step = 0
+                self.next_step = now + SEQUENCER_CYCLES
+            self.power = power
+            io[addr] = value & 0x80
+        elif reg >= WAVE:
+            io[addr] = value
+        elif reg >= NR50:
+            if self.power:
+                io[addr] = value
+        elif self.power:
+            io[addr] = value
+            channel, x = divmod(reg - 0x10, 5)
+            if x == 1:
+                self.length[channel] = 256 - value if channel == 2 else 64 - (value & 0x3F)
+            elif x == 2 and channel != 2 and not value & 0xF8:
+                self.on[channel] = False    # DAC off
+            elif x == 0 and channel == 2 and not value & 0x80:
+                self.on[2] = False
+            elif x == 4 and value & 0x80:
+                self._trigger(channel)
+                triggered = 1 << channel
+        if self.synthesize:
+            self.log.append((now, triggered) + self._snapshot())
+
+    def _dac(self, channel):
+        if channel == 2:
+            return bool(self.io[0xFF00 | NR30] & 0x80)
+        return bool(self.io[0xFF12 + 5 * channel] & 0xF8)
+
+    def _trigger(self, channel):
+        io = self.io
+        if not self.length[channel]:
+            self.length[channel] = 256 if channel == 2 else 64
+        self.on[channel] = self._dac(channel)
+        if channel != 2:
+            envelope = io[0xFF12 + 5 * channel]
+            self.volume[channel] = envelope >> 4
+            self.env_timer[channel] = envelope & 0x07
+        if channel == 0:
+            sweep = io[0xFF00 | NR10]
+            self.shadow = io[0xFF13] | (io[0xFF14] & 0x07) << 8
+            self.sweep_timer = (sweep >> 4) & 0x07 or 8
+            self.sweep_enabled = bool(sweep & 0x77)
+            if sweep & 0x07:
+                self._sweep_next()
+
+    def _sweep_next(self):
+        # the next sweep frequency, overflowing turns channel 1 off
+        sweep = self.io[0xFF00 | NR10]
+        delta = self.shadow >> (sweep & 0x07)
+        frequency = self.shadow - delta if sweep & 0x08 else self.shadow + delta
+        if frequency > 2047:
+            self.on[0] = False
+        return frequency
+
+    # =Frame sequencer=
+    def sync(self, now=None):
+        # run the frame sequencer steps up to now
+        if now is None:
+            now = self.clock()
+        if now < self.next_step:
+            return
+        if not self.power or not any(self.on):
+            # nothing is counting: skip to the last step before now
+            steps = (now - self.next_step) // SEQUENCER_CYCLES
+            self.step = (self.step + steps) & 7
+            self.next_step += steps * SEQUENCER_CYCLES
+        while self.next_step <= now:
+            audible = self.synthesize and any(self.on)
+            self._step(self.step)
+            if audible:
+                self.log.append((self.next_step, 0) + self._snapshot())
+            self.step = (self.step + 1) & 7
+            self.next_step += SEQUENCER_CYCLES
+
+    def _step(self, step):
+        if not self.power:
+            return
+        io = self.io
+        on = self.on
+        if not step & 1:
+            # length counters, 256 Hz
+            for channel in range(4):
+                if io[0xFF14 + 5 * channel] & 0x40 and self.length[channel]:
+                    self.length[channel] -= 1
+                    if not self.length[channel]:
+                        on[channel] = False
+        if step in (2, 6) and on[0]:
+            # sweep, 128 Hz
+            self.sweep_timer -= 1
+            if self.sweep_timer <= 0:
+                sweep = io[0xFF00 | NR10]
+                self.sweep_timer = (sweep >> 4) & 0x07 or 8
+                if self.sweep_enabled and sweep & 0x70:
+                    frequency = self._sweep_next()
+                    if frequency <= 2047 and sweep & 0x07:
+                        self.shadow = frequency
+                        io[0xFF13] = frequency & 0xFF
+                        io[0xFF14] = (io[0xFF14] & 0xF8) | (frequency >> 8)
+                        self._sweep_next()
+        if step == 7:
+            # envelopes, 64 Hz
+            for channel in (0, 1, 3):
+                envelope = io[0xFF12 + 5 * channel]
+                if not on[channel] or not envelope & 0x07:
+                    continue
+                self.env_timer[channel] -= 1
+                if self.env_timer[channel] <= 0:
+                    self.env_timer[channel] = envelope & 0x07
+                    volume = self.volume[channel] + (1 if envelope & 0x08 else -1)
+                    if 0 <= volume <= 15:
+                        self.volume[channel] = volume
+
+    # =Synthesis=
+    def _snapshot(self):
+        return (bytes(self.io[0xFF10:0xFF40]), tuple(self.on), tuple(self.volume))
+
+    def render(self):
+        # turn the log up to now into samples in the ring buffer
+        now = self.clock()
+        self.sync(now)
+        if not self.synthesize:
+            return
+        log, self.log = self.log, []
+        start = self.rendered
+        for time, triggered, *snapshot in log:
+            self._block(start, time)
+            for channel in range(4):
+                if triggered >> channel & 1 and channel >= 2:
+                    self.phase[channel] = 0.0   # wave position and LFSR restart
+            self.snapshot = tuple(snapshot)
+            start = time
+        self._block(start, now)
+        self.rendered = now
+
+    def _block(self, start, end):
+        # samples for [start, end) with the sound of self.snapshot
+        if end <= self.sample_time:
+            return
+        step = self.sample_cycles
+        count = int(np.ceil((end - self.sample_time) / step))
+        offsets = self.sample_time - start + np.arange(count) * step    # cycles since start
+        regs, on, volume = self.snapshot
+        mix = np.zeros((count, 2), dtype=np.float32)
+        panning = regs[NR51 - 0x10]
+        for channel in range(4):
+            if not on[channel]:
+                continue
+            out = self._channel(channel, regs, volume[channel], offsets, end - start)
+            if panning & (0x10 << channel):
+                mix[:, 0] += out
+            if panning & (0x01 << channel):
+                mix[:, 1] += out
+        master = regs[NR50 - 0x10]
+        mix[:, 0] *= (((master >> 4) & 0x07) + 1) / 32
+        mix[:, 1] *= ((master & 0x07) + 1) / 32
+        self._push(mix)
+        self.sample_time += count * step
+
+    def _channel(self, channel, regs, volume, offsets, length):
+        # one channel's output in -1..1 at offsets, advances its phase
+        base = 5 * channel
+        phase = self.phase[channel]
+        if channel < 3:
+            frequency = regs[base + 3] | (regs[base + 4] & 0x07) << 8
+        if channel < 2:
+            period = (2048 - frequency) * 4     # cycles per duty step
+            positions = phase + offsets / period
+            out = DUTY[regs[base + 1] >> 6][positions.astype(np.int64) & 7] * (volume / 15)
+            self.phase[channel] = (phase + length / period) % 8
+        elif channel == 2:
+            period = (2048 - frequency) * 2     # cycles per wave sample
+            positions = phase + offsets / period
+            wave = np.frombuffer(regs, dtype=np.uint8, count=16, offset=WAVE - 0x10)
+            samples = np.empty(32, dtype=np.float32)
+            samples[0::2] = wave >> 4
+            samples[1::2] = wave & 0x0F
+            samples = (samples - 7.5) / 7.5 * WAVE_VOLUME[(regs[NR30 - 0x10 + 2] >> 5) & 0x03]
+            out = samples[positions.astype(np.int64) & 31]
+            self.phase[channel] = (phase + length / period) % 32
+        else:
+            polynomial = regs[0x12]
+            shift = polynomial >> 4
+            if shift >= 14:
+                return np.zeros(len(offsets), dtype=np.float32)
+            period = ((polynomial & 0x07) * 16 or 8) << shift   # cycles per LFSR clock
+            sequence = self.noise[1 if polynomial & 0x08 else 0]
+            positions = phase + offsets / period
+            out = sequence[positions.astype(np.int64) % len(sequence)] * (volume / 15)
+            self.phase[channel] = (phase + length / period) % len(sequence)
+        return out
+
+    # =Ring buffer=
+    def _push(self, samples):
+        buffer = self.buffer
+        size = len(buffer)
+        if len(samples) > size:
+            samples = samples[-size:]
+        count = len(samples)
+        at = self.written % size
+        first = min(count, size - at)
+        buffer[at:at + first] = samples[:first]
+        buffer[:count - first] = samples[first:]
+        self.written += count
+        # the oldest samples are overwritten when nobody reads
+        self.read_pos = max(self.read_pos, self.written - size)
+
+    def available(self):
+        return self.written - self.read_pos
+
+    def read(self, count=None):
+        # up to count (default all) buffered samples as a (n, 2) float32
+        # array in -1..1, oldest first
+        available = self.available()
+        count = available if count is None else min(count, available)
+        size = len(self.buffer)
+        at = self.read_pos % size
+        first = min(count, size - at)
+        out = np.concatenate((self.buffer[at:at + first], self.buffer[:count - first]))
+        self.read_pos += count
+        return out
+
+    # =Savestate=
+    def get_state(self):
+        return (self.power, self.step, self.next_step, *self.on, *self.length,
+                *self.volume, *self.env_timer, self.sweep_timer, self.shadow, self.sweep_enabled)
+
+    def set_state(self, state):
+        self.power, self.step, self.next_step = state[:3]
+        self.on = list(state[3:7])
+        self.length = list(state[7:11])
+        self.volume = list(state[11:15])
+        self.env_timer = list(state[15:19])
+        self.sweep_timer, self.shadow, self.sweep_enabled = state[19:]
+        # the sound picks up from here, nothing is rendered across the load
+        now = self.clock()
+        self.log = []
+        self.rendered = now
+        self.sample_time = float(now)
+        self.snapshot = self._snapshot()
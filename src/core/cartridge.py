@@ -1,3 +1,4 @@
+import struct
 
 # general metadata of the header 0x0100 - 0x014F
 FIELDS = [
@@ -18,3 +19,53 @@ FIELDS = [
   ("global_checksum", 'H'),     # 0x14E-0x14F (global checksum)
 ]
 
+# cartridge_type (0x147) -> (mapper, has RAM, has battery, has RTC)
+CARTRIDGE_TYPES = {
+  0x00: ("ROM", False, False, False),   # ROM ONLY
+  0x01: ("MBC1", False, False, False),  # MBC1
+  0x02: ("MBC1", True, False, False),   # MBC1+RAM
+  0x03: ("MBC1", True, True, False),    # MBC1+RAM+BATTERY
+  0x08: ("ROM", True, False, False),    # ROM+RAM
+  0x09: ("ROM", True, True, False),     # ROM+RAM+BATTERY
+  0x0F: ("MBC3", False, True, True),    # MBC3+TIMER+BATTERY
+  0x10: ("MBC3", True, True, True),     # MBC3+TIMER+RAM+BATTERY
+  0x11: ("MBC3", False, False, False),  # MBC3
+  0x12: ("MBC3", True, False, False),   # MBC3+RAM
+  0x13: ("MBC3", True, True, False),    # MBC3+RAM+BATTERY
+  0x19: ("MBC5", False, False, False),  # MBC5
+  0x1A: ("MBC5", True, False, False),   # MBC5+RAM
+  0x1B: ("MBC5", True, True, False),    # MBC5+RAM+BATTERY
+  0x1C: ("MBC5", False, False, False),  # MBC5+RUMBLE
+  0x1D: ("MBC5", True, False, False),   # MBC5+RUMBLE+RAM
+  0x1E: ("MBC5", True, True, False),    # MBC5+RUMBLE+RAM+BATTERY
+}
+
+# ram_size (0x149) -> bytes of external RAM
+RAM_SIZES = {
+  0x00: 0,
+  0x01: 0x800,      # 2kb (unofficial)
+  0x02: 0x2000,     # 8kb, 1 bank
+  0x03: 0x8000,     # 32kb, 4 banks
+  0x04: 0x20000,    # 128kb, 16 banks
+  0x05: 0x10000,    # 64kb, 8 banks
+}
+
+
+def parse_header(rom):
+    # FIELDS of the 0x0100 - 0x014F header as a dict, plus the derived
+    # mapper / size info the MBCs need
+    fmt = "".join(fmt for _, fmt in FIELDS)
+    values = struct.unpack_from(fmt, rom, 0x100)
+    header = dict(zip((name for name, fmt in FIELDS if name), values))
+    header["title"] = header["title"].split(b"\0", 1)[0].decode("ascii", "replace")
+
+    cartridge_type = header["cartridge_type"]
+    if cartridge_type not in CARTRIDGE_TYPES:
+        raise ValueError(f"Unsupported cartridge type 0x{cartridge_type:02X}")
+    mapper, has_ram, battery, rtc = CARTRIDGE_TYPES[cartridge_type]
+    header["mapper"] = mapper
+    header["battery"] = battery
+    header["rtc"] = rtc
+    header["rom_banks"] = 2 << header["rom_size"]     # 16kb banks
+    header["ram_bytes"] = RAM_SIZES.get(header["ram_size"], 0) if has_ram else 0
+    return header
@@ -1,371 +1,1225 @@
-from .instructions import Operand, Instruction
-from pathlib import Path
+from .flags import ADC_FLAGS, SBC_FLAGS, INC_FLAGS, DEC_FLAGS, ZERO_FLAGS, AND_FLAGS
+import struct
+
+# register file indexes, same as the 3-bit register code in opcodes.
+# code 6 is (HL) (memory), so its slot holds F instead.
+B, C, D, E, H, L, F, A = range(8)
+
+BLOCK_ENDS = {"JR", "JP", "CALL", "RET", "RETI", "RST", "HALT", "STOP", "EI", "DI"}
+MAX_BLOCK = 32      # instructions per block, bounds how far run() overshoots
+CONDITIONS = {"NZ", "Z", "NC", "C"}
+# 8-bit ALU A,r / A,n and INC/DEC r: the ops that leave their flags pending
+# with lazy_flags
+LAZY_FLAG_OPS = frozenset([*range(0x80, 0xC0), *range(0xC6, 0x100, 8),
+                           *range(0x04, 0x40, 8), *range(0x05, 0x40, 8)])
 
 
 class CPU:
-    def __init__(self, prefixed, regular, memory):
+    __slots__ = (
+        'memory', 'registers', 'pairs', 'stack_pairs', 'regs', 'PC', 'SP',
+        'ime', 'halted', 'stopped', 'regular', 'prefixed', 'cycles', 'opcodes',
+        'ops', 'cb_ops', 'op_cycles', 'cb_cycles', 'op_bytes', 'ends_block',
+        'blocks', 'ram_blocks', 'until', 'breakpoints', 'ei_delay', 'flag_tables',
+        'lazy_flags', 'flag_op',
+    )
+    # savestate section: regs, PC, SP, ime, ei_delay, halted, stopped,
+    # cycles, opcodes
+    STATE = struct.Struct("<8sHH????QQ")
+
+    def __init__(self, prefixed, regular, memory, flag_tables=True, lazy_flags=False):
         self.memory = memory
+        # 8-bit ALU flags from the tables in flags.py, False works them out
+        # in every handler (the reference the tables are checked against)
+        self.flag_tables = flag_tables
+        # lazy_flags: the 8-bit ALU only records what its flags come from in
+        # flag_op, (table, index, kept bits) into flags.py, and F is worked
+        # out by sync_flags() when something reads it. Every other op that
+        # touches F syncs first, and run()/cycle() sync before returning, so
+        # outside of them regs[F] is always current.
+        self.lazy_flags = lazy_flags
+        self.flag_op = None
         # =Registers=
-        """ A | F = AF 
+        """ A | F = AF
             B | C = BC
             D | E = DE
             H | L = HL """
         # 0-7
         self.registers = ['B', 'C', 'D', 'E', 'H', 'L', '(HL)', 'A'] #(HL) means to mem[HL]
-        # Hi:
-        self.A = 0  
-        self.B = 0
-        self.D = 0
-        self.E = 0
-        # Lo:
-        self.C = 0
-        self.H = 0
-        self.L = 0
-        self.F = 0
-        
+        # 16-bit pairs, 0-3 (bits 4-5 of the opcode) as (hi, lo) indexes
+        self.pairs = [(B, C), (D, E), (H, L), None]     # BC DE HL SP
+        self.stack_pairs = [(B, C), (D, E), (H, L), (A, F)]
+        # B C D E H L F A, one int per register.
+        # F (upper 4: znhc lower: ----) is the only copy of the flags:
+        # bit 7: zero, bit 6: sub (BCD), bit 5: half carry (BCD), bit 4: carry
+        self.regs = [0] * 8
+
         # 16-bit registers
         self.PC = 0x0100    # Program Counter (pointer) starts here for GB
         self.SP = 0xFFFE    # Stack pointer default
 
-        # Flags (stored in F, upper 4: znhc lower: ----)
-        self.z = 0 # bit 7: zero flag
-        self.n = 0 # bit 6: sub flag (BCD)
-        self.h = 0 # bit 5: half carry flag (BCD)
-        self.c = 0 # bit 4: carry flag
+        self.ime = False    # interrupt master enable
+        self.ei_delay = False   # EI was executed, IME goes on after the next instruction
+        self.halted = False
+        self.stopped = False
 
         # =Opcode tables=
-        self.regular = regular or {}
-        self.prefixed = prefixed or {}
+        # compiled OpcodeTables, shared read-only between instances
+        self.regular = regular
+        self.prefixed = prefixed
         self.cycles = 0
         self.opcodes = 0
-        self.opcode_table = {
-            0x00: lambda d=None,s=None,i=None: self.NOP()
-        }
-    # combined values
+        # flat 256 slot dispatch tables: handler(n) where n is the immediate
+        # operand (0 when the instruction has none), plus the base cycle cost
+        # and length of every opcode. Conditional branches charge their taken
+        # penalty themselves.
+        self.ops = [None] * 0x100
+        self.cb_ops = [None] * 0x100
+        self.op_cycles = list(regular.cycles)
+        self.cb_cycles = list(prefixed.cycles)
+        self.op_bytes = list(regular.bytes)
+        # opcodes that can change PC (or interrupt state) end a basic block
+        self.ends_block = [
+            mnemonic in BLOCK_ENDS or mnemonic.startswith("ILLEGAL")
+            for mnemonic in regular.mnemonic
+        ]
+        self._init_tables()
+
+        # =Block cache=
+        # decoded straight-line runs keyed by (bank << 16) | PC, each a tuple
+        # of (handler, immediate, next PC, cycles) per instruction
+        self.blocks = {}
+        self.ram_blocks = {}    # page -> keys of blocks decoded from that RAM page
+        self.until = 0
+        # run() stops when PC lands on one of these, blocks end before them
+        self.breakpoints = frozenset()
+
+        # =Interrupts=
+        # writing IE/IF can make an interrupt pending, leave run() so the
+        # caller can service it
+        memory.register_io(0xFF0F, read=self._read_if, write=self._write_interrupt)
+        memory.register_io(0xFFFF, write=self._write_interrupt)
+
+    # combined values, for tools and debugging. Handlers index self.regs.
     @property
     def AF(self):
-        return (self.A << 8) | self.F
+        return (self.regs[A] << 8) | self.regs[F]
     @AF.setter
     def AF(self, value):
-        self.A = (value >> 8) & 0xFF
-        self.F = value & 0xF0   # lower 4 bits of F (flags), 0
-    
+        self.regs[A] = (value >> 8) & 0xFF
+        self.regs[F] = value & 0xF0   # lower 4 bits of F (flags), 0
+
     @property
     def BC(self):
-        return (self.B << 8) | self.C
+        return (self.regs[B] << 8) | self.regs[C]
     @BC.setter
     def BC(self, value):
-        self.B = (value >> 8) & 0xFF
-        self.C = value & 0xFF
-    
+        self.regs[B] = (value >> 8) & 0xFF
+        self.regs[C] = value & 0xFF
+
     @property
     def DE(self):
-        return (self.D << 8) | self.E
+        return (self.regs[D] << 8) | self.regs[E]
     @DE.setter
     def DE(self, value):
-        self.D = (value >> 8) & 0xFF
-        self.E = value & 0xFF
-    
+        self.regs[D] = (value >> 8) & 0xFF
+        self.regs[E] = value & 0xFF
+
     @property
     def HL(self):
-        return (self.H << 8) | self.L
+        return (self.regs[H] << 8) | self.regs[L]
     @HL.setter
     def HL(self, value):
-        self.H = (value >> 8) & 0xFF
-        self.L = value & 0xFF
+        self.regs[H] = (value >> 8) & 0xFF
+        self.regs[L] = value & 0xFF
+
     # populate optable with family groups
+    def _init_tables(self):
+        # PREFIX reads the CB opcode as its immediate and charges its cost
+        self.op_bytes[0xCB] = 2
+        self.op_cycles[0xCB] = 0
+        # STOP is followed by a padding byte
+        self.op_bytes[0x10] = 2
+
+        for opcode in range(0x100):
+            self.ops[opcode] = self.ILLEGAL(opcode)
+        self.ops[0x00] = self.NOP
+        self.ops[0x10] = self.STOP
+        self.ops[0x76] = self.HALT
+        self.ops[0xF3] = self.DI
+        self.ops[0xFB] = self.EI
+        self.ops[0xCB] = self.PREFIX
+        self._init_LD_r_r()
+        self._init_LD_r_n()
+        self._init_LD_rr_nn()
+        self._init_LD_indirect()
+        self._init_ADD_A_r()
+        self._init_ADC_A_r()
+        self._init_SUB_A_r()
+        self._init_SBC_A_r()
+        self._init_AND_A_r()
+        self._init_XOR_A_r()
+        self._init_OR_A_r()
+        self._init_CP_A_r()
+        self._init_INC_r()
+        self._init_DEC_r()
+        self._init_INC_DEC_rr()
+        self._init_ADD_HL_rr()
+        self._init_SP_ops()
+        self._init_accumulator_ops()
+        self._init_jumps()
+        self._init_stack()
+        self._init_CB()
+        if self.lazy_flags:
+            self._init_lazy_flags()
+
+    def _init_lazy_flags(self):
+        # everything else reading or writing F syncs it first: conditional
+        # branches, PUSH AF and every op with flags
+        regular = self.regular
+        for opcode in range(0x100):
+            if opcode in LAZY_FLAG_OPS:
+                continue
+            operands = regular.operands[opcode]
+            conditional = bool(operands) and operands[0][0] in CONDITIONS
+            if regular.flags[opcode] != "----" or conditional or opcode == 0xF5:
+                self.ops[opcode] = self._synced(self.ops[opcode])
+        for opcode in range(0x100):
+            if self.prefixed.flags[opcode] != "----":
+                self.cb_ops[opcode] = self._synced(self.cb_ops[opcode])
+
+    def _synced(self, handler):
+        def op(n):
+            if self.flag_op is not None:
+                self.sync_flags()
+            handler(n)
+        return op
+
+    def sync_flags(self):
+        # F with the flags a lazy ALU op left pending worked out
+        pending = self.flag_op
+        if pending is not None:
+            table, index, kept = pending
+            self.regs[F] = kept | table[index]
+            self.flag_op = None
+        return self.regs[F]
+
+    def _condition(self, cc):
+        # NZ, Z, NC, C -> (mask, expected) on F
+        return [(0x80, 0x00), (0x80, 0x80), (0x10, 0x00), (0x10, 0x10)][cc]
+
+    def _operand(self, src, apply):
+        # wrap apply(value) so it reads register code src, or the immediate
+        # when src is None
+        regs = self.regs
+        memory = self.memory
+        if src is None:
+            return apply
+        if src == 6:
+            return lambda n: apply(memory[(regs[H] << 8) | regs[L]])
+        return lambda n: apply(regs[src])
+
+    def _modify(self, dest, apply):
+        # read-modify-write register code dest through apply(value) -> value
+        regs = self.regs
+        memory = self.memory
+        if dest == 6:
+            def op(n):
+                hl = (regs[H] << 8) | regs[L]
+                memory[hl] = apply(memory[hl])
+        else:
+            def op(n):
+                regs[dest] = apply(regs[dest])
+        return op
+
     def _init_LD_r_r(self):     # 0x40 - 0x7F
         # 8 bits = 01|DES|SRC || 01 111 101 Des = 111 in binary, aka 7/A
         for row, dest in enumerate(self.registers):
             for col, src in enumerate(self.registers):
                 opcode = 0x40 + row*8 + col
-                self.opcode_table[opcode] = (lambda d=dest, s=src, i=None: self.LD_r_r(d, s))
-    
+                if opcode == 0x76:      # LD (HL),(HL) is HALT
+                    continue
+                self.ops[opcode] = self.LD_r_r(row, col)
+
     def LD_r_r(self, dest, src):
-        if dest == '(HL)' and src == '(HL)':
-            raise Exception(f"LD (HL),(HL) is invalid {self.opcode}")
-        
-        if dest == '(HL)':
-            self.memory[self.HL] = getattr(self, src)
-        elif src == '(HL)':
-            setattr(self, dest, self.memory[self.HL])
+        regs = self.regs
+        memory = self.memory
+        if dest == 6:
+            def op(n):
+                memory[(regs[H] << 8) | regs[L]] = regs[src]
+        elif src == 6:
+            def op(n):
+                regs[dest] = memory[(regs[H] << 8) | regs[L]]
         else:
-            setattr(self, dest, getattr(self, src))
-        
-        return True
+            def op(n):
+                regs[dest] = regs[src]
+        return op
 
-    def _init_ADD_A_r(self):    # 0x80 - 0x87
-        for col, src in enumerate(self.registers):
-            opcode = 0x80 + col 
-            self.opcode_table[opcode] = (lambda d=None,s=src,i=None: self.ADD_A_r(s))
- 
-    def ADD_A_r(self, src):
-        if src == '(HL)':
-            r_value = self.memory[self.HL]
-        else:
-            r_value = getattr(self, src)
-        result = self.A + r_value
-        # Flags
-        self.F = 0
-        if (result & 0xFF) == 0:
-            self.F |= 0x80  # z
-        if ((self.A & 0xF) + (r_value & 0xF)) > 0xF:
-            self.F |= 0x20  # h
-        if result > 0xFF:
-            self.F |= 0x10  # c
-
-        self.A = result & 0xFF
-        return True
-        
-    def _init_ADC_A_r(self):    # 0x88 - 0x8F
+    def _init_LD_r_n(self):     # 1-3x6 + 1-3xE
         for col, src in enumerate(self.registers):
-            opcode = 0x88 + col 
-            self.opcode_table[opcode] = (lambda d=None,s=src,i=None: self.ADC_A_r(s))
+            opcode = 0x06 + (col * 0x08)
+            self.ops[opcode] = self.LD_r_n(col)
 
-    def ADC_A_r(self, src):
-        if src == '(HL)':
-            r_value = self.memory[self.HL]
+    def LD_r_n(self, dest):
+        regs = self.regs
+        memory = self.memory
+        if dest == 6:
+            def op(n):
+                memory[(regs[H] << 8) | regs[L]] = n
         else:
-            r_value = getattr(self, src)
-        carry = 1 if (self.F & 0x10) else 0
-
-        result = self.A + r_value + carry
-        self.F = 0
-
-        if (result & 0xFF) == 0:
-            self.F |= 0x80  # z
-        if ((self.A & 0xF) + (r_value & 0xF)) > 0xF:
-            self.F |= 0x20  # h
-        if result > 0xFF:
-            self.F |= 0x10  # c
-        self.A = result & 0xFF
-        return True
+            def op(n):
+                regs[dest] = n
+        return op
 
-    def _init_SUB_A_r(self):    # 0x90 - 0x97
-        for col, src in enumerate(self.registers):
-            opcode = 0x90 + col 
-            self.opcode_table[opcode] = (lambda d=None,s=src,i=None: self.SUB_A_r(s))
+    def _init_LD_rr_nn(self):   # 0x01, 0x11, 0x21, 0x31
+        regs = self.regs
+        for row, pair in enumerate(self.pairs):
+            if pair is None:
+                def op(n):
+                    self.SP = n
+            else:
+                def op(n, hi=pair[0], lo=pair[1]):
+                    regs[hi] = n >> 8
+                    regs[lo] = n & 0xFF
+            self.ops[0x01 + row*0x10] = op
 
-    def SUB_A_r(self, src):
-        if src == '(HL)':
-            r_value = self.memory[self.HL]
-        else:
-            r_value = getattr(self, src)
-        result = self.A - r_value
-
-        self.F = 0x40
-        if (result & 0xFF) == 0:
-            self.F |= 0x80  
-        if ((self.A & 0xF) < (r_value & 0xF)):
-            self.F |= 0x20
-        if self.A < result:
-            self.F |= 0x10
-        
-        self.A = result & 0xFF
-        return True
-    
-    def _init_SBC_A_r(self):    # 0x98 - 0x9F
+    def _init_LD_indirect(self):
+        regs = self.regs
+        memory = self.memory
+
+        def LD_mBC_A(n):        # 0x02
+            memory[(regs[B] << 8) | regs[C]] = regs[A]
+        def LD_mDE_A(n):        # 0x12
+            memory[(regs[D] << 8) | regs[E]] = regs[A]
+        def LD_mHLi_A(n):       # 0x22
+            hl = (regs[H] << 8) | regs[L]
+            memory[hl] = regs[A]
+            hl = (hl + 1) & 0xFFFF
+            regs[H] = hl >> 8
+            regs[L] = hl & 0xFF
+        def LD_mHLd_A(n):       # 0x32
+            hl = (regs[H] << 8) | regs[L]
+            memory[hl] = regs[A]
+            hl = (hl - 1) & 0xFFFF
+            regs[H] = hl >> 8
+            regs[L] = hl & 0xFF
+        def LD_A_mBC(n):        # 0x0A
+            regs[A] = memory[(regs[B] << 8) | regs[C]]
+        def LD_A_mDE(n):        # 0x1A
+            regs[A] = memory[(regs[D] << 8) | regs[E]]
+        def LD_A_mHLi(n):       # 0x2A
+            hl = (regs[H] << 8) | regs[L]
+            regs[A] = memory[hl]
+            hl = (hl + 1) & 0xFFFF
+            regs[H] = hl >> 8
+            regs[L] = hl & 0xFF
+        def LD_A_mHLd(n):       # 0x3A
+            hl = (regs[H] << 8) | regs[L]
+            regs[A] = memory[hl]
+            hl = (hl - 1) & 0xFFFF
+            regs[H] = hl >> 8
+            regs[L] = hl & 0xFF
+        def LD_mnn_SP(n):       # 0x08
+            memory[n] = self.SP & 0xFF
+            memory[(n + 1) & 0xFFFF] = self.SP >> 8
+        def LDH_mn_A(n):        # 0xE0
+            memory[0xFF00 | n] = regs[A]
+        def LDH_A_mn(n):        # 0xF0
+            regs[A] = memory[0xFF00 | n]
+        def LD_mC_A(n):         # 0xE2
+            memory[0xFF00 | regs[C]] = regs[A]
+        def LD_A_mC(n):         # 0xF2
+            regs[A] = memory[0xFF00 | regs[C]]
+        def LD_mnn_A(n):        # 0xEA
+            memory[n] = regs[A]
+        def LD_A_mnn(n):        # 0xFA
+            regs[A] = memory[n]
+
+        self.ops[0x02] = LD_mBC_A
+        self.ops[0x12] = LD_mDE_A
+        self.ops[0x22] = LD_mHLi_A
+        self.ops[0x32] = LD_mHLd_A
+        self.ops[0x0A] = LD_A_mBC
+        self.ops[0x1A] = LD_A_mDE
+        self.ops[0x2A] = LD_A_mHLi
+        self.ops[0x3A] = LD_A_mHLd
+        self.ops[0x08] = LD_mnn_SP
+        self.ops[0xE0] = LDH_mn_A
+        self.ops[0xF0] = LDH_A_mn
+        self.ops[0xE2] = LD_mC_A
+        self.ops[0xF2] = LD_A_mC
+        self.ops[0xEA] = LD_mnn_A
+        self.ops[0xFA] = LD_A_mnn
+
+    def _init_ADD_A_r(self):    # 0x80 - 0x87, 0xC6
         for col, src in enumerate(self.registers):
-            opcode = 0x98 + col 
-            self.opcode_table[opcode] = (lambda d=None,s=src,i=None: self.SBC_A_r(s))
-    
-    def SBC_A_r(self, src):
-        if src == '(HL)':
-            r_value = self.memory[self.HL]
-        else:
-            r_value = getattr(self, src)
-        carry = 1 if (self.F & 0x10) else 0
-
-        result = self.A - r_value - carry
-        self.F = 0x40
-
-        if (result & 0xFF) == 0:
-            self.F |= 0x80  # z
-        if (self.A & 0xF) < ((r_value & 0xF) + carry):
-            self.F |= 0x20  # h
-        if self.A < (r_value + carry):
-            self.F |= 0x10  # c
-        self.A = result & 0xFF
-        return True
+            opcode = 0x80 + col
+            self.ops[opcode] = self._operand(col, self.ADD_A_r())
+        self.ops[0xC6] = self._operand(None, self.ADD_A_r())
+
+    def ADD_A_r(self):
+        regs = self.regs
+        if self.lazy_flags:
+            def op(r_value):
+                a = regs[A]
+                self.flag_op = (ADC_FLAGS, (a << 8) | r_value, 0)
+                regs[A] = (a + r_value) & 0xFF
+            return op
+        if self.flag_tables:
+            def op(r_value):
+                a = regs[A]
+                regs[F] = ADC_FLAGS[(a << 8) | r_value]
+                regs[A] = (a + r_value) & 0xFF
+            return op
+        def op(r_value):
+            a = regs[A]
+            result = a + r_value
+            # Flags
+            regs[F] = (
+                (0x80 if (result & 0xFF) == 0 else 0)                       # z
+                | (0x20 if ((a & 0xF) + (r_value & 0xF)) > 0xF else 0)      # h
+                | (0x10 if result > 0xFF else 0)                            # c
+            )
+            regs[A] = result & 0xFF
+        return op
 
-    def _init_AND_A_r(self):    # 0xA0 - 0xA7
+    def _init_ADC_A_r(self):    # 0x88 - 0x8F, 0xCE
         for col, src in enumerate(self.registers):
-            opcode = 0xA0 + col 
-            self.opcode_table[opcode] = (lambda d=None,s=src,i=None: self.AND_A_r(s))
+            opcode = 0x88 + col
+            self.ops[opcode] = self._operand(col, self.ADC_A_r())
+        self.ops[0xCE] = self._operand(None, self.ADC_A_r())
 
-    def AND_A_r(self, src):
-        if src == '(HL)':
-            r_value = self.memory[self.HL]
-        else:
-            r_value = getattr(self, src)
-        result = self.A & r_value
+    def ADC_A_r(self):
+        regs = self.regs
+        if self.lazy_flags:
+            def op(r_value):
+                carry = self.sync_flags() & 0x10
+                a = regs[A]
+                self.flag_op = (ADC_FLAGS, (carry << 12) | (a << 8) | r_value, 0)
+                regs[A] = (a + r_value + (carry >> 4)) & 0xFF
+            return op
+        if self.flag_tables:
+            def op(r_value):
+                carry = regs[F] & 0x10
+                a = regs[A]
+                regs[F] = ADC_FLAGS[(carry << 12) | (a << 8) | r_value]
+                regs[A] = (a + r_value + (carry >> 4)) & 0xFF
+            return op
+        def op(r_value):
+            carry = (regs[F] >> 4) & 1
+            a = regs[A]
+            result = a + r_value + carry
+            regs[F] = (
+                (0x80 if (result & 0xFF) == 0 else 0)
+                | (0x20 if ((a & 0xF) + (r_value & 0xF) + carry) > 0xF else 0)
+                | (0x10 if result > 0xFF else 0)
+            )
+            regs[A] = result & 0xFF
+        return op
 
-        self.F = 0
-        if (result & 0xFF) == 0:
-            self.F |= 0x80
-        self.F |= 0x20
+    def _init_SUB_A_r(self):    # 0x90 - 0x97, 0xD6
+        for col, src in enumerate(self.registers):
+            opcode = 0x90 + col
+            self.ops[opcode] = self._operand(col, self.SUB_A_r())
+        self.ops[0xD6] = self._operand(None, self.SUB_A_r())
 
-        self.A = result & 0xFF
-        return True
-    
-    def _init_OR_A_r(self):     # 0xB0 - 0xB7
+    def SUB_A_r(self):
+        regs = self.regs
+        if self.lazy_flags:
+            def op(r_value):
+                a = regs[A]
+                self.flag_op = (SBC_FLAGS, (a << 8) | r_value, 0)
+                regs[A] = (a - r_value) & 0xFF
+            return op
+        if self.flag_tables:
+            def op(r_value):
+                a = regs[A]
+                regs[F] = SBC_FLAGS[(a << 8) | r_value]
+                regs[A] = (a - r_value) & 0xFF
+            return op
+        def op(r_value):
+            a = regs[A]
+            result = a - r_value
+            regs[F] = (
+                0x40
+                | (0x80 if result == 0 else 0)
+                | (0x20 if (a & 0xF) < (r_value & 0xF) else 0)
+                | (0x10 if result < 0 else 0)
+            )
+            regs[A] = result & 0xFF
+        return op
+
+    def _init_SBC_A_r(self):    # 0x98 - 0x9F, 0xDE
         for col, src in enumerate(self.registers):
-            opcode = 0xB0 + col 
-            self.opcode_table[opcode] = (lambda d=None,s=src,i=None: self.OR_A_r(s))
+            opcode = 0x98 + col
+            self.ops[opcode] = self._operand(col, self.SBC_A_r())
+        self.ops[0xDE] = self._operand(None, self.SBC_A_r())
 
-    def OR_A_r(self, src):
-        if src == '(HL)':
-            r_value = self.memory[self.HL]
-        else:
-            r_value = getattr(self, src)
-        result = self.A | r_value
-
-        self.F = 0
-        if (result & 0xFF) == 0:
-            self.F |= 0x80
-        
-        self.A = result & 0xFF
-        return True
+    def SBC_A_r(self):
+        regs = self.regs
+        if self.lazy_flags:
+            def op(r_value):
+                carry = self.sync_flags() & 0x10
+                a = regs[A]
+                self.flag_op = (SBC_FLAGS, (carry << 12) | (a << 8) | r_value, 0)
+                regs[A] = (a - r_value - (carry >> 4)) & 0xFF
+            return op
+        if self.flag_tables:
+            def op(r_value):
+                carry = regs[F] & 0x10
+                a = regs[A]
+                regs[F] = SBC_FLAGS[(carry << 12) | (a << 8) | r_value]
+                regs[A] = (a - r_value - (carry >> 4)) & 0xFF
+            return op
+        def op(r_value):
+            carry = (regs[F] >> 4) & 1
+            a = regs[A]
+            result = a - r_value - carry
+            regs[F] = (
+                0x40
+                | (0x80 if (result & 0xFF) == 0 else 0)                     # z
+                | (0x20 if (a & 0xF) < ((r_value & 0xF) + carry) else 0)   # h
+                | (0x10 if result < 0 else 0)                               # c
+            )
+            regs[A] = result & 0xFF
+        return op
 
-    def _init_XOR_A_r(self):    # 0xA8 - 0xAF
+    def _init_AND_A_r(self):    # 0xA0 - 0xA7, 0xE6
         for col, src in enumerate(self.registers):
-            opcode = 0xA8 + col 
-            self.opcode_table[opcode] = (lambda d=None,s=src,i=None: self.XOR_A_r(s))
+            opcode = 0xA0 + col
+            self.ops[opcode] = self._operand(col, self.AND_A_r())
+        self.ops[0xE6] = self._operand(None, self.AND_A_r())
 
-    def XOR_A_r(self, src):
-        if src == '(HL)':
-            r_value = self.memory[self.HL]
-        else:
-            r_value = getattr(self, src)
-        result = self.A ^ r_value
+    def AND_A_r(self):
+        regs = self.regs
+        if self.lazy_flags:
+            def op(r_value):
+                result = regs[A] & r_value
+                self.flag_op = (AND_FLAGS, result, 0)
+                regs[A] = result
+            return op
+        if self.flag_tables:
+            def op(r_value):
+                result = regs[A] & r_value
+                regs[F] = AND_FLAGS[result]
+                regs[A] = result
+            return op
+        def op(r_value):
+            result = regs[A] & r_value
+            regs[F] = 0xA0 if result == 0 else 0x20
+            regs[A] = result
+        return op
 
-        self.F = 0
-        if (result & 0xFF) == 0:
-            self.F |= 0x80
+    def _init_OR_A_r(self):     # 0xB0 - 0xB7, 0xF6
+        for col, src in enumerate(self.registers):
+            opcode = 0xB0 + col
+            self.ops[opcode] = self._operand(col, self.OR_A_r())
+        self.ops[0xF6] = self._operand(None, self.OR_A_r())
 
-        self.A = result & 0xFF
-        return True
+    def OR_A_r(self):
+        regs = self.regs
+        if self.lazy_flags:
+            def op(r_value):
+                result = regs[A] | r_value
+                self.flag_op = (ZERO_FLAGS, result, 0)
+                regs[A] = result
+            return op
+        if self.flag_tables:
+            def op(r_value):
+                result = regs[A] | r_value
+                regs[F] = ZERO_FLAGS[result]
+                regs[A] = result
+            return op
+        def op(r_value):
+            result = regs[A] | r_value
+            regs[F] = 0x80 if result == 0 else 0
+            regs[A] = result
+        return op
 
-    def _init_CP_A_r(self):     # 0xB8 - 0xBF
+    def _init_XOR_A_r(self):    # 0xA8 - 0xAF, 0xEE
         for col, src in enumerate(self.registers):
-            opcode = 0xB8 + col 
-            self.opcode_table[opcode] = (lambda d=None,s=src,i=None: self.CP_A_r(s))
+            opcode = 0xA8 + col
+            self.ops[opcode] = self._operand(col, self.XOR_A_r())
+        self.ops[0xEE] = self._operand(None, self.XOR_A_r())
 
-    def CP_A_r(self, src):
-        if src == '(HL)':
-            r_value = self.memory[self.HL]
-        else:
-            r_value = getattr(self, src)
-        result = self.A - r_value
-
-        self.F = 0
-        self.F |= 0x40
-        if (result & 0xFF) == 0:
-            self.F |= 0x80
-        if (self.A & 0xF) < (r_value & 0xF):
-            self.F |= 0x20
-        if self.A < r_value:
-            self.F |= 0x10
+    def XOR_A_r(self):
+        regs = self.regs
+        if self.lazy_flags:
+            def op(r_value):
+                result = regs[A] ^ r_value
+                self.flag_op = (ZERO_FLAGS, result, 0)
+                regs[A] = result
+            return op
+        if self.flag_tables:
+            def op(r_value):
+                result = regs[A] ^ r_value
+                regs[F] = ZERO_FLAGS[result]
+                regs[A] = result
+            return op
+        def op(r_value):
+            result = regs[A] ^ r_value
+            regs[F] = 0x80 if result == 0 else 0
+            regs[A] = result
+        return op
 
-        return True
+    def _init_CP_A_r(self):     # 0xB8 - 0xBF, 0xFE
+        for col, src in enumerate(self.registers):
+            opcode = 0xB8 + col
+            self.ops[opcode] = self._operand(col, self.CP_A_r())
+        self.ops[0xFE] = self._operand(None, self.CP_A_r())
+
+    def CP_A_r(self):
+        regs = self.regs
+        if self.lazy_flags:
+            def op(r_value):
+                self.flag_op = (SBC_FLAGS, (regs[A] << 8) | r_value, 0)
+            return op
+        if self.flag_tables:
+            def op(r_value):
+                regs[F] = SBC_FLAGS[(regs[A] << 8) | r_value]
+            return op
+        def op(r_value):
+            a = regs[A]
+            regs[F] = (
+                0x40
+                | (0x80 if a == r_value else 0)
+                | (0x20 if (a & 0xF) < (r_value & 0xF) else 0)
+                | (0x10 if a < r_value else 0)
+            )
+        return op
 
     def _init_INC_r(self):      # 1-3x4 + 1-3xC
         for col, src in enumerate(self.registers):
             # 4 12 20 28
             opcode = 0x04 + (col * 0x08)
-            self.opcode_table[opcode] = (lambda d=None,s=src,i=None: self.INC_r(s))
-    
+            self.ops[opcode] = self.INC_r(col)
+
     def INC_r(self, src):
-        # self.register += 1, change flags
-        if src == '(HL)':
-            r_value = self.memory[self.HL]
+        regs = self.regs
+        if self.lazy_flags:
+            # C is kept, so whatever is pending is worked out first
+            def inc(r_value):
+                self.flag_op = (INC_FLAGS, r_value, self.sync_flags() & 0x10)
+                return (r_value + 1) & 0xFF
+            if src == 6:
+                return self._modify(src, inc)
+            def op(n):
+                r_value = regs[src]
+                self.flag_op = (INC_FLAGS, r_value, self.sync_flags() & 0x10)
+                regs[src] = (r_value + 1) & 0xFF
+            return op
+        if self.flag_tables:
+            def inc(r_value):
+                regs[F] = (regs[F] & 0x10) | INC_FLAGS[r_value]
+                return (r_value + 1) & 0xFF
+            if src == 6:
+                return self._modify(src, inc)
+            def op(n):
+                r_value = regs[src]
+                regs[F] = (regs[F] & 0x10) | INC_FLAGS[r_value]
+                regs[src] = (r_value + 1) & 0xFF
+            return op
+        def inc(r_value):
             result = (r_value + 1) & 0xFF
-            self.memory[self.HL] = result
-        else:
-            r_value = getattr(self, src) 
+            # keep c, n = 0
+            regs[F] = (
+                (regs[F] & 0x10)
+                | (0x80 if result == 0 else 0)                  # z
+                | (0x20 if (r_value & 0x0F) == 0x0F else 0)     # h
+            )
+            return result
+        if src == 6:
+            return self._modify(src, inc)
+        def op(n):
+            r_value = regs[src]
             result = (r_value + 1) & 0xFF
-            setattr(self, src, result)
-        # set c and n respectively 00010000
-        self.F &= 0x10  
-        if result == 0:             
-            self.F |= 0x80  # z
-        if (r_value & 0x0F) + 1 > 0x0F:
-            self.F |= 0x20  # h
-        
-        return True
+            regs[src] = result
+            regs[F] = (
+                (regs[F] & 0x10)
+                | (0x80 if result == 0 else 0)
+                | (0x20 if (r_value & 0x0F) == 0x0F else 0)
+            )
+        return op
 
     def _init_DEC_r(self):      # 1-3x5 + 1-3xD
         for col, src in enumerate(self.registers):
             opcode = 0x05 + (col * 0x08)
-            self.opcode_table[opcode] = (lambda d=None,s=src,i=None: self.DEC_r(s))        
+            self.ops[opcode] = self.DEC_r(col)
 
     def DEC_r(self, src):
         # opposite of INC
-        if src == '(HL)':
-            r_value = self.memory[self.HL]
+        regs = self.regs
+        if self.lazy_flags:
+            # C is kept, so whatever is pending is worked out first
+            def dec(r_value):
+                self.flag_op = (DEC_FLAGS, r_value, self.sync_flags() & 0x10)
+                return (r_value - 1) & 0xFF
+            if src == 6:
+                return self._modify(src, dec)
+            def op(n):
+                r_value = regs[src]
+                self.flag_op = (DEC_FLAGS, r_value, self.sync_flags() & 0x10)
+                regs[src] = (r_value - 1) & 0xFF
+            return op
+        if self.flag_tables:
+            def dec(r_value):
+                regs[F] = (regs[F] & 0x10) | DEC_FLAGS[r_value]
+                return (r_value - 1) & 0xFF
+            if src == 6:
+                return self._modify(src, dec)
+            def op(n):
+                r_value = regs[src]
+                regs[F] = (regs[F] & 0x10) | DEC_FLAGS[r_value]
+                regs[src] = (r_value - 1) & 0xFF
+            return op
+        def dec(r_value):
             result = (r_value - 1) & 0xFF
-            self.memory[self.HL] = result
-        else:
-            r_value = getattr(self, src)
+            # keep c, set n
+            regs[F] = (
+                (regs[F] & 0x10)
+                | 0x40
+                | (0x80 if result == 0 else 0)
+                | (0x20 if (r_value & 0x0F) == 0 else 0)
+            )
+            return result
+        if src == 6:
+            return self._modify(src, dec)
+        def op(n):
+            r_value = regs[src]
             result = (r_value - 1) & 0xFF
-            setattr(self, src, result)
-        # keep c
-        self.F &= 0x10
-        # set n
-        self.F |= 0x40
-        if result == 0:
-            self.F |= 0x80
-        if r_value & 0x0F == 0:
-            self.F |= 0x20
+            regs[src] = result
+            regs[F] = (
+                (regs[F] & 0x10)
+                | 0x40
+                | (0x80 if result == 0 else 0)
+                | (0x20 if (r_value & 0x0F) == 0 else 0)
+            )
+        return op
 
-        return True
+    def _init_INC_DEC_rr(self):     # 0x03 - 0x33, 0x0B - 0x3B
+        regs = self.regs
+        for row, pair in enumerate(self.pairs):
+            if pair is None:
+                def inc(n):
+                    self.SP = (self.SP + 1) & 0xFFFF
+                def dec(n):
+                    self.SP = (self.SP - 1) & 0xFFFF
+            else:
+                def inc(n, hi=pair[0], lo=pair[1]):
+                    if regs[lo] == 0xFF:
+                        regs[lo] = 0
+                        regs[hi] = (regs[hi] + 1) & 0xFF
+                    else:
+                        regs[lo] += 1
+                def dec(n, hi=pair[0], lo=pair[1]):
+                    if regs[lo] == 0:
+                        regs[lo] = 0xFF
+                        regs[hi] = (regs[hi] - 1) & 0xFF
+                    else:
+                        regs[lo] -= 1
+            self.ops[0x03 + row*0x10] = inc
+            self.ops[0x0B + row*0x10] = dec
 
-    def _init_LD_r_n(self):     # 1-3x6 + 1-3xE
-        for col, src in enumerate(self.registers):
-            opcode = 0x06 + (col * 0x08)
-            self.opcode_table[opcode] = (lambda d=None,s=src,i=None: self.LD_r_n(s))
-    
-    def LD_r_n(self, src):
-        if src == '(HL)':
-            self.memory[self.HL] = (self.memory[self.PC + 1] & 0xFF)
-        else:
-            setattr(self, src, self.memory[self.PC + 1] & 0xFF)
-        self.PC += 1
-        return True
+    def _init_ADD_HL_rr(self):      # 0x09, 0x19, 0x29, 0x39
+        for row, pair in enumerate(self.pairs):
+            self.ops[0x09 + row*0x10] = self.ADD_HL_rr(pair)
+
+    def ADD_HL_rr(self, pair):
+        regs = self.regs
+        def op(n):
+            hl = (regs[H] << 8) | regs[L]
+            value = self.SP if pair is None else (regs[pair[0]] << 8) | regs[pair[1]]
+            result = hl + value
+            # keep z, n = 0
+            regs[F] = (
+                (regs[F] & 0x80)
+                | (0x20 if ((hl & 0xFFF) + (value & 0xFFF)) > 0xFFF else 0)
+                | (0x10 if result > 0xFFFF else 0)
+            )
+            regs[H] = (result >> 8) & 0xFF
+            regs[L] = result & 0xFF
+        return op
+
+    def _init_SP_ops(self):
+        regs = self.regs
+
+        def sp_plus_e(n):
+            # SP + signed e8, flags come from the unsigned low byte add
+            sp = self.SP
+            regs[F] = (
+                (0x20 if ((sp & 0xF) + (n & 0xF)) > 0xF else 0)
+                | (0x10 if ((sp & 0xFF) + n) > 0xFF else 0)
+            )
+            return (sp + (n - 0x100 if n & 0x80 else n)) & 0xFFFF
+
+        def ADD_SP_e(n):        # 0xE8
+            self.SP = sp_plus_e(n)
+        def LD_HL_SP_e(n):      # 0xF8
+            hl = sp_plus_e(n)
+            regs[H] = hl >> 8
+            regs[L] = hl & 0xFF
+        def LD_SP_HL(n):        # 0xF9
+            self.SP = (regs[H] << 8) | regs[L]
+
+        self.ops[0xE8] = ADD_SP_e
+        self.ops[0xF8] = LD_HL_SP_e
+        self.ops[0xF9] = LD_SP_HL
+
+    def _init_accumulator_ops(self):
+        regs = self.regs
+
+        def RLCA(n):            # 0x07
+            a = regs[A]
+            carry = a >> 7
+            regs[A] = ((a << 1) | carry) & 0xFF
+            regs[F] = carry << 4
+        def RRCA(n):            # 0x0F
+            a = regs[A]
+            carry = a & 1
+            regs[A] = (a >> 1) | (carry << 7)
+            regs[F] = carry << 4
+        def RLA(n):             # 0x17
+            a = regs[A]
+            regs[A] = ((a << 1) | ((regs[F] >> 4) & 1)) & 0xFF
+            regs[F] = (a >> 7) << 4
+        def RRA(n):             # 0x1F
+            a = regs[A]
+            regs[A] = (a >> 1) | ((regs[F] & 0x10) << 3)
+            regs[F] = (a & 1) << 4
+        def DAA(n):             # 0x27
+            a = regs[A]
+            f = regs[F]
+            carry = f & 0x10
+            if f & 0x40:
+                if carry:
+                    a -= 0x60
+                if f & 0x20:
+                    a -= 0x06
+            else:
+                if carry or a > 0x99:
+                    a += 0x60
+                    carry = 0x10
+                if (f & 0x20) or (a & 0x0F) > 0x09:
+                    a += 0x06
+            a &= 0xFF
+            regs[A] = a
+            regs[F] = (0x80 if a == 0 else 0) | (f & 0x40) | carry
+        def CPL(n):             # 0x2F
+            regs[A] ^= 0xFF
+            regs[F] |= 0x60
+        def SCF(n):             # 0x37
+            regs[F] = (regs[F] & 0x80) | 0x10
+        def CCF(n):             # 0x3F
+            regs[F] = (regs[F] & 0x90) ^ 0x10
+
+        self.ops[0x07] = RLCA
+        self.ops[0x0F] = RRCA
+        self.ops[0x17] = RLA
+        self.ops[0x1F] = RRA
+        self.ops[0x27] = DAA
+        self.ops[0x2F] = CPL
+        self.ops[0x37] = SCF
+        self.ops[0x3F] = CCF
+
+    def _init_jumps(self):
+        regs = self.regs
+        memory = self.memory
+
+        def JR_e(n):            # 0x18
+            self.PC = (self.PC + (n - 0x100 if n & 0x80 else n)) & 0xFFFF
+        def JP_nn(n):           # 0xC3
+            self.PC = n
+        def JP_HL(n):           # 0xE9
+            self.PC = (regs[H] << 8) | regs[L]
+        def CALL_nn(n):         # 0xCD
+            sp = (self.SP - 2) & 0xFFFF
+            pc = self.PC
+            memory[sp] = pc & 0xFF
+            memory[(sp + 1) & 0xFFFF] = pc >> 8
+            self.SP = sp
+            self.PC = n
+        def RET(n):             # 0xC9
+            sp = self.SP
+            self.PC = memory[sp] | (memory[(sp + 1) & 0xFFFF] << 8)
+            self.SP = (sp + 2) & 0xFFFF
+        def RETI(n):            # 0xD9
+            RET(n)
+            self.ime = True
+            self.stop()
+
+        self.ops[0x18] = JR_e
+        self.ops[0xC3] = JP_nn
+        self.ops[0xE9] = JP_HL
+        self.ops[0xCD] = CALL_nn
+        self.ops[0xC9] = RET
+        self.ops[0xD9] = RETI
+        for cc in range(4):
+            mask, want = self._condition(cc)
+            self.ops[0x20 + cc*8] = self.branch(mask, want, JR_e, self.regular.taken[0x20 + cc*8])
+            self.ops[0xC2 + cc*8] = self.branch(mask, want, JP_nn, self.regular.taken[0xC2 + cc*8])
+            self.ops[0xC4 + cc*8] = self.branch(mask, want, CALL_nn, self.regular.taken[0xC4 + cc*8])
+            self.ops[0xC0 + cc*8] = self.branch(mask, want, RET, self.regular.taken[0xC0 + cc*8])
+        for row in range(8):    # RST 00h - 38h
+            self.ops[0xC7 + row*8] = (lambda n, target=row*8: CALL_nn(target))
+
+    def branch(self, mask, want, jump, penalty):
+        regs = self.regs
+        def op(n):
+            if (regs[F] & mask) == want:
+                jump(n)
+                self.cycles += penalty
+        return op
+
+    def _init_stack(self):
+        for row, pair in enumerate(self.stack_pairs):
+            self.ops[0xC5 + row*0x10] = self.PUSH_rr(*pair)
+            self.ops[0xC1 + row*0x10] = self.POP_rr(*pair)
+
+    def PUSH_rr(self, hi, lo):
+        regs = self.regs
+        memory = self.memory
+        def op(n):
+            sp = (self.SP - 2) & 0xFFFF
+            memory[sp] = regs[lo]
+            memory[(sp + 1) & 0xFFFF] = regs[hi]
+            self.SP = sp
+        return op
+
+    def POP_rr(self, hi, lo):
+        regs = self.regs
+        memory = self.memory
+        # POP AF drops the unused low nibble of F
+        mask = 0xF0 if lo == F else 0xFF
+        def op(n):
+            sp = self.SP
+            regs[lo] = memory[sp] & mask
+            regs[hi] = memory[(sp + 1) & 0xFFFF]
+            self.SP = (sp + 2) & 0xFFFF
+        return op
+
+    # =CB prefixed=
+    def _init_CB(self):
+        shifts = [self.RLC, self.RRC, self.RL, self.RR, self.SLA, self.SRA, self.SWAP, self.SRL]
+        for row, shift in enumerate(shifts):    # 0x00 - 0x3F
+            for col, src in enumerate(self.registers):
+                self.cb_ops[row*8 + col] = self._modify(col, shift())
+        for bit in range(8):
+            for col, src in enumerate(self.registers):
+                self.cb_ops[0x40 + bit*8 + col] = self.BIT(bit, col)
+                self.cb_ops[0x80 + bit*8 + col] = self.RES(bit, col)
+                self.cb_ops[0xC0 + bit*8 + col] = self.SET(bit, col)
+
+    # shifts return value -> result and set z/c, n = h = 0
+    def RLC(self):
+        regs = self.regs
+        def op(value):
+            result = ((value << 1) | (value >> 7)) & 0xFF
+            regs[F] = (0x80 if result == 0 else 0) | ((value >> 3) & 0x10)
+            return result
+        return op
+
+    def RRC(self):
+        regs = self.regs
+        def op(value):
+            result = (value >> 1) | ((value & 1) << 7)
+            regs[F] = (0x80 if result == 0 else 0) | ((value & 1) << 4)
+            return result
+        return op
 
+    def RL(self):
+        regs = self.regs
+        def op(value):
+            result = ((value << 1) | ((regs[F] >> 4) & 1)) & 0xFF
+            regs[F] = (0x80 if result == 0 else 0) | ((value >> 3) & 0x10)
+            return result
+        return op
 
-    def NOP(self):
+    def RR(self):
+        regs = self.regs
+        def op(value):
+            result = (value >> 1) | ((regs[F] & 0x10) << 3)
+            regs[F] = (0x80 if result == 0 else 0) | ((value & 1) << 4)
+            return result
+        return op
+
+    def SLA(self):
+        regs = self.regs
+        def op(value):
+            result = (value << 1) & 0xFF
+            regs[F] = (0x80 if result == 0 else 0) | ((value >> 3) & 0x10)
+            return result
+        return op
+
+    def SRA(self):
+        regs = self.regs
+        def op(value):
+            result = (value >> 1) | (value & 0x80)
+            regs[F] = (0x80 if result == 0 else 0) | ((value & 1) << 4)
+            return result
+        return op
+
+    def SWAP(self):
+        regs = self.regs
+        def op(value):
+            result = ((value << 4) | (value >> 4)) & 0xFF
+            regs[F] = 0x80 if result == 0 else 0
+            return result
+        return op
+
+    def SRL(self):
+        regs = self.regs
+        def op(value):
+            result = value >> 1
+            regs[F] = (0x80 if result == 0 else 0) | ((value & 1) << 4)
+            return result
+        return op
+
+    def BIT(self, bit, src):
+        regs = self.regs
+        mask = 1 << bit
+        def op(value):
+            # keep c, h = 1
+            regs[F] = (regs[F] & 0x10) | 0x20 | (0 if value & mask else 0x80)
+        return self._operand(src, op)
+
+    def RES(self, bit, src):
+        mask = ~(1 << bit) & 0xFF
+        return self._modify(src, lambda value: value & mask)
+
+    def SET(self, bit, src):
+        mask = 1 << bit
+        return self._modify(src, lambda value: value | mask)
+
+    # =Control=
+    def NOP(self, n):
         # NOP: do nothing (4 cycles)
-        return True
-    
+        pass
+
+    def HALT(self, n):
+        # with an interrupt already pending there is nothing to wait for:
+        # end the run so interrupt() dispatches it, or with IME clear
+        # execution just goes on
+        memory = self.memory
+        if memory[0xFFFF] & memory[0xFF0F] & 0x1F:
+            self.stop()
+        else:
+            self.halted = True
+
+    def STOP(self, n):
+        self.stopped = True
+
+    def DI(self, n):
+        self.ime = False
+        self.ei_delay = False
 
+    def EI(self, n):
+        # takes effect after the next instruction, see interrupt()
+        self.ei_delay = True
+        self.stop()
+
+    def PREFIX(self, n):
+        self.cb_ops[n](n)
+        self.cycles += self.cb_cycles[n]
+
+    def ILLEGAL(self, opcode):
+        def op(n):
+            raise Exception(f"Illegal opcode 0x{opcode:02X} at 0x{(self.PC - 1) & 0xFFFF:04X}")
+        return op
 
     def cycle(self):
+        if self.halted or self.stopped:
+            self.cycles += 4
+            return
+        memory = self.memory
         # =Fetch=
-        self.opcode = self.memory[self.PC]  # instructions from gb rom        
-        self.PC += 1
+        pc = self.PC
+        opcode = memory[pc]  # instructions from gb rom
         # =Decode=
-        if self.opcode == 0xCB:
-            #operands = self.prefixed[self.opcode].operands
-            # TODO: fix cycles
-            self.opcode = self.memory[self.PC]
-            self.PC += 1
-            handler = self.opcode_table.get(self.opcode)
-            self.cycles += self.prefixed[self.opcode].cycles
+        length = self.op_bytes[opcode]
+        if length == 1:
+            n = 0
+        elif length == 2:
+            n = memory[(pc + 1) & 0xFFFF]
         else:
-            handler = self.opcode_table.get(self.opcode)
-            self.cycles += self.regular[self.opcode].cycles
+            n = memory[(pc + 1) & 0xFFFF] | (memory[(pc + 2) & 0xFFFF] << 8)
+        self.PC = (pc + length) & 0xFFFF
         # =Execute=
-        s = self.registers[self.opcode & 0x07]
-        d = self.registers[(self.opcode >> 3) & 0x07]
-        i = None #immediate value TODO
-        if handler:
+        self.ops[opcode](n)
+        self.cycles += self.op_cycles[opcode]
+        self.opcodes += 1
+        if self.flag_op is not None:
+            self.sync_flags()
+
+    # =Interrupts=
+    def _read_if(self, addr):
+        return self.memory.data[addr] | 0xE0
+
+    def _write_interrupt(self, addr, value):
+        self.memory.data[addr] = value & 0x1F if addr == 0xFF0F else value
+        self.stop()
+
+    def interrupt(self):
+        # called between run()s: finish a pending EI, then wake from HALT
+        # (STOP: joypad only) and dispatch the highest priority pending
+        # interrupt if enabled
+        if self.ei_delay:
+            self.cycle()
+            if self.ei_delay:   # not cancelled by a DI right after
+                self.ei_delay = False
+                self.ime = True
+        data = self.memory.data
+        pending = data[0xFFFF] & data[0xFF0F] & 0x1F
+        if not pending:
+            return False
+        self.halted = False
+        if pending & 0x10:
+            self.stopped = False    # only the joypad ends STOP
+        if self.stopped or not self.ime:
+            return False
+        bit = pending & -pending
+        data[0xFF0F] &= ~bit
+        self.ime = False
+        sp = (self.SP - 2) & 0xFFFF
+        self.memory[sp] = self.PC & 0xFF
+        self.memory[(sp + 1) & 0xFFFF] = self.PC >> 8
+        self.SP = sp
+        self.PC = 0x40 + (bit.bit_length() - 1) * 8
+        self.cycles += 20
+        return True
+
+    # =Block cache=
+    def run(self, until):
+        # execute cached blocks until self.cycles reaches until. Stops are
+        # only checked between blocks, so this can overshoot by one block.
+        # Anything setting self.until lower (see stop()) ends the run early,
+        # and so does reaching a breakpoint after the first instruction.
+        self.until = until
+        memory = self.memory
+        blocks = self.blocks
+        breakpoints = self.breakpoints
+        while self.cycles < self.until:
+            if self.halted or self.stopped:
+                # nothing executes until an interrupt, and those only come
+                # from events at or after until: skip the idle cycles. One
+                # already pending wakes the CPU in interrupt() instead.
+                data = memory.data
+                wake = 0x10 if self.stopped else 0x1F
+                if not data[0xFFFF] & data[0xFF0F] & wake and self.until != float("inf"):
+                    self.cycles = self.until
+                break
+            pc = self.PC
+            if pc < 0x4000:
+                key = (memory.bank0 << 16) | pc
+            elif pc < 0x8000:
+                key = (memory.bank1 << 16) | pc
+            else:
+                key = pc
+            block = blocks.get(key)
+            if block is None:
+                block = self.decode_block(pc, key)
+                if block is None:
+                    # not cacheable (VRAM, cart RAM, IO), step it
+                    self.cycle()
+                    if breakpoints and self.PC in breakpoints:
+                        break
+                    continue
+            for handler, n, next_pc, cost in block:
+                self.PC = next_pc
+                handler(n)
+                self.cycles += cost
+            self.opcodes += len(block)
+            if breakpoints and self.PC in breakpoints:
+                break
+        if self.flag_op is not None:
+            self.sync_flags()
+
+    def stop(self):
+        # end run() at the next block boundary
+        self.until = 0
+
+    def limit(self, until):
+        # end run() at the first block boundary at or past until
+        if until < self.until:
+            self.until = until
+
+    def stall(self, cycles):
+        # something else holds the bus (VRAM DMA): time passes, nothing runs
+        self.cycles += cycles
+
+    def decode_block(self, pc, key):
+        memory = self.memory
+        if pc < 0x4000:
+            limit = 0x4000
+        elif pc < 0x8000:
+            limit = 0x8000
+        elif 0xC000 <= pc < 0xFE00 or 0xFF80 <= pc < 0xFFFF:
+            # RAM blocks stay within one page so a write there drops them
+            limit = min((pc | 0xFF) + 1, 0xFFFF)
+        else:
+            return None
+        ops = self.ops
+        op_bytes = self.op_bytes
+        op_cycles = self.op_cycles
+        ends_block = self.ends_block
+        breakpoints = self.breakpoints
+        block = []
+        while len(block) < MAX_BLOCK:
+            if block and pc in breakpoints:
+                break
+            opcode = memory[pc]
+            length = op_bytes[opcode]
+            if pc + length > limit:
+                break
+            if length == 1:
+                n = 0
+            elif length == 2:
+                n = memory[pc + 1]
+            else:
+                n = memory[pc + 1] | (memory[pc + 2] << 8)
+            pc += length
+            if opcode == 0xCB:
+                block.append((self.cb_ops[n], n, pc, self.cb_cycles[n]))
+            else:
+                block.append((ops[opcode], n, pc & 0xFFFF, op_cycles[opcode]))
+            if ends_block[opcode]:
+                break
+        if not block:
+            return None
+        block = tuple(block)
+        self.blocks[key] = block
+        if key >= 0x8000 and key < 0x10000:
+            page = key >> 8
+            keys = self.ram_blocks.get(page)
+            if keys is None:
+                self.ram_blocks[page] = [key]
+                memory.watch(page, self._drop_ram_blocks)
+            else:
+                keys.append(key)
+        return block
+
+    def _drop_ram_blocks(self, page):
+        # code in a RAM page was written, forget what was decoded from it
+        for key in self.ram_blocks.pop(page, ()):
+            self.blocks.pop(key, None)
 
-            result = handler(s, d, i)
-            if result is False:
-                increment_PC = False
-        
+    def set_breakpoints(self, addresses):
+        addresses = frozenset(addresses)
+        if addresses != self.breakpoints:
+            # blocks are cut at breakpoints, so they have to be decoded again
+            self.breakpoints = addresses
+            self.flush_blocks()
 
+    def flush_blocks(self):
+        self.blocks.clear()
+        self.ram_blocks.clear()
 
+    # =Savestate=
+    def get_state(self):
+        self.sync_flags()
+        return (bytes(self.regs), self.PC, self.SP, self.ime, self.ei_delay,
+                self.halted, self.stopped, self.cycles, self.opcodes)
 
-    
\ No newline at end of file
+    def set_state(self, state):
+        (regs, self.PC, self.SP, self.ime, self.ei_delay, self.halted,
+         self.stopped, self.cycles, self.opcodes) = state
+        self.regs[:] = regs
+        self.flag_op = None
@@ -0,0 +1,158 @@
+from collections import namedtuple
+from hashlib import blake2b
+from array import array
+import zlib
+
+# Incremental state digests, for comparing runs without comparing states.
+# Every 256 byte page of what a savestate holds (the 64kb address space and
+# cart RAM) keeps a crc32, recomputed only for pages written since the last
+# update(). Writes are caught the way the save RAM flush does it: a watch()
+# per page fires on its first write and the page takes the fast path again
+# until the next update re-arms it. IO/HRAM is written behind the bus by the
+# peripherals and is hashed every time, pages nothing on the bus can write
+# (ROM, echo RAM, unmapped cart RAM) only change on a state load (reset()).
+# A cart RAM watch stands for the bank mapped when it fires, so a RAM bank
+# switch re-arms all of them.
+# The digest is a hash of the component sections plus all page crcs.
+
+REGIONS = (
+    ("ROM", 0x00, 0x80),
+    ("VRAM", 0x80, 0xA0),
+    ("ERAM", 0xA0, 0xC0),
+    ("WRAM", 0xC0, 0xE0),
+    ("ECHO", 0xE0, 0xFE),
+    ("OAM", 0xFE, 0xFF),
+    ("IO/HRAM", 0xFF, 0x100),
+)
+WATCHED = [*range(0x80, 0xE0), 0xFE]
+CPU_FIELDS = ("B", "C", "D", "E", "H", "L", "F", "A", "PC", "SP", "ime", "ei_delay",
+              "halted", "stopped", "cycles", "opcodes")
+
+# what diff() compares: component name -> get_state() tuple, and the page
+# crcs of the address space and of cart RAM
+Snapshot = namedtuple("Snapshot", "sections pages ram_pages")
+
+
+def _components(gb):
+    components = [("cpu", gb.cpu), ("ppu", gb.ppu), ("timer", gb.timer), ("serial", gb.serial),
+                  ("joypad", gb.joypad), ("apu", gb.apu)]
+    if gb.memory.mbc is not None:
+        components.append(("mbc", gb.memory.mbc))
+    return components + [("dma", gb.dma)]
+
+
+def _ram(gb):
+    mbc = gb.memory.mbc
+    return mbc.ram if mbc is not None else b""
+
+
+class StateDigest:
+    def __init__(self, gb):
+        self.gb = gb
+        self.memory = gb.memory
+        self.memory.ram_listeners.append(self._ram_mapped)
+        self.reset()
+
+    def reset(self):
+        # everything hashed again on the next update, after a ROM or state
+        # load replaced memory wholesale
+        self.pages = array("I", bytes(4 * 0x100))
+        self.ram_pages = array("I", bytes(4 * (len(_ram(self.gb)) >> 8)))
+        self.dirty = set(range(0x100))
+        self.ram_dirty = set(range(len(self.ram_pages)))
+
+    def _ram_mapped(self):
+        # writes from here on land in another bank, catch them again
+        for page in range(0xA0, 0xC0):
+            self.memory.watch(page, self._mark)
+
+    def _mark(self, page):
+        self.dirty.add(page)
+        if 0xA0 <= page < 0xC0:
+            # a cart RAM write lands in the mapped bank (see MBC._mark_dirty)
+            mbc = self.memory.mbc
+            eram = self.memory.eram
+            if mbc is not None and eram is not None and len(mbc.ram):
+                bank = mbc.ram_bank % mbc.ram_banks
+                self.ram_dirty.add((bank * 0x2000 + (((page - 0xA0) << 8) % len(eram))) >> 8)
+
+    def update(self):
+        # rehash what was written since the last update, re-arm its watches
+        self.gb.ppu.sync()
+        memory = self.memory
+        data = memoryview(memory.data)
+        pages = self.pages
+        crc32 = zlib.crc32
+        for page in self.dirty:
+            pages[page] = crc32(data[page << 8:(page + 1) << 8])
+        watched = self.dirty.intersection(WATCHED)
+        self.dirty = {0xFF}
+        ram = memoryview(_ram(self.gb))
+        ram_pages = self.ram_pages
+        for page in self.ram_dirty:
+            ram_pages[page] = crc32(ram[page << 8:(page + 1) << 8])
+        self.ram_dirty = set()
+        for page in watched:
+            memory.watch(page, self._mark)
+
+    def snapshot(self):
+        self.update()
+        return Snapshot({name: component.get_state() for name, component in _components(self.gb)},
+                        tuple(self.pages), tuple(self.ram_pages))
+
+    def digest(self):
+        # 64 bit hash of the whole state
+        self.update()
+        h = blake2b(digest_size=8)
+        for _, component in _components(self.gb):
+            h.update(component.STATE.pack(*component.get_state()))
+        h.update(self.pages)
+        h.update(self.ram_pages)
+        return int.from_bytes(h.digest(), "little")
+
+    def regions(self):
+        # region name -> crc of its page crcs, plus one per component
+        self.update()
+        hashes = {name: zlib.crc32(self.pages[first:last]) for name, first, last in REGIONS}
+        hashes["SRAM"] = zlib.crc32(self.ram_pages)
+        for name, component in _components(self.gb):
+            hashes[name] = zlib.crc32(component.STATE.pack(*component.get_state()))
+        return hashes
+
+
+def _page_name(page):
+    for name, first, last in REGIONS:
+        if first <= page < last:
+            return f"{name}:{page << 8:04X}"
+
+
+def diff(a, b):
+    # what differs between two emulators (their state_digest()s) or
+    # snapshots, as a list of names: CPU registers ("cpu.PC"), other
+    # sections by field index ("timer[2]") and pages ("WRAM:C100",
+    # "SRAM:0200" for cart RAM)
+    if not isinstance(a, Snapshot):
+        a = a.state_digest().snapshot()
+    if not isinstance(b, Snapshot):
+        b = b.state_digest().snapshot()
+    differences = []
+    names = list(a.sections) + [name for name in b.sections if name not in a.sections]
+    for name in names:
+        left, right = a.sections.get(name), b.sections.get(name)
+        if left == right:
+            continue
+        if left is None or right is None:
+            differences.append(name)
+        elif name == "cpu":
+            left = tuple(left[0]) + tuple(left[1:])
+            right = tuple(right[0]) + tuple(right[1:])
+            differences.extend(f"cpu.{field}" for field, x, y in zip(CPU_FIELDS, left, right) if x != y)
+        else:
+            differences.extend(f"{name}[{i}]" for i, (x, y) in enumerate(zip(left, right)) if x != y)
+    differences.extend(_page_name(page) for page, (x, y) in enumerate(zip(a.pages, b.pages)) if x != y)
+    if len(a.ram_pages) != len(b.ram_pages):
+        differences.append("SRAM")
+    else:
+        differences.extend(f"SRAM:{page << 8:04X}" for page, (x, y) in enumerate(zip(a.ram_pages, b.ram_pages))
+                           if x != y)
+    return differences
@@ -0,0 +1,298 @@
+from .cartridge import parse_header
+from bisect import bisect_right
+from pathlib import Path
+import marshal
+import os
+import zlib
+
+# Static disassembly. analyze() follows the code of a ROM from its entry
+# point and interrupt vectors (recursive traversal: jumps, calls and RSTs
+# are followed, JP HL and code in RAM are not) and builds a CodeIndex:
+# every reached instruction, the basic blocks with their successors and the
+# call targets. Addresses are keyed like the CPU's block cache, (bank << 16)
+# | PC with bank 0 for 0x0000 - 0x3FFF, so an index can pre-seed it.
+#
+# Which bank a jump into 0x4000 - 0x7FFF lands in is only known when the
+# code switches banks right before it (LD A,n then LD (2000-3FFF),A on the
+# same path); from bank 0 it is taken to be bank 1 otherwise.
+
+INDEX_VERSION = 2
+INDEX_DIR = Path(__file__).resolve().parents[2] / "data" / "index"
+ENTRY_POINTS = {
+    0x0100: "start",
+    0x0040: "int_vblank",
+    0x0048: "int_stat",
+    0x0050: "int_timer",
+    0x0058: "int_serial",
+    0x0060: "int_joypad",
+}
+CONDITIONS = {"NZ", "Z", "NC", "C"}
+BRANCHES = {"JR", "JP", "CALL", "RST", "RET", "RETI"}
+
+
+def _key(bank, pc):
+    return pc if pc < 0x4000 else (bank << 16) | pc
+
+
+def _location(key):
+    pc = key & 0xFFFF
+    return f"{pc:04X}" if pc < 0x4000 or pc >= 0x8000 else f"{key >> 16:02X}:{pc:04X}"
+
+
+def rom_key(rom):
+    # name of a ROM's index: title + the header and global checksums, and a
+    # crc32 of the whole ROM since homebrew and test ROMs often share a
+    # header (and leave the global checksum 0)
+    header = parse_header(rom)
+    title = "".join(c if c.isalnum() else "_" for c in header["title"]) or "untitled"
+    return (f"{title}-{header['global_checksum']:04X}{header['header_checksum']:02X}-{len(rom) >> 14}"
+            f"-{zlib.crc32(rom):08X}")
+
+
+class CodeIndex:
+    def __init__(self, rom_key, instructions, blocks, calls, indirect):
+        self.rom_key = rom_key
+        self.instructions = instructions    # key -> (opcode, immediate, length)
+        self.blocks = blocks                # start key -> (end key, successor keys)
+        self.calls = calls                  # target key -> call site keys
+        self.indirect = indirect            # keys of JP HL and jumps into RAM
+        # function starts for symbol(): entry points and call targets
+        self.functions = sorted(set(calls) | {k for k in ENTRY_POINTS if k in instructions})
+        self._banks = None      # switchable PC -> banks it is code in
+
+    def locate(self, pc):
+        # the key of code at pc when only the PC is known (traces): ROM0 and
+        # RAM addresses are keys already, a switchable one is resolved when
+        # exactly one bank has code there
+        if pc < 0x4000 or pc >= 0x8000:
+            return pc
+        if self._banks is None:
+            self._banks = {}
+            for key in self.instructions:
+                if 0x4000 <= key & 0xFFFF < 0x8000:
+                    self._banks.setdefault(key & 0xFFFF, []).append(key)
+        keys = self._banks.get(pc, ())
+        return keys[0] if len(keys) == 1 else None
+
+    def label(self, key):
+        if key in ENTRY_POINTS:
+            return ENTRY_POINTS[key]
+        if key in self.calls:
+            return f"sub_{_location(key).replace(':', '_')}"
+        return f"loc_{_location(key).replace(':', '_')}"
+
+    def symbol(self, key):
+        # "sub_0150+12": the function key is in (the closest start at or
+        # before it in the same bank), None outside of known code
+        i = bisect_right(self.functions, key)
+        if not i:
+            return None
+        start = self.functions[i - 1]
+        if start >> 16 != key >> 16:
+            return None
+        offset = (key & 0xFFFF) - (start & 0xFFFF)
+        return self.label(start) + (f"+{offset}" if offset else "")
+
+    def listing(self, regular, prefixed):
+        # the disassembly in address order, with labels at block starts
+        lines = []
+        for key in sorted(self.instructions):
+            if key in self.blocks:
+                lines.append(f"{self.label(key)}:")
+            opcode, n, length = self.instructions[key]
+            lines.append(f"    {_location(key)}  {format_instruction(regular, prefixed, opcode, n, key & 0xFFFF)}")
+        return lines
+
+    # =Persistence=
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(marshal.dumps((INDEX_VERSION, self.rom_key, self.instructions, self.blocks,
+                                   self.calls, self.indirect)))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            version, *fields = marshal.loads(f.read())
+        if version != INDEX_VERSION:
+            raise ValueError("index of another version")
+        return cls(*fields)
+
+
+def format_instruction(regular, prefixed, opcode, n, pc):
+    # "JP $0150", "LD A,($FF44)", "BIT 7,H"
+    if opcode == 0xCB:
+        table, opcode, n = prefixed, n, 0
+    else:
+        table = regular
+    parts = []
+    for name, _, immediate, adjust in table.operands[opcode]:
+        if name == "n8":
+            text = f"${n:02X}"
+        elif name == "a8":
+            text = f"${0xFF00 | n:04X}"
+        elif name in ("n16", "a16"):
+            text = f"${n:04X}"
+        elif name == "e8":
+            e = n - 0x100 if n & 0x80 else n
+            text = f"${(pc + 2 + e) & 0xFFFF:04X}" if table.mnemonic[opcode] == "JR" else f"{e:+d}"
+        else:
+            text = name + (adjust or "")
+        parts.append(text if immediate else f"({text})")
+    mnemonic = table.mnemonic[opcode]
+    return f"{mnemonic} {','.join(parts)}" if parts else mnemonic
+
+
+def analyze(rom, regular):
+    banks = max(2, len(rom) // 0x4000)
+    instructions = {}
+    leaders = set()
+    ends = set()            # keys of instructions that end a block
+    stops = set()           # ... and of those execution never continues after
+    targets = {}            # key -> branch target keys
+    calls = {}
+    indirect = set()
+    work = [(0, pc) for pc in ENTRY_POINTS]
+
+    while work:
+        bank, pc = work.pop()
+        key = _key(bank, pc)
+        leaders.add(key)
+        last_a = None       # value of the last LD A,n on this path
+        far = None          # bank switched to on this path
+        while key not in instructions:
+            offset = pc if pc < 0x4000 else bank * 0x4000 + pc - 0x4000
+            opcode = rom[offset]
+            # like the CPU: PREFIX takes the CB opcode as its immediate and
+            # STOP is followed by a padding byte
+            length = 2 if opcode in (0xCB, 0x10) else regular.bytes[opcode]
+            if pc + length > (0x4000 if pc < 0x4000 else 0x8000) or offset + length > len(rom):
+                break
+            n = 0
+            if length == 2:
+                n = rom[offset + 1]
+            elif length == 3:
+                n = rom[offset + 1] | rom[offset + 2] << 8
+            instructions[key] = (opcode, n, length)
+            mnemonic = regular.mnemonic[opcode]
+            operands = regular.operands[opcode]
+            following = pc + length
+
+            if opcode == 0x3E:
+                last_a = n
+            elif opcode == 0xEA and 0x2000 <= n < 0x4000 and last_a is not None:
+                far = (last_a or 1) % banks
+
+            if mnemonic.startswith("ILLEGAL"):
+                ends.add(key)
+                stops.add(key)
+                break
+            if mnemonic in BRANCHES:
+                conditional = bool(operands) and operands[0][0] in CONDITIONS
+                if mnemonic == "JP" and operands[0][0] == "HL":
+                    indirect.add(key)
+                    ends.add(key)
+                    stops.add(key)
+                    break
+                target = None
+                if mnemonic == "JR":
+                    target = (following + (n - 0x100 if n & 0x80 else n)) & 0xFFFF
+                elif mnemonic in ("JP", "CALL"):
+                    target = n
+                elif mnemonic == "RST":
+                    target = opcode & 0x38
+                if target is not None:
+                    if target >= 0x8000:
+                        indirect.add(key)
+                    else:
+                        if target < 0x4000:
+                            target_bank = 0
+                        elif pc >= 0x4000:
+                            target_bank = bank
+                        else:
+                            target_bank = far if far is not None else 1
+                        target_key = _key(target_bank, target)
+                        targets[key] = (target_key,)
+                        work.append((target_bank, target))
+                        if mnemonic in ("CALL", "RST"):
+                            calls.setdefault(target_key, []).append(key)
+                ends.add(key)
+                if mnemonic in ("CALL", "RST") or conditional:
+                    # execution comes back (or falls through) after it
+                    leaders.add(_key(bank, following))
+                else:
+                    stops.add(key)
+                    break
+            pc = following
+            key = _key(bank, pc)
+            if pc >= 0x8000 or pc == 0x4000:
+                break
+
+    # basic blocks: runs of consecutive instructions cut at leaders and
+    # after branches
+    def successors(last):
+        following = last + instructions[last][2]
+        if last in stops or following not in instructions:
+            return targets.get(last, ())
+        return targets.get(last, ()) + (following,)
+
+    blocks = {}
+    start = previous = None
+    for key in sorted(instructions):
+        if start is not None and (key in leaders or key != previous + instructions[previous][2]):
+            blocks[start] = (previous, successors(previous))
+            start = None
+        if start is None:
+            start = key
+        previous = key
+        if key in ends:
+            blocks[start] = (key, successors(key))
+            start = None
+    if start is not None:
+        blocks[start] = (previous, successors(previous))
+
+    calls = {target: tuple(sorted(sites)) for target, sites in calls.items()}
+    return CodeIndex(rom_key(rom), instructions, blocks, calls, tuple(sorted(indirect)))
+
+
+
+def load_index(rom, regular, directory=None):
+    # the index of rom from directory (INDEX_DIR by default), analysed and
+    # saved there first if it isn't yet. A read-only directory only means
+    # it is analysed every time.
+    key = rom_key(rom)
+    path = Path(directory or INDEX_DIR) / f"{key}.idx"
+    try:
+        index = CodeIndex.load(path)
+        if index.rom_key == key:
+            return index
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    index = analyze(rom, regular)
+    try:
+        index.save(path)
+    except OSError:
+        pass
+    return index
+
+
+def seed_blocks(cpu, index):
+    # decode every ROM block of index into the CPU's block cache up front,
+    # mapping each bank in while its blocks are decoded
+    memory = cpu.memory
+    bank0, bank1 = memory.bank0, memory.bank1
+    try:
+        for start in sorted(index.blocks, key=lambda key: (key >> 16, key)):
+            pc = start & 0xFFFF
+            if start in cpu.blocks or pc >= 0x8000:
+                continue
+            if pc >= 0x4000 and memory.bank1 != start >> 16:
+                memory.map_rom(0, start >> 16)
+            elif pc < 0x4000 and memory.bank0 != 0:
+                memory.map_rom(0, memory.bank1)
+            cpu.decode_block(pc, start)
+    finally:
+        memory.map_rom(bank0, bank1)
@@ -0,0 +1,150 @@
+from .ppu import LINE_CYCLES
+import struct
+
+# OAM DMA (0xFF46) and CGB VRAM DMA (HDMA1-5, 0xFF51 - 0xFF55). Every
+# transfer is a bulk copy the moment it starts (or, for HBlank DMA, the
+# moment its HBlank starts), only its timing is modelled: OAM DMA locks the
+# CPU out of everything but IO/HRAM until the scheduler says it is done,
+# VRAM DMA stalls the CPU for the cycles it keeps the bus.
+
+DMA = 0x46
+HDMA1, HDMA2, HDMA3, HDMA4, HDMA5 = 0x51, 0x52, 0x53, 0x54, 0x55
+OAM_DMA_CYCLES = 160 * 4    # one byte per M-cycle
+HDMA_BLOCK = 0x10
+HDMA_BLOCK_CYCLES = 32      # CPU stalled 8 M-cycles per block (single speed)
+
+
+class DMAController:
+    # savestate section: cycle the OAM DMA ends (-1 idle), VRAM DMA source,
+    # destination, blocks left, HBlank mode
+    STATE = struct.Struct("<qHHB?")
+
+    def __init__(self, memory, clock, scheduler=None, ppu=None, stall=None):
+        self.memory = memory
+        self.io = memory.data
+        self.clock = clock
+        self.scheduler = scheduler
+        self.ppu = ppu                  # HBlank timing for HDMA
+        self.stall = stall or (lambda cycles: None)     # stall(cycles) charges the CPU
+        self.oam_done_at = -1
+        self.oam_event = None
+        # VRAM DMA, blocks > 0 while one is running (or paused, hblank False)
+        self.source = 0
+        self.dest = 0x8000
+        self.blocks = 0
+        self.hblank = False
+        self.hdma_event = None
+        memory.register_io(0xFF00 | DMA, write=self._write_dma)
+
+    def map_hdma(self, enabled):
+        # HDMA1-5 only exist on CGB carts, elsewhere they are plain bytes
+        for reg in (HDMA1, HDMA2, HDMA3, HDMA4):
+            self.memory.register_io(0xFF00 | reg, read=self._read_write_only if enabled else None)
+        if enabled:
+            self.memory.register_io(0xFF00 | HDMA5, read=self._read_hdma5, write=self._write_hdma5)
+        else:
+            self.memory.register_io(0xFF00 | HDMA5)
+
+    # =OAM DMA=
+    def _write_dma(self, addr, value):
+        self.io[addr] = value
+        memory = self.memory
+        memory.unlock_bus()     # a restart reads the source normally
+        # sources past 0xDFFF read echo RAM
+        source = (value - 0x20 if value >= 0xE0 else value) << 8
+        data = memory.read_block(source, 0xA0)
+        memory.notify(0xFE)     # the PPU finishes its lines with the old OAM
+        memory.data[0xFE00:0xFEA0] = data
+        if self.scheduler is None:
+            return
+        self._start_oam(self.clock() + OAM_DMA_CYCLES)
+
+    def _start_oam(self, time):
+        self.scheduler.cancel(self.oam_event)
+        self.oam_done_at = time
+        self.memory.lock_bus()
+        self.oam_event = self.scheduler.schedule(time, self._oam_done)
+
+    def _oam_done(self, time):
+        self.oam_event = None
+        self.oam_done_at = -1
+        self.memory.unlock_bus()
+
+    # =VRAM DMA=
+    def _read_write_only(self, addr):
+        return 0xFF
+
+    def _read_hdma5(self, addr):
+        if not self.blocks:
+            return 0xFF
+        # blocks left - 1, bit 7 set once an HBlank DMA was stopped
+        return (self.blocks - 1) | (0x00 if self.hblank else 0x80)
+
+    def _write_hdma5(self, addr, value):
+        if self.blocks and self.hblank and not value & 0x80:
+            # stop a running HBlank DMA
+            self.hblank = False
+            self._cancel_hdma()
+            return
+        io = self.io
+        self.source = ((io[0xFF00 | HDMA1] << 8) | io[0xFF00 | HDMA2]) & 0xFFF0
+        self.dest = 0x8000 | (((io[0xFF00 | HDMA3] << 8) | io[0xFF00 | HDMA4]) & 0x1FF0)
+        self.blocks = (value & 0x7F) + 1
+        self.hblank = bool(value & 0x80)
+        self._cancel_hdma()
+        if self.hblank:
+            self._schedule_hblank(self.clock())
+        else:
+            # general purpose DMA: everything now, the CPU waits it out
+            blocks = self.blocks
+            self._copy(blocks)
+            self.stall(blocks * HDMA_BLOCK_CYCLES)
+
+    def _copy(self, blocks):
+        memory = self.memory
+        for _ in range(blocks):
+            memory.write_block(self.dest, memory.read_block(self.source, HDMA_BLOCK))
+            self.source = (self.source + HDMA_BLOCK) & 0xFFFF
+            self.dest = 0x8000 | ((self.dest + HDMA_BLOCK) & 0x1FF0)
+        self.blocks -= blocks
+
+    def _cancel_hdma(self):
+        if self.scheduler is not None:
+            self.scheduler.cancel(self.hdma_event)
+        self.hdma_event = None
+
+    def _schedule_hblank(self, time):
+        if self.scheduler is None or self.ppu is None:
+            return
+        start = self.ppu.hblank_after(time)
+        if start is None:
+            # LCD off, no HBlanks: look again a line later
+            start = time + LINE_CYCLES
+            self.hdma_event = self.scheduler.schedule(start, self._schedule_hblank)
+        else:
+            self.hdma_event = self.scheduler.schedule(start, self._hblank)
+
+    def _hblank(self, time):
+        # one block per HBlank
+        self.hdma_event = None
+        self._copy(1)
+        self.stall(HDMA_BLOCK_CYCLES)
+        if self.blocks:
+            self._schedule_hblank(time + 1)
+
+    # =Savestate=
+    def get_state(self):
+        return (self.oam_done_at, self.source, self.dest, self.blocks, self.hblank)
+
+    def set_state(self, state):
+        oam_done_at, self.source, self.dest, self.blocks, self.hblank = state
+        self._cancel_hdma()
+        if self.scheduler is not None:
+            self.scheduler.cancel(self.oam_event)
+        self.oam_event = None
+        self.oam_done_at = -1
+        self.memory.unlock_bus()
+        if oam_done_at >= 0 and self.scheduler is not None:
+            self._start_oam(oam_done_at)
+        if self.blocks and self.hblank:
+            self._schedule_hblank(self.clock())
@@ -0,0 +1,38 @@
+import numpy as np
+
+# Precomputed Z/N/H/C for the 8-bit ALU, so the handlers look their flags up
+# instead of working them out bit by bit:
+#   ADC_FLAGS[carry << 16 | a << 8 | value]    ADD (carry 0) and ADC
+#   SBC_FLAGS[carry << 16 | a << 8 | value]    SUB, CP (carry 0) and SBC
+#   INC_FLAGS[value], DEC_FLAGS[value]         Z, N and H, C is kept
+#   ZERO_FLAGS[result], AND_FLAGS[result]      OR/XOR and AND
+# carry is the old C flag as 0/1, (F & 0x10) << 12 gives carry << 16. Built
+# with the same formulas as the CPU's eager handlers (flag_tables=False),
+# tests/test_flags.py checks both agree on every input. With lazy_flags the
+# CPU keeps the table and index and only looks F up when it is read.
+
+
+def _build():
+    carry = np.arange(2).reshape(2, 1, 1)
+    a = np.arange(256).reshape(1, 256, 1)
+    value = np.arange(256).reshape(1, 1, 256)
+
+    result = a + value + carry
+    adc = (np.where((result & 0xFF) == 0, 0x80, 0)
+           | np.where((a & 0xF) + (value & 0xF) + carry > 0xF, 0x20, 0)
+           | np.where(result > 0xFF, 0x10, 0))
+    result = a - value - carry
+    sbc = (0x40
+           | np.where((result & 0xFF) == 0, 0x80, 0)
+           | np.where((a & 0xF) < (value & 0xF) + carry, 0x20, 0)
+           | np.where(result < 0, 0x10, 0))
+
+    v = np.arange(256)
+    inc = np.where(((v + 1) & 0xFF) == 0, 0x80, 0) | np.where((v & 0xF) == 0xF, 0x20, 0)
+    dec = 0x40 | np.where(((v - 1) & 0xFF) == 0, 0x80, 0) | np.where((v & 0xF) == 0, 0x20, 0)
+    zero = np.where(v == 0, 0x80, 0)
+    return tuple(table.astype(np.uint8).tobytes() for table in (adc, sbc, inc, dec, zero, zero | 0x20))
+
+
+ADC_FLAGS, SBC_FLAGS, INC_FLAGS, DEC_FLAGS, ZERO_FLAGS, AND_FLAGS = _build()
+
@@ -0,0 +1,107 @@
+from .ppu import FRAME_CYCLES
+import struct
+
+# P1 (0xFF00). The buttons are one bitmask, set from outside between runs
+# (set_buttons) or fed from a recorded movie by scheduler events at frame
+# boundaries (play). Nothing polls per instruction: reads of P1 work out
+# the selected lines from the mask.
+
+P1 = 0x00
+IF = 0x0F
+BUTTONS = {
+    "a": 0x01, "b": 0x02, "select": 0x04, "start": 0x08,
+    "right": 0x10, "left": 0x20, "up": 0x40, "down": 0x80,
+}
+
+
+class Joypad:
+    # savestate section: select bits, pressed mask
+    STATE = struct.Struct("<BB")
+
+    def __init__(self, memory, clock, scheduler=None):
+        self.io = memory.data
+        self.clock = clock
+        self.scheduler = scheduler
+        self.select = 0x30      # P1 bits 4 (directions) and 5 (buttons), 0 selects
+        self.pressed = 0        # BUTTONS bits
+        # (frame, mask) for every set_buttons() while recording, else None
+        self.changes = None
+        # movie being played: masks from frame start_frame on
+        self.inputs = b""
+        self.start_frame = 0
+        self.event = None
+        memory.register_io(0xFF00 | P1, read=self._read_p1, write=self._write_p1)
+
+    def _lines(self, mask):
+        # the 4 input lines mask pulls low under the current selection
+        low = 0
+        if not self.select & 0x10:
+            low |= mask >> 4
+        if not self.select & 0x20:
+            low |= mask & 0x0F
+        return low
+
+    def _read_p1(self, addr):
+        return 0xC0 | self.select | (~self._lines(self.pressed) & 0x0F)
+
+    def _write_p1(self, addr, value):
+        self.select = value & 0x30
+
+    def set_buttons(self, mask):
+        # hold exactly the buttons in mask. A line going low raises the
+        # joypad interrupt (which also ends STOP).
+        mask &= 0xFF
+        if self._lines(mask & ~self.pressed):
+            self.io[0xFF00 | IF] |= 0x10
+        self.pressed = mask
+        if self.changes is not None:
+            self.changes.append((self.clock() // FRAME_CYCLES, mask))
+
+    def press(self, *names):
+        self.set_buttons(self.pressed | sum(BUTTONS[name] for name in names))
+
+    def release(self, *names):
+        self.set_buttons(self.pressed & ~sum(BUTTONS[name] for name in names))
+
+    # =Movies=
+    def play(self, inputs, start_frame):
+        # hold inputs[i] from frame start_frame + i on, set by scheduler
+        # events at the frames where the mask changes
+        self.stop()
+        self.inputs = inputs
+        self.start_frame = start_frame
+        self._schedule(0)
+
+    def stop(self):
+        if self.scheduler is not None:
+            self.scheduler.cancel(self.event)
+        self.event = None
+        self.inputs = b""
+
+    @property
+    def playing(self):
+        return self.event is not None
+
+    def _schedule(self, index):
+        if index >= len(self.inputs):
+            self.event = None
+            return
+        frame = self.start_frame + index
+        self.event = self.scheduler.schedule(
+            frame * FRAME_CYCLES, lambda time: self._feed(index))
+
+    def _feed(self, index):
+        inputs = self.inputs
+        mask = inputs[index]
+        self.set_buttons(mask)
+        index += 1
+        while index < len(inputs) and inputs[index] == mask:
+            index += 1
+        self._schedule(index)
+
+    # =Savestate=
+    def get_state(self):
+        return (self.select, self.pressed)
+
+    def set_state(self, state):
+        self.select, self.pressed = state
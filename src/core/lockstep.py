@@ -0,0 +1,561 @@
+import numpy as np
+from .cartridge import parse_header
+from .cpu import CPU, B, C, D, E, H, L, F, A
+
+# Experimental lockstep engine: N instances of one ROM held as NumPy arrays
+# (memory N x 64kb, registers N x 8) and stepped together. Each step takes
+# the instances at the same PC and executes the instruction there with one
+# vectorized handler, so N instances running the same code cost about as
+# much as one.
+#
+# Only the CPU and flat memory are emulated: no PPU, timer or interrupts.
+# LY and DIV read back values derived from the instance's cycle count so
+# wait loops still progress. ROM banking follows the ROM bank register of
+# MBC1/3/5, cart RAM is a single bank. Opcodes without a vectorized
+# handler run per instance on a scalar CPU. An instance is done on HALT,
+# STOP or an illegal opcode.
+
+# CB rotates and shifts, (value, carry in) -> (result, carry out)
+SHIFTS = [
+    lambda v, c: (((v << 1) | (v >> 7)) & 0xFF, v >> 7),        # RLC
+    lambda v, c: (((v >> 1) | (v << 7)) & 0xFF, v & 1),         # RRC
+    lambda v, c: (((v << 1) | c) & 0xFF, v >> 7),               # RL
+    lambda v, c: ((v >> 1) | (c << 7), v & 1),                  # RR
+    lambda v, c: ((v << 1) & 0xFF, v >> 7),                     # SLA
+    lambda v, c: ((v >> 1) | (v & 0x80), v & 1),                # SRA
+    lambda v, c: (((v << 4) | (v >> 4)) & 0xFF, v & 0),         # SWAP
+    lambda v, c: (v >> 1, v & 1),                               # SRL
+]
+
+BANK_REGISTER = {       # mapper -> (ROM bank mask, lowest bank)
+    "ROM": None,
+    "MBC1": (0x1F, 1),
+    "MBC3": (0x7F, 1),
+    "MBC5": (0xFF, 0),
+}
+
+
+class Lockstep:
+    def __init__(self, prefixed, regular, rom, count):
+        self.count = count
+        if len(rom) < 0x8000:
+            rom = bytes(rom) + bytes(0x8000 - len(rom))
+        self.rom = np.frombuffer(rom, dtype=np.uint8)
+        self.rom_banks = max(2, len(rom) // 0x4000)
+        self.bank_register = BANK_REGISTER[parse_header(rom)["mapper"]]
+
+        # =State= one row per instance
+        self.memory = np.zeros((count, 0x10000), dtype=np.uint8)
+        self.regs = np.zeros((count, 8), dtype=np.uint8)    # B C D E H L F A
+        self.PC = np.full(count, 0x0100, dtype=np.int64)
+        self.SP = np.full(count, 0xFFFE, dtype=np.int64)
+        self.bank = np.ones(count, dtype=np.int64)
+        self.ime = np.zeros(count, dtype=bool)
+        self.cycles = np.zeros(count, dtype=np.int64)
+        self.done = np.zeros(count, dtype=bool)
+        self.errors = {}        # instance -> message, for illegal opcodes
+        self.steps = 0
+
+        # =Dispatch= handler(idx, n), None falls back to the scalar CPU
+        self.regular = regular
+        self.op_bytes = np.array(regular.bytes, dtype=np.int64)
+        self.op_cycles = np.array(regular.cycles, dtype=np.int64)
+        self.cb_cycles = np.array(prefixed.cycles, dtype=np.int64)
+        # same conventions as CPU: PREFIX takes the CB opcode as immediate
+        # and charges its cost, STOP has a padding byte
+        self.op_bytes[0xCB] = 2
+        self.op_cycles[0xCB] = 0
+        self.op_bytes[0x10] = 2
+        self.vops = [None] * 0x100
+        self.cb_vops = [None] * 0x100
+        self._init_tables()
+
+        # scalar CPU for everything else, its memory is one instance's row
+        self.lane = Lane(self)
+        self.cpu = CPU(prefixed, regular, self.lane)
+
+    def _init_tables(self):
+        self.vops[0x00] = self.NOP
+        self._init_LD_r_r()
+        self._init_LD_r_n()
+        self._init_LD_rr_nn()
+        self._init_LD_memory()
+        self._init_ALU()
+        self._init_INC_DEC_r()
+        self._init_INC_DEC_rr()
+        self._init_ADD_HL_rr()
+        self._init_SP_ops()
+        self._init_accumulator_ops()
+        self._init_jumps()
+        self._init_stack()
+        self._init_CB()
+        self.vops[0xF3] = lambda idx, n: self.ime.__setitem__(idx, False)    # DI
+        self.vops[0xFB] = lambda idx, n: self.ime.__setitem__(idx, True)     # EI
+        self.vops[0xCB] = self.PREFIX
+
+    # =Memory=
+    def read(self, idx, addr):
+        # byte at addr for instances idx, as int64
+        addr = addr & 0xFFFF
+        low, high = addr.min(), addr.max()
+        if high < 0x4000:
+            return self.rom[addr].astype(np.int64)
+        if low >= 0x8000 and high < 0xE000:
+            return self.memory[idx, addr].astype(np.int64)
+        value = self.memory[idx, addr].astype(np.int64)
+        rom = addr < 0x8000
+        if rom.any():
+            a = addr[rom]
+            banked = (self.bank[idx[rom]] % self.rom_banks) * 0x4000 + (a - 0x4000)
+            value[rom] = self.rom[np.where(a < 0x4000, a, banked)]
+        if (addr >= 0xE000).any():
+            echo = (addr >= 0xE000) & (addr < 0xFE00)
+            value[echo] = self.memory[idx[echo], addr[echo] - 0x2000]
+            ly = addr == 0xFF44
+            value[ly] = (self.cycles[idx[ly]] // 456) % 154
+            div = addr == 0xFF04
+            value[div] = (self.cycles[idx[div]] >> 8) & 0xFF
+        return value
+
+    def write(self, idx, addr, value):
+        addr = addr & 0xFFFF
+        rom = addr < 0x8000
+        if rom.any():
+            if self.bank_register is not None:
+                mask, lowest = self.bank_register
+                select = rom & (addr >= 0x2000) & (addr < 0x3000 if lowest == 0 else addr < 0x4000)
+                self.bank[idx[select]] = np.maximum(value[select] & mask, lowest)
+            keep = ~rom
+            idx, addr, value = idx[keep], addr[keep], value[keep]
+        addr = np.where((addr >= 0xE000) & (addr < 0xFE00), addr - 0x2000, addr)
+        self.memory[idx, addr] = value & 0xFF
+
+    def _pair(self, idx, hi, lo):
+        regs = self.regs
+        return (regs[idx, hi].astype(np.int64) << 8) | regs[idx, lo]
+
+    def _set_pair(self, idx, hi, lo, value):
+        self.regs[idx, hi] = (value >> 8) & 0xFF
+        self.regs[idx, lo] = value & 0xFF
+
+    def _get(self, idx, src):
+        # register code src (6 is (HL)) as int64
+        if src == 6:
+            return self.read(idx, self._pair(idx, H, L))
+        return self.regs[idx, src].astype(np.int64)
+
+    def _put(self, idx, dest, value):
+        if dest == 6:
+            self.write(idx, self._pair(idx, H, L), value)
+        else:
+            self.regs[idx, dest] = value & 0xFF
+
+    # =Vector ops=
+    def NOP(self, idx, n):
+        pass
+
+    def _init_LD_r_r(self):     # 0x40 - 0x7F
+        for dest in range(8):
+            for src in range(8):
+                if dest == 6 and src == 6:      # HALT
+                    continue
+                self.vops[0x40 + dest*8 + src] = (
+                    lambda idx, n, dest=dest, src=src: self._put(idx, dest, self._get(idx, src)))
+
+    def _init_LD_r_n(self):     # 0x06, 0x0E ... 0x3E
+        for dest in range(8):
+            self.vops[0x06 + dest*8] = lambda idx, n, dest=dest: self._put(idx, dest, n)
+
+    def _init_LD_rr_nn(self):   # 0x01, 0x11, 0x21, 0x31
+        for row, (hi, lo) in enumerate([(B, C), (D, E), (H, L)]):
+            self.vops[0x01 + row*0x10] = lambda idx, n, hi=hi, lo=lo: self._set_pair(idx, hi, lo, n)
+
+        def LD_SP_nn(idx, n):
+            self.SP[idx] = n
+        self.vops[0x31] = LD_SP_nn
+
+    def _init_LD_memory(self):
+        def LDH_mn_A(idx, n):   # 0xE0
+            self.write(idx, 0xFF00 | n, self._get(idx, A))
+        def LDH_A_mn(idx, n):   # 0xF0
+            self.regs[idx, A] = self.read(idx, 0xFF00 | n)
+        def LD_mnn_A(idx, n):   # 0xEA
+            self.write(idx, n, self._get(idx, A))
+        def LD_A_mnn(idx, n):   # 0xFA
+            self.regs[idx, A] = self.read(idx, n)
+        def LD_mBC_A(idx, n):   # 0x02
+            self.write(idx, self._pair(idx, B, C), self._get(idx, A))
+        def LD_mDE_A(idx, n):   # 0x12
+            self.write(idx, self._pair(idx, D, E), self._get(idx, A))
+        def LD_A_mBC(idx, n):   # 0x0A
+            self.regs[idx, A] = self.read(idx, self._pair(idx, B, C))
+        def LD_A_mDE(idx, n):   # 0x1A
+            self.regs[idx, A] = self.read(idx, self._pair(idx, D, E))
+
+        self.vops[0xE0] = LDH_mn_A
+        self.vops[0xF0] = LDH_A_mn
+        self.vops[0xEA] = LD_mnn_A
+        self.vops[0xFA] = LD_A_mnn
+        def LD_mC_A(idx, n):    # 0xE2
+            self.write(idx, 0xFF00 | self._get(idx, C), self._get(idx, A))
+        def LD_A_mC(idx, n):    # 0xF2
+            self.regs[idx, A] = self.read(idx, 0xFF00 | self._get(idx, C))
+        def LD_mnn_SP(idx, n):  # 0x08
+            sp = self.SP[idx]
+            self.write(idx, n, sp & 0xFF)
+            self.write(idx, n + 1, sp >> 8)
+
+        self.vops[0x02] = LD_mBC_A
+        self.vops[0x12] = LD_mDE_A
+        self.vops[0x0A] = LD_A_mBC
+        self.vops[0x1A] = LD_A_mDE
+        self.vops[0xE2] = LD_mC_A
+        self.vops[0xF2] = LD_A_mC
+        self.vops[0x08] = LD_mnn_SP
+        # LD (HL+),A  LD (HL-),A  LD A,(HL+)  LD A,(HL-)
+        for opcode, store, delta in ((0x22, True, 1), (0x32, True, -1), (0x2A, False, 1), (0x3A, False, -1)):
+            def op(idx, n, store=store, delta=delta):
+                hl = self._pair(idx, H, L)
+                if store:
+                    self.write(idx, hl, self._get(idx, A))
+                else:
+                    self.regs[idx, A] = self.read(idx, hl)
+                self._set_pair(idx, H, L, (hl + delta) & 0xFFFF)
+            self.vops[opcode] = op
+
+    def _init_ALU(self):        # 0x80 - 0xBF, 0xC6 - 0xFE
+        # the same flag rules as CPU's ALU families, on arrays
+        regs = self.regs
+
+        def ADD(idx, a, v, carry):
+            result = a + v + carry
+            regs[idx, F] = (
+                ((result & 0xFF) == 0) * 0x80
+                | (((a & 0xF) + (v & 0xF) + carry) > 0xF) * 0x20
+                | (result > 0xFF) * 0x10
+            )
+            regs[idx, A] = result & 0xFF
+
+        def SUB(idx, a, v, carry, store=True):
+            result = a - v - carry
+            regs[idx, F] = (
+                ((result & 0xFF) == 0) * 0x80
+                | 0x40
+                | (((a & 0xF) - (v & 0xF) - carry) < 0) * 0x20
+                | (result < 0) * 0x10
+            )
+            if store:
+                regs[idx, A] = result & 0xFF
+
+        def carry_of(idx):
+            return (regs[idx, F].astype(np.int64) >> 4) & 1
+
+        families = [
+            lambda idx, a, v: ADD(idx, a, v, 0),
+            lambda idx, a, v: ADD(idx, a, v, carry_of(idx)),
+            lambda idx, a, v: SUB(idx, a, v, 0),
+            lambda idx, a, v: SUB(idx, a, v, carry_of(idx)),
+            lambda idx, a, v: self._logic(idx, a & v, 0x20),
+            lambda idx, a, v: self._logic(idx, a ^ v, 0x00),
+            lambda idx, a, v: self._logic(idx, a | v, 0x00),
+            lambda idx, a, v: SUB(idx, a, v, 0, store=False),
+        ]
+        for row, apply in enumerate(families):
+            for src in range(8):
+                self.vops[0x80 + row*8 + src] = (
+                    lambda idx, n, apply=apply, src=src: apply(idx, self._get(idx, A), self._get(idx, src)))
+            self.vops[0xC6 + row*8] = lambda idx, n, apply=apply: apply(idx, self._get(idx, A), n)
+
+    def _logic(self, idx, result, flags):
+        self.regs[idx, F] = ((result & 0xFF) == 0) * 0x80 | flags
+        self.regs[idx, A] = result & 0xFF
+
+    def _init_INC_DEC_r(self):  # 0x04/0x05 ... 0x3C/0x3D
+        regs = self.regs
+        for dest in range(8):
+            def INC(idx, n, dest=dest):
+                v = self._get(idx, dest)
+                result = (v + 1) & 0xFF
+                regs[idx, F] = (regs[idx, F] & 0x10) | (result == 0) * 0x80 | ((v & 0xF) == 0xF) * 0x20
+                self._put(idx, dest, result)
+            def DEC(idx, n, dest=dest):
+                v = self._get(idx, dest)
+                result = (v - 1) & 0xFF
+                regs[idx, F] = (regs[idx, F] & 0x10) | (result == 0) * 0x80 | 0x40 | ((v & 0xF) == 0) * 0x20
+                self._put(idx, dest, result)
+            self.vops[0x04 + dest*8] = INC
+            self.vops[0x05 + dest*8] = DEC
+
+    def _init_INC_DEC_rr(self):     # 0x03/0x0B ... 0x33/0x3B
+        for row, (hi, lo) in enumerate([(B, C), (D, E), (H, L)]):
+            for opcode, delta in ((0x03, 1), (0x0B, -1)):
+                self.vops[opcode + row*0x10] = (
+                    lambda idx, n, hi=hi, lo=lo, delta=delta:
+                        self._set_pair(idx, hi, lo, (self._pair(idx, hi, lo) + delta) & 0xFFFF))
+
+        def INC_SP(idx, n):
+            self.SP[idx] = (self.SP[idx] + 1) & 0xFFFF
+        def DEC_SP(idx, n):
+            self.SP[idx] = (self.SP[idx] - 1) & 0xFFFF
+        self.vops[0x33] = INC_SP
+        self.vops[0x3B] = DEC_SP
+
+    def _init_ADD_HL_rr(self):  # 0x09, 0x19, 0x29, 0x39
+        regs = self.regs
+        for row, pair in enumerate([(B, C), (D, E), (H, L), None]):
+            def op(idx, n, pair=pair):
+                hl = self._pair(idx, H, L)
+                value = self.SP[idx] if pair is None else self._pair(idx, *pair)
+                result = hl + value
+                regs[idx, F] = (
+                    (regs[idx, F] & 0x80)
+                    | (((hl & 0xFFF) + (value & 0xFFF)) > 0xFFF) * 0x20
+                    | (result > 0xFFFF) * 0x10
+                )
+                self._set_pair(idx, H, L, result & 0xFFFF)
+            self.vops[0x09 + row*0x10] = op
+
+    def _init_SP_ops(self):
+        regs = self.regs
+
+        def sp_plus_e(idx, n):
+            sp = self.SP[idx]
+            regs[idx, F] = (((sp & 0xF) + (n & 0xF)) > 0xF) * 0x20 | (((sp & 0xFF) + n) > 0xFF) * 0x10
+            return (sp + np.where(n & 0x80, n - 0x100, n)) & 0xFFFF
+
+        def ADD_SP_e(idx, n):   # 0xE8
+            self.SP[idx] = sp_plus_e(idx, n)
+        def LD_HL_SP_e(idx, n): # 0xF8
+            self._set_pair(idx, H, L, sp_plus_e(idx, n))
+        def LD_SP_HL(idx, n):   # 0xF9
+            self.SP[idx] = self._pair(idx, H, L)
+
+        self.vops[0xE8] = ADD_SP_e
+        self.vops[0xF8] = LD_HL_SP_e
+        self.vops[0xF9] = LD_SP_HL
+
+    def _init_accumulator_ops(self):
+        regs = self.regs
+
+        def rotate(shift):
+            # RLCA/RRCA/RLA/RRA: the CB rotate on A, with z cleared
+            def op(idx, n):
+                result, carry = shift(regs[idx, A].astype(np.int64), (regs[idx, F] >> 4) & 1)
+                regs[idx, A] = result
+                regs[idx, F] = carry << 4
+            return op
+
+        def DAA(idx, n):        # 0x27
+            a = regs[idx, A].astype(np.int64)
+            f = regs[idx, F].astype(np.int64)
+            sub = (f & 0x40) != 0
+            half = (f & 0x20) != 0
+            carry = (f & 0x10) != 0
+            add_carry = ~sub & (carry | (a > 0x99))
+            adjust = (
+                np.where(sub, -0x60 * carry - 0x06 * half, 0)
+                + add_carry * 0x60
+                + (~sub & (half | ((a & 0x0F) > 0x09))) * 0x06
+            )
+            a = (a + adjust) & 0xFF
+            regs[idx, A] = a
+            regs[idx, F] = (a == 0) * 0x80 | (f & 0x40) | (carry | add_carry) * 0x10
+        def CPL(idx, n):        # 0x2F
+            regs[idx, A] ^= 0xFF
+            regs[idx, F] |= 0x60
+        def SCF(idx, n):        # 0x37
+            regs[idx, F] = (regs[idx, F] & 0x80) | 0x10
+        def CCF(idx, n):        # 0x3F
+            regs[idx, F] = (regs[idx, F] & 0x90) ^ 0x10
+
+        for row, opcode in enumerate((0x07, 0x0F, 0x17, 0x1F)):
+            self.vops[opcode] = rotate(SHIFTS[row])
+        self.vops[0x27] = DAA
+        self.vops[0x2F] = CPL
+        self.vops[0x37] = SCF
+        self.vops[0x3F] = CCF
+
+    def _init_jumps(self):
+        def JR_e(idx, n):       # 0x18
+            self.PC[idx] = (self.PC[idx] + np.where(n & 0x80, n - 0x100, n)) & 0xFFFF
+        def JP_nn(idx, n):      # 0xC3
+            self.PC[idx] = n
+        def CALL_nn(idx, n):    # 0xCD
+            sp = (self.SP[idx] - 2) & 0xFFFF
+            pc = self.PC[idx]
+            self.write(idx, sp, pc & 0xFF)
+            self.write(idx, sp + 1, pc >> 8)
+            self.SP[idx] = sp
+            self.PC[idx] = n
+        def RET(idx, n):        # 0xC9
+            sp = self.SP[idx]
+            self.PC[idx] = self.read(idx, sp) | (self.read(idx, sp + 1) << 8)
+            self.SP[idx] = (sp + 2) & 0xFFFF
+
+        def JP_HL(idx, n):      # 0xE9
+            self.PC[idx] = self._pair(idx, H, L)
+        def RETI(idx, n):       # 0xD9
+            RET(idx, n)
+            self.ime[idx] = True
+
+        self.vops[0x18] = JR_e
+        self.vops[0xC3] = JP_nn
+        self.vops[0xE9] = JP_HL
+        self.vops[0xCD] = CALL_nn
+        self.vops[0xC9] = RET
+        self.vops[0xD9] = RETI
+        for row in range(8):    # RST 00h - 38h
+            self.vops[0xC7 + row*8] = lambda idx, n, target=row*8: CALL_nn(idx, np.full(len(idx), target))
+        conditions = [(0x80, 0x00), (0x80, 0x80), (0x10, 0x00), (0x10, 0x10)]
+        for cc, (mask, want) in enumerate(conditions):
+            for opcode, jump in ((0x20, JR_e), (0xC2, JP_nn), (0xC4, CALL_nn), (0xC0, RET)):
+                opcode += cc*8
+                self.vops[opcode] = self.branch(mask, want, jump, self.regular.taken[opcode])
+
+    def branch(self, mask, want, jump, penalty):
+        def op(idx, n):
+            taken = (self.regs[idx, F] & mask) == want
+            if taken.any():
+                jump(idx[taken], n[taken])
+                self.cycles[idx[taken]] += penalty
+        return op
+
+    def _init_stack(self):
+        for row, (hi, lo) in enumerate([(B, C), (D, E), (H, L), (A, F)]):
+            def PUSH(idx, n, hi=hi, lo=lo):
+                sp = (self.SP[idx] - 2) & 0xFFFF
+                self.write(idx, sp, self._get(idx, lo))
+                self.write(idx, sp + 1, self._get(idx, hi))
+                self.SP[idx] = sp
+            def POP(idx, n, hi=hi, lo=lo):
+                sp = self.SP[idx]
+                self.regs[idx, lo] = self.read(idx, sp) & (0xF0 if lo == F else 0xFF)
+                self.regs[idx, hi] = self.read(idx, sp + 1)
+                self.SP[idx] = (sp + 2) & 0xFFFF
+            self.vops[0xC5 + row*0x10] = PUSH
+            self.vops[0xC1 + row*0x10] = POP
+
+    # =CB prefixed=
+    def _init_CB(self):
+        regs = self.regs
+        for row, shift in enumerate(SHIFTS):       # 0x00 - 0x3F
+            for src in range(8):
+                def op(idx, shift=shift, src=src):
+                    result, carry = shift(self._get(idx, src), (regs[idx, F] >> 4) & 1)
+                    regs[idx, F] = (result == 0) * 0x80 | carry << 4
+                    self._put(idx, src, result)
+                self.cb_vops[row*8 + src] = op
+        for bit in range(8):
+            for src in range(8):
+                def BIT(idx, bit=bit, src=src):     # 0x40 - 0x7F
+                    zero = ((self._get(idx, src) >> bit) & 1) == 0
+                    regs[idx, F] = (regs[idx, F] & 0x10) | 0x20 | zero * 0x80
+                def RES(idx, bit=bit, src=src):     # 0x80 - 0xBF
+                    self._put(idx, src, self._get(idx, src) & ~(1 << bit))
+                def SET(idx, bit=bit, src=src):     # 0xC0 - 0xFF
+                    self._put(idx, src, self._get(idx, src) | (1 << bit))
+                self.cb_vops[0x40 + bit*8 + src] = BIT
+                self.cb_vops[0x80 + bit*8 + src] = RES
+                self.cb_vops[0xC0 + bit*8 + src] = SET
+
+    def PREFIX(self, idx, n):
+        # group again by the CB opcode
+        for cb in np.unique(n):
+            group = idx[n == cb]
+            self.cb_vops[cb](group)
+            self.cycles[group] += self.cb_cycles[cb]
+
+    # =Stepping=
+    def step(self, idx=None):
+        # one instruction on the instances of idx (default: all not done)
+        # that are at the lowest PC, returns how many ran. Running the
+        # lowest PC first lets instances that took different paths through
+        # a branch or loop meet up again, so groups stay large.
+        if idx is None:
+            idx = np.flatnonzero(~self.done)
+        if not len(idx):
+            return 0
+        pc = self.PC[idx]
+        low = pc.min()
+        idx = idx[pc == low]
+        pc = np.full(len(idx), low)
+        opcodes = self.read(idx, pc)
+        first = opcodes[0]
+        if (opcodes == first).all():
+            self._execute(int(first), idx, pc)
+        else:
+            # same PC but different code: other ROM banks or RAM contents
+            for opcode in np.unique(opcodes):
+                group = opcodes == opcode
+                self._execute(int(opcode), idx[group], pc[group])
+        self.steps += 1
+        return len(idx)
+
+    def _execute(self, opcode, idx, pc):
+        vop = self.vops[opcode]
+        if vop is None:
+            for i in idx:
+                self._step_scalar(int(i))
+            return
+        length = self.op_bytes[opcode]
+        if length == 1:
+            # still one per instance: branch() selects the taken ones
+            n = np.zeros(len(idx), dtype=np.int64)
+        elif length == 2:
+            n = self.read(idx, pc + 1)
+        else:
+            n = self.read(idx, pc + 1) | (self.read(idx, pc + 2) << 8)
+        self.PC[idx] = (pc + length) & 0xFFFF
+        vop(idx, n)
+        self.cycles[idx] += self.op_cycles[opcode]
+
+    def _step_scalar(self, i):
+        cpu = self.cpu
+        cpu.regs[:] = self.regs[i].tolist()
+        cpu.PC = int(self.PC[i])
+        cpu.SP = int(self.SP[i])
+        cpu.ime = bool(self.ime[i])
+        cpu.cycles = int(self.cycles[i])
+        self.lane.i = i
+        try:
+            cpu.cycle()
+        except Exception as e:
+            self.errors[i] = str(e)
+            self.done[i] = True
+            return
+        self.regs[i] = cpu.regs
+        self.PC[i] = cpu.PC
+        self.SP[i] = cpu.SP
+        self.ime[i] = cpu.ime
+        self.cycles[i] = cpu.cycles
+        if cpu.halted or cpu.stopped:
+            cpu.halted = cpu.stopped = False
+            self.done[i] = True
+
+    def run(self, cycles):
+        # step until every instance has run cycles more T-cycles or is done.
+        # Instances that reach the target wait for the others.
+        target = self.cycles + cycles
+        while True:
+            idx = np.flatnonzero(~self.done & (self.cycles < target))
+            if not len(idx):
+                return
+            self.step(idx)
+
+
+class Lane:
+    # Memory stand-in for Lockstep's scalar CPU: one instance's row, with
+    # the same ROM banking, echo RAM and LY/DIV rules as Lockstep.read/write
+    def __init__(self, engine):
+        self.engine = engine
+        self.i = 0
+
+    def __getitem__(self, addr):
+        engine = self.engine
+        return int(engine.read(np.array([self.i]), np.array([addr]))[0])
+
+    def __setitem__(self, addr, value):
+        self.engine.write(np.array([self.i]), np.array([addr]), np.array([value]))
+
+    def register_io(self, addr, read=None, write=None):
+        pass    # lanes have no IO hooks
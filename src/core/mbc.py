@@ -0,0 +1,282 @@
+from .cartridge import parse_header
+from pathlib import Path
+import mmap
+import struct
+import time
+
+# Cartridge mappers. The whole ROM stays in one read-only buffer; a bank
+# switch only repoints Memory's page table at another 16kb window of it.
+
+CLOCK_HZ = 4194304      # T-cycles per second, drives the MBC3 RTC
+FLUSH_INTERVAL = 5.0    # seconds between save RAM flushes while running
+
+
+class MBC:
+    # ROM only (32kb), optionally with 8kb of RAM that is always enabled
+    # savestate section: rom_bank, ram_bank, ram_enabled (RAM itself is a
+    # separate region of the state)
+    STATE = struct.Struct("<HB?")
+
+    def __init__(self, memory, rom, header, clock=None, save_path=None):
+        self.memory = memory
+        self.rom = rom
+        self.header = header
+        self.clock = clock      # () -> T-cycles, only used by the RTC
+        self.rom_banks = max(2, len(rom) // 0x4000)
+        size = header["ram_bytes"]
+        # battery RAM with a save file lives in a shared mmap of it: writes
+        # are plain memory stores, flush() syncs only the dirty pages
+        self.save_path = Path(save_path) if save_path and header["battery"] and size else None
+        self.ram = self._open_save(self.save_path, size) if self.save_path else bytearray(size)
+        self.ram_banks = max(1, size // 0x2000)
+        self.ram_enabled = True
+        self.rom_bank = 1
+        self.ram_bank = 0
+        self.ram_view = memoryview(self.ram)
+        self.dirty = set()      # 256 byte pages of self.ram written since the last flush
+        self.last_flush = time.monotonic()
+
+    def write_handlers(self):
+        # write(addr, value) for 0x0000, 0x2000, 0x4000 and 0x6000 - 0x7FFF
+        return [self.write_ignore] * 4
+
+    def write_ignore(self, addr, value):
+        # ROM is read-only, so writes are ignored
+        pass
+
+    def bank0(self):
+        return 0
+
+    def map(self):
+        self.map_rom()
+        self.map_ram()
+
+    def map_rom(self):
+        self.memory.map_rom(self.bank0() % self.rom_banks, self.rom_bank % self.rom_banks)
+
+    def map_ram(self):
+        if not self.ram_enabled or not self.ram:
+            self.memory.map_ram(None)
+        else:
+            bank = self.ram_bank % self.ram_banks
+            self.memory.map_ram(self.ram_view[bank * 0x2000:(bank + 1) * 0x2000])
+        if self.save_path:
+            self.arm()
+
+    # =Savestate=
+    def get_state(self):
+        return (self.rom_bank, self.ram_bank, self.ram_enabled)
+
+    def set_state(self, state):
+        self.rom_bank, self.ram_bank, self.ram_enabled = state[:3]
+        if self.save_path:
+            # the RAM was restored wholesale, write it all back
+            self.dirty.update(range(len(self.ram) >> 8))
+        self.map()
+
+    # =Save RAM=
+    def _open_save(self, path, size):
+        with open(path, "a+b") as f:
+            if path.stat().st_size < size:
+                f.truncate(size)
+            return mmap.mmap(f.fileno(), size)
+
+    def arm(self):
+        # the first write into each mapped RAM page marks it dirty. Armed
+        # again after every bank switch and flush, so steady state writes
+        # run at full speed.
+        for page in range(0xA0, 0xC0):
+            self.memory.watch(page, self._mark_dirty)
+
+    def _mark_dirty(self, page):
+        eram = self.memory.eram
+        if eram is None:
+            return
+        bank = self.ram_bank % self.ram_banks
+        offset = ((page - 0xA0) << 8) % len(eram)
+        self.dirty.add((bank * 0x2000 + offset) >> 8)
+
+    def flush(self):
+        # msync dirty pages only, adjacent ones coalesced into one range
+        if not self.dirty:
+            return
+        runs = []
+        for page in sorted(self.dirty):
+            start = (page << 8) & ~(mmap.PAGESIZE - 1)
+            end = min((page + 1) << 8, len(self.ram))
+            if runs and start <= runs[-1][1]:
+                runs[-1][1] = max(runs[-1][1], end)
+            else:
+                runs.append([start, end])
+        for start, end in runs:
+            self.ram.flush(start, end - start)
+        self.dirty.clear()
+        self.last_flush = time.monotonic()
+        self.arm()
+
+    def maybe_flush(self, interval=FLUSH_INTERVAL):
+        # called between runs, flushes at most once per interval
+        if self.dirty and time.monotonic() - self.last_flush >= interval:
+            self.flush()
+
+
+class BankedMBC(MBC):
+    # RAM enable at 0x0000 - 0x1FFF is common to MBC1/3/5
+    def __init__(self, memory, rom, header, clock=None, save_path=None):
+        super().__init__(memory, rom, header, clock, save_path)
+        self.ram_enabled = False
+
+    def write_handlers(self):
+        return [self.write_ram_enable, self.write_rom_bank, self.write_ram_bank, self.write_mode]
+
+    def write_ram_enable(self, addr, value):
+        enabled = (value & 0x0F) == 0x0A
+        if enabled != self.ram_enabled:
+            self.ram_enabled = enabled
+            self.map_ram()
+
+    def switch_rom(self, bank):
+        # the hot path: games switch banks thousands of times a frame,
+        # often to the bank that is already mapped
+        self.rom_bank = bank
+        bank %= self.rom_banks
+        memory = self.memory
+        if bank != memory.bank1:
+            memory.map_rom(memory.bank0, bank)
+
+    def write_rom_bank(self, addr, value):
+        pass
+
+    def write_ram_bank(self, addr, value):
+        pass
+
+    def write_mode(self, addr, value):
+        pass
+
+
+class MBC1(BankedMBC):
+    STATE = struct.Struct(MBC.STATE.format + "BBB")
+
+    def __init__(self, memory, rom, header, clock=None, save_path=None):
+        super().__init__(memory, rom, header, clock, save_path)
+        self.bank_lo = 1        # 5 bits
+        self.bank_hi = 0        # 2 bits, upper ROM bits or RAM bank
+        self.mode = 0
+
+    def write_rom_bank(self, addr, value):
+        self.bank_lo = (value & 0x1F) or 1
+        self.switch_rom((self.bank_hi << 5) | self.bank_lo)
+
+    def write_ram_bank(self, addr, value):
+        self.bank_hi = value & 0x03
+        self.rom_bank = (self.bank_hi << 5) | self.bank_lo
+        self.map()
+
+    def write_mode(self, addr, value):
+        self.mode = value & 0x01
+        self.map()
+
+    def map_ram(self):
+        self.ram_bank = self.bank_hi if self.mode else 0
+        super().map_ram()
+
+    def bank0(self):
+        # mode 1 also switches the upper bits in at 0x0000
+        return (self.bank_hi << 5) if self.mode else 0
+
+    def get_state(self):
+        return super().get_state() + (self.bank_lo, self.bank_hi, self.mode)
+
+    def set_state(self, state):
+        self.bank_lo, self.bank_hi, self.mode = state[3:]
+        super().set_state(state)
+
+
+class MBC3(BankedMBC):
+    # + latched RTC, rtc_base, rtc_halted_at (-1 when running), latch_armed
+    STATE = struct.Struct(MBC.STATE.format + "5sqq?")
+
+    def __init__(self, memory, rom, header, clock=None, save_path=None):
+        super().__init__(memory, rom, header, clock, save_path)
+        self.rtc = [0] * 5          # S M H DL DH as last latched
+        self.rtc_base = 0           # clock() at which the counter read 0
+        self.rtc_halted_at = None
+        self.latch_armed = False
+
+    def write_rom_bank(self, addr, value):
+        self.switch_rom((value & 0x7F) or 1)
+
+    def write_ram_bank(self, addr, value):
+        self.ram_bank = value & 0x0F
+        self.map_ram()
+
+    def write_mode(self, addr, value):
+        # writing 0 then 1 latches the clock into the RTC registers
+        if self.latch_armed and value == 0x01:
+            self.latch()
+        self.latch_armed = value == 0x00
+
+    def map_ram(self):
+        if self.ram_enabled and 0x08 <= self.ram_bank <= 0x0C:
+            self.memory.map_ram(None, self.read_rtc, self.write_rtc)
+        else:
+            super().map_ram()
+
+    def _seconds(self):
+        now = self.rtc_halted_at if self.rtc_halted_at is not None else self.clock()
+        return (now - self.rtc_base) // CLOCK_HZ
+
+    def latch(self):
+        total = self._seconds()
+        days = total // 86400
+        self.rtc = [
+            total % 60,
+            (total // 60) % 60,
+            (total // 3600) % 24,
+            days & 0xFF,
+            ((days >> 8) & 0x01) | (0x40 if self.rtc_halted_at is not None else 0) | (0x80 if days > 0x1FF else 0),
+        ]
+
+    def read_rtc(self, addr):
+        return self.rtc[self.ram_bank - 0x08]
+
+    def write_rtc(self, addr, value):
+        # rebase the counter so the written field reads back as value
+        self.latch()
+        rtc = self.rtc
+        rtc[self.ram_bank - 0x08] = value
+        days = rtc[3] | ((rtc[4] & 0x01) << 8)
+        total = ((days * 24 + rtc[2]) * 60 + rtc[1]) * 60 + rtc[0]
+        now = self.clock()
+        self.rtc_base = now - total * CLOCK_HZ
+        self.rtc_halted_at = now if rtc[4] & 0x40 else None
+
+    def get_state(self):
+        halted_at = -1 if self.rtc_halted_at is None else self.rtc_halted_at
+        return super().get_state() + (bytes(self.rtc), self.rtc_base, halted_at, self.latch_armed)
+
+    def set_state(self, state):
+        rtc, self.rtc_base, halted_at, self.latch_armed = state[3:]
+        self.rtc = list(rtc)
+        self.rtc_halted_at = None if halted_at < 0 else halted_at
+        super().set_state(state)
+
+
+class MBC5(BankedMBC):
+    def write_rom_bank(self, addr, value):
+        if addr < 0x3000:
+            self.switch_rom((self.rom_bank & 0x100) | value)
+        else:
+            self.switch_rom((self.rom_bank & 0xFF) | ((value & 0x01) << 8))
+
+    def write_ram_bank(self, addr, value):
+        self.ram_bank = value & 0x0F
+        self.map_ram()
+
+
+MAPPERS = {"ROM": MBC, "MBC1": MBC1, "MBC3": MBC3, "MBC5": MBC5}
+
+
+def make_mbc(memory, rom, clock=None, save_path=None):
+    header = parse_header(rom)
+    return MAPPERS[header["mapper"]](memory, rom, header, clock or (lambda: 0), save_path)
@@ -1,70 +1,336 @@
+from .mbc import make_mbc
+
+
 class Memory:
     def __init__(self):
-        self.rom_bank0 = [0] * 0x4000   # 0x0000 - 0x3FFF: 16kb ROM bank 0
-        self.rom_bank1 = [0] * 0x4000   # 0x4000 - 0x7FFF: 16kb ROM bank 1 (switchable via mapper)
-        self.vram = [0] * 0x2000        # 0x8000 - 0x9FFF: 8kb VRAM
-        self.eram = [0] * 0x2000        # 0xA000 - 0xBFFF: 8kb ext cart RAM
-        self.wram = [0] * 0x2000        # 0xC000 - 0xDFFF: 8kb work RAM
-        # Echo RAM mirrors C000-DDFF (optional, handled as alias later)
-        # self.eram_echo = self.wram    # 0xE000 - 0xFDFF: forbidden, can point to same array
-        self.oam = [0] * 0xA0           # 0xFE00 - 0xFE9F: Sprite Attribute Table (OAM) 160
-                                        # 0xFEA0 - 0xFEFF: forbidden
-        self.io_regs = [0] * 0x80       # 0xFF00 - 0xFF7F: IO Registers
-        self.hram = [0] * 0x7F          # 0xFF80 - 0xFFFE: HRAM
-        self.interrupt_enable = 0       # 0xFFFF: IE Interrup Enable
+        # one flat 64kb address space, regions below are views into it
+        self.data = bytearray(0x10000)
+        view = memoryview(self.data)
+        self.rom_bank0 = view[0x0000:0x4000]    # 0x0000 - 0x3FFF: 16kb ROM bank 0
+        self.rom_bank1 = view[0x4000:0x8000]    # 0x4000 - 0x7FFF: 16kb ROM bank 1 (switchable via mapper)
+        self.vram = view[0x8000:0xA000]         # 0x8000 - 0x9FFF: 8kb VRAM
+        self.eram = view[0xA000:0xC000]         # 0xA000 - 0xBFFF: 8kb ext cart RAM
+        self.wram = view[0xC000:0xE000]         # 0xC000 - 0xDFFF: 8kb work RAM
+                                                # 0xE000 - 0xFDFF: echo RAM, mirrors C000-DDFF
+        self.oam = view[0xFE00:0xFEA0]          # 0xFE00 - 0xFE9F: Sprite Attribute Table (OAM) 160
+                                                # 0xFEA0 - 0xFEFF: forbidden
+        self.io_regs = view[0xFF00:0xFF80]      # 0xFF00 - 0xFF7F: IO Registers
+        self.hram = view[0xFF80:0xFFFF]         # 0xFF80 - 0xFFFE: HRAM
+                                                # 0xFFFF: IE Interrupt Enable
+        # cartridge: the whole ROM as one read-only buffer + its mapper
+        self.rom = None
+        self.mbc = None
+        self._rom_pages = {}    # bank -> its 64 page views into self.rom
+        # ROM banks currently mapped at 0x0000 and 0x4000
+        self.bank0 = 0
+        self.bank1 = 1
 
-    def __getitem__(self, addr):
-        if 0x0000 <= addr <= 0x3FFF:
-            return self.rom_bank0[addr]
-        elif 0x4000 <= addr <= 0x7FFF:
-            return self.rom_bank1[addr - 0x4000]
-        elif 0x8000 <= addr <= 0x9FFF:
-            return self.vram[addr - 0x8000]
-        elif 0xA000 <= addr <= 0xBFFF:
-            return self.eram[addr - 0xA000]
-        elif 0xC000 <= addr <= 0xDFFF:
-            return self.wram[addr - 0xC000]
-        elif 0xFE00 <= addr <= 0xFE9F:
-            return self.oam[addr - 0xFE00]
-        elif 0xFF00 <= addr <= 0xFF7F:
-            return self.io_regs[addr - 0xFF00]
-        elif 0xFF80 <= addr <= 0xFFFE:
-            return self.hram[addr - 0xFF80]
-        elif addr == 0xFFFF:
-            return self.interrupt_enable
+        # =Page tables=
+        # 256 pages of 256 bytes. A page entry is a 256 byte view that is
+        # indexed directly, or None when the page goes through its handler.
+        pages = [view[p << 8:(p + 1) << 8] for p in range(0x100)]
+        self.read_pages = list(pages)
+        self.write_pages = list(pages)
+        self.read_handlers = [None] * 0x100
+        self.write_handlers = [None] * 0x100
+        # normal write mapping, write_pages/handlers differ from it only
+        # while a page is watched
+        self.write_map = list(pages)
+        self.write_funcs = [None] * 0x100
+        # per page callbacks fired (once) on the next write, see watch()
+        self.watchers = [None] * 0x100
+        # write_filter(addr, value) sees every write while set
+        self.write_filter = None
+        # called after every map_ram(): one-shot watches on cart RAM pages
+        # stand for the bank that was mapped, bank switches re-arm them
+        self.ram_listeners = []
+        # OAM DMA owns the bus: the CPU only reaches page 0xFF, see lock_bus()
+        self.locked = False
+        self._unlocked_reads = None
+
+        # echo RAM: E000-FDFF reads and writes land in C000-DDFF
+        for p in range(0xE0, 0xFE):
+            self.read_pages[p] = pages[p - 0x20]
+            self._map_write(p, None, pages[p - 0x20])
+        # ROM: writes are MBC control, never stored
+        for p in range(0x00, 0x80):
+            self._map_write(p, self._write_rom)
+        # OAM + forbidden area
+        self._map_write(0xFE, self._write_oam)
+        # IO, HRAM and IE
+        self._map_read(0xFF, self._read_io)
+        self._map_write(0xFF, self._write_io)
+
+        # per-register IO hooks, indexed by the low byte of 0xFFxx
+        self.io_readers = [None] * 0x100
+        self.io_writers = [None] * 0x100
+
+    def _reads(self):
+        # the (pages, handlers) read tables a new mapping goes into: the ones
+        # kept aside while the bus is locked, restored by unlock_bus()
+        if self.locked:
+            return self._unlocked_reads
+        return self.read_pages, self.read_handlers
+
+    def _map_read(self, page, handler):
+        read_pages, read_handlers = self._reads()
+        read_pages[page] = None
+        read_handlers[page] = handler
+
+    def _map_write(self, page, handler, view=None):
+        self.write_map[page] = view
+        self.write_funcs[page] = handler
+        self._refresh(page)
+
+    def _refresh(self, page):
+        # rebuild the active write entry of page
+        if self.locked and page != 0xFF:
+            self.write_pages[page] = None
+            self.write_handlers[page] = self._write_ignore
+        elif self.write_filter is not None:
+            self.write_pages[page] = None
+            self.write_handlers[page] = self._write_filtered
+        elif self.watchers[page] is not None:
+            self.write_pages[page] = None
+            self.write_handlers[page] = self._write_trap
+        else:
+            self.write_pages[page] = self.write_map[page]
+            self.write_handlers[page] = self.write_funcs[page]
+
+    def _alias(self, page):
+        # the other page backed by the same bytes (WRAM <-> echo RAM)
+        if 0xC0 <= page <= 0xDD:
+            return page + 0x20
+        if 0xE0 <= page <= 0xFD:
+            return page - 0x20
+        return None
+
+    def watch(self, page, callback):
+        # callback(page) fires once on the next write into page (or its
+        # echo alias). Until then writes to it take the slow path, after
+        # that the page goes back to its normal mapping.
+        for p in (page, self._alias(page)):
+            if p is None:
+                continue
+            if self.watchers[p] is None:
+                self.watchers[p] = []
+                self._refresh(p)
+        if callback not in self.watchers[page]:
+            self.watchers[page].append(callback)
+
+    def notify(self, page):
+        # fire and clear the watchers of page, also used by bulk writers
+        # that bypass __setitem__
+        fired = []
+        for p in (page, self._alias(page)):
+            if p is None or self.watchers[p] is None:
+                continue
+            fired.append((p, self.watchers[p]))
+            self.watchers[p] = None
+            self._refresh(p)
+        for p, callbacks in fired:
+            for callback in callbacks:
+                callback(p)
+
+    def notify_all(self):
+        # fire every watcher, before the whole address space is overwritten
+        for page in range(0x100):
+            if self.watchers[page] is not None:
+                self.notify(page)
+
+    def _write_trap(self, addr, value):
+        self.notify(addr >> 8)
+        self[addr] = value
+
+    def set_write_filter(self, write_filter):
+        # route every write through write_filter(addr, value), called after
+        # the write lands. None restores the normal mapping.
+        self.write_filter = write_filter
+        for page in range(0x100):
+            self._refresh(page)
+
+    def _write_filtered(self, addr, value):
+        page = addr >> 8
+        if self.watchers[page] is not None:
+            self.notify(page)
+        view = self.write_map[page]
+        if view is not None:
+            view[addr & 0xFF] = value
         else:
-            # Echo RAM and unused areas
-            return 0
+            self.write_funcs[page](addr, value)
+        self.write_filter(addr, value)
+
+    def lock_bus(self):
+        # while OAM DMA runs the CPU reads 0xFF and can't write outside of
+        # IO/HRAM. The normal read mapping is kept aside until unlock_bus().
+        if self.locked:
+            return
+        self.locked = True
+        self._unlocked_reads = (self.read_pages[:0xFF], self.read_handlers[:0xFF])
+        self.read_pages[:0xFF] = [None] * 0xFF
+        self.read_handlers[:0xFF] = [self._read_open_bus] * 0xFF
+        # what _refresh() gives every locked page
+        self.write_pages[:0xFF] = [None] * 0xFF
+        self.write_handlers[:0xFF] = [self._write_ignore] * 0xFF
+
+    def unlock_bus(self):
+        if not self.locked:
+            return
+        self.locked = False
+        self.read_pages[:0xFF], self.read_handlers[:0xFF] = self._unlocked_reads
+        self._unlocked_reads = None
+        self.write_pages[:0xFF] = self.write_map[:0xFF]
+        self.write_handlers[:0xFF] = self.write_funcs[:0xFF]
+        for page in range(0xFF):
+            if self.write_filter is not None or self.watchers[page] is not None:
+                self._refresh(page)
+
+    # =Blocks=
+    def read_block(self, addr, length):
+        # length bytes from addr as a bytearray, slice copies wherever a
+        # page is directly mapped
+        out = bytearray(length)
+        done = 0
+        while done < length:
+            a = (addr + done) & 0xFFFF
+            offset = a & 0xFF
+            n = min(0x100 - offset, length - done)
+            view = self.read_pages[a >> 8]
+            if view is not None:
+                out[done:done + n] = view[offset:offset + n]
+            else:
+                handler = self.read_handlers[a >> 8]
+                out[done:done + n] = bytes(handler(a + i) for i in range(n))
+            done += n
+        return out
+
+    def write_block(self, addr, data):
+        # the bulk version of self[addr + i] = data[i]: watchers of every
+        # page touched fire first, then directly mapped pages get one slice
+        # copy and the rest goes through their handlers
+        length = len(data)
+        done = 0
+        while done < length:
+            a = (addr + done) & 0xFFFF
+            page, offset = a >> 8, a & 0xFF
+            n = min(0x100 - offset, length - done)
+            if self.write_handlers[page] == self._write_trap:
+                self.notify(page)
+            view = self.write_pages[page]
+            if view is not None:
+                view[offset:offset + n] = data[done:done + n]
+            else:
+                handler = self.write_handlers[page]
+                for i in range(n):
+                    handler(a + i, data[done + i])
+            done += n
+
+    def register_io(self, addr, read=None, write=None):
+        # hook a single 0xFFxx register, read(addr) -> value / write(addr, value)
+        self.io_readers[addr & 0xFF] = read
+        self.io_writers[addr & 0xFF] = write
+
+    def __getitem__(self, addr):
+        page = self.read_pages[addr >> 8]
+        if page is not None:
+            return page[addr & 0xFF]
+        return self.read_handlers[addr >> 8](addr)
 
     def __setitem__(self, addr, value):
-        # Detect potential MBC writes (future) TODO
-        if 0x2000 <= addr <= 0x3FFF:
-        # This is where MBC1/2/3/5 handle ROM bank switching
-            self.rom_bank0[addr] = value
-        elif 0x4000 <= addr <= 0x7FFF:
-            self.rom_bank1[addr - 0x4000] = value
-        elif 0x8000 <= addr <= 0x9FFF:
-            self.vram[addr - 0x8000] = value
-        elif 0xA000 <= addr <= 0xBFFF:
-            self.eram[addr - 0xA000] = value
-        elif 0xC000 <= addr <= 0xDFFF:
-            self.wram[addr - 0xC000] = value
-        elif 0xFE00 <= addr <= 0xFE9F:
-            self.oam[addr - 0xFE00] = value
-        elif 0xFF00 <= addr <= 0xFF7F:
-            self.io_regs[addr - 0xFF00] = value
-        elif 0xFF80 <= addr <= 0xFFFE:
-            self.hram[addr - 0xFF80] = value
-        elif addr == 0xFFFF:
-            self.interrupt_enable = value
-        # ROM is read-only, so writes are ignored
-
-    def load_rom(self, rom_data):
-        # load 32kb for now, figure rest later TODO banking
-        for i in range(min(len(rom_data), 0x4000)):
-            self.rom_bank0[i] = rom_data[i]
-        if len(rom_data) > 0x4000:
-            for i in range(min(len(rom_data) - 0x4000, 0x4000)):
-                self.rom_bank1[i] = rom_data[i + 0x4000]
-
-    
\ No newline at end of file
+        page = self.write_pages[addr >> 8]
+        if page is not None:
+            page[addr & 0xFF] = value
+        else:
+            self.write_handlers[addr >> 8](addr, value)
+
+    # =Handlers=
+    def _write_rom(self, addr, value):
+        # no cartridge loaded, ROM is read-only so writes are ignored
+        pass
+
+    def _read_open_bus(self, addr):
+        return 0xFF
+
+    def _write_ignore(self, addr, value):
+        pass
+
+    def _write_oam(self, addr, value):
+        if addr < 0xFEA0:
+            self.data[addr] = value
+
+    def _read_io(self, addr):
+        reader = self.io_readers[addr & 0xFF]
+        if reader is None:
+            return self.data[addr]
+        return reader(addr)
+
+    def _write_io(self, addr, value):
+        writer = self.io_writers[addr & 0xFF]
+        if writer is None:
+            self.data[addr] = value
+        else:
+            writer(addr, value)
+
+    @property
+    def interrupt_enable(self):
+        return self.data[0xFFFF]
+
+    @interrupt_enable.setter
+    def interrupt_enable(self, value):
+        self.data[0xFFFF] = value
+
+    def load_rom(self, rom_data, clock=None, save_path=None):
+        # rom_data (bytes or an mmap) is kept as is, never copied, unless it
+        # is smaller than the 32kb the address space expects. save_path
+        # backs battery cart RAM with a file.
+        if len(rom_data) < 0x8000:
+            rom_data = bytes(rom_data) + bytes(0x8000 - len(rom_data))
+        self.rom = memoryview(rom_data)
+        self._rom_pages = {}
+        self.bank0 = self.bank1 = None     # force map_rom to repoint
+        self.mbc = make_mbc(self, self.rom, clock, save_path)
+        handlers = self.mbc.write_handlers()
+        for p in range(0x00, 0x80):
+            self._map_write(p, handlers[p >> 5])
+        self.mbc.map()
+
+    def _bank(self, bank):
+        # (64 page views, 16kb view) of a ROM bank, built on first use
+        mapped = self._rom_pages.get(bank)
+        if mapped is None:
+            view = self.rom[bank * 0x4000:(bank + 1) * 0x4000]
+            mapped = ([view[p << 8:(p + 1) << 8] for p in range(0x40)], view)
+            self._rom_pages[bank] = mapped
+        return mapped
+
+    def map_rom(self, bank0, bank1):
+        # point 0x0000 - 0x3FFF and 0x4000 - 0x7FFF at two 16kb banks
+        read_pages = self._reads()[0]
+        if bank0 != self.bank0:
+            read_pages[0x00:0x40], self.rom_bank0 = self._bank(bank0)
+            self.bank0 = bank0
+        if bank1 != self.bank1:
+            read_pages[0x40:0x80], self.rom_bank1 = self._bank(bank1)
+            self.bank1 = bank1
+
+    def map_ram(self, view, read=None, write=None):
+        # point 0xA000 - 0xBFFF at a cart RAM bank view (mirrored if it is
+        # smaller than 8kb), or at read/write handlers. With neither the
+        # RAM is disabled: reads give 0xFF and writes are dropped.
+        if view is None:
+            for p in range(0xA0, 0xC0):
+                self._map_read(p, read or self._read_open_bus)
+                self._map_write(p, write or self._write_ignore)
+            self.eram = None
+        else:
+            size = len(view)
+            read_pages, read_handlers = self._reads()
+            for p in range(0xA0, 0xC0):
+                offset = ((p - 0xA0) << 8) % size
+                page = view[offset:offset + 0x100]
+                read_pages[p] = page
+                read_handlers[p] = None
+                self._map_write(p, None, page)
+            self.eram = view
+        for listener in self.ram_listeners:
+            listener()
@@ -0,0 +1,125 @@
+from .ppu import FRAME_CYCLES
+from . import savestate
+import struct
+import zlib
+
+# Input movies: the button mask held during every frame of a run, plus the
+# state it started from, so replaying it reproduces the run exactly.
+#   HEADER | zlib(start state) | checkpoints | zlib(one mask byte per frame)
+# The start state is empty for a movie recorded from power on. Checkpoints
+# are state digests (the low 32 bits, see digest.py) every interval frames
+# and at the end, checked by replay() to catch (and locate) a divergence.
+
+MAGIC = b"PXMV"
+VERSION = 2
+# magic, version, ROM id, start frame, frames, checkpoint interval,
+# compressed start state size, checkpoint count
+HEADER = struct.Struct("<4sBIIIIII")
+
+
+def _digest(gb):
+    return gb.state_digest().digest() & 0xFFFFFFFF
+
+
+class Movie:
+    def __init__(self, rom_id=0, start_frame=0, state=b"", inputs=b"", interval=0, checkpoints=()):
+        self.rom_id = rom_id
+        self.start_frame = start_frame
+        self.state = state
+        self.inputs = bytearray(inputs)
+        self.interval = interval
+        self.checkpoints = list(checkpoints)
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def to_bytes(self):
+        state = zlib.compress(self.state, 9) if self.state else b""
+        head = HEADER.pack(MAGIC, VERSION, self.rom_id, self.start_frame, len(self.inputs),
+                           self.interval, len(state), len(self.checkpoints))
+        checkpoints = struct.pack(f"<{len(self.checkpoints)}I", *self.checkpoints)
+        return head + state + checkpoints + zlib.compress(self.inputs, 9)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, rom_id, start_frame, frames, interval, state_size, count = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a movie of this version")
+        offset = HEADER.size
+        state = zlib.decompress(data[offset:offset + state_size]) if state_size else b""
+        offset += state_size
+        checkpoints = struct.unpack_from(f"<{count}I", data, offset)
+        inputs = zlib.decompress(data[offset + 4 * count:])
+        if len(inputs) != frames:
+            raise ValueError("movie is truncated")
+        return cls(rom_id, start_frame, state, inputs, interval, checkpoints)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+
+class Recorder:
+    # records the inputs of gb from the current frame on. Buttons have to
+    # change between frames (set_buttons between run_frame() calls), which
+    # is also where replay() applies them.
+    def __init__(self, gb, interval=0):
+        self.gb = gb
+        self.interval = interval
+        cycles = gb.cpu.cycles
+        self.start_frame = cycles // FRAME_CYCLES
+        self.state = gb.save_state() if cycles else b""
+        self.initial = gb.joypad.pressed
+        gb.joypad.changes = []
+
+    def finish(self):
+        # stop recording at the current frame, the movie ends with the
+        # final state's checkpoint
+        gb = self.gb
+        changes, gb.joypad.changes = gb.joypad.changes, None
+        frames = gb.cpu.cycles // FRAME_CYCLES - self.start_frame
+        inputs = bytearray([self.initial]) * frames
+        for frame, mask in changes:
+            index = frame - self.start_frame
+            inputs[index:] = bytes([mask]) * (frames - index)
+        # intermediate checkpoints need the states along the way, which
+        # replay(..., update=True) fills in
+        return Movie(savestate._rom_id(gb), self.start_frame, self.state, inputs,
+                     self.interval, [_digest(gb)])
+
+
+def replay(gb, movie, update=False):
+    # run movie on gb (fresh, with the ROM loaded, ideally headless) as fast
+    # as possible. Returns the first frame whose checkpoint doesn't match,
+    # or None. update=True rewrites the checkpoints instead.
+    if movie.rom_id != savestate._rom_id(gb):
+        raise ValueError("movie is for a different ROM")
+    if movie.state:
+        gb.load_state(movie.state)
+    elif gb.cpu.cycles:
+        raise ValueError("a movie from power on needs a fresh emulator")
+    gb.joypad.play(movie.inputs, movie.start_frame)
+    frames = len(movie.inputs)
+    step = movie.interval or frames
+    stops = list(range(step, frames, step)) + [frames]
+    checkpoints = []
+    try:
+        for stop in stops:
+            gb.run_until(frames=movie.start_frame + stop - gb.cpu.cycles // FRAME_CYCLES)
+            checkpoints.append(_digest(gb))
+            if not update and len(movie.checkpoints) == len(stops):
+                if checkpoints[-1] != movie.checkpoints[len(checkpoints) - 1]:
+                    return movie.start_frame + stop
+    finally:
+        gb.joypad.stop()
+    if update:
+        movie.checkpoints = checkpoints
+        return None
+    if checkpoints[-1] != movie.checkpoints[-1]:
+        return movie.start_frame + frames
+    return None
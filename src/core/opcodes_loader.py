@@ -1,6 +1,26 @@
+import hashlib
 import json
+import marshal
+import os
+from collections import namedtuple
 from pathlib import Path
-from instructions import Instruction, Operand
+from .instructions import Instruction, Operand
+
+# bump when the compiled layout below changes
+CACHE_VERSION = 1
+
+# compiled form of one opcode table (unprefixed or CB), every field is a
+# 256 slot tuple indexed by opcode:
+#   mnemonic  str
+#   bytes     instruction length
+#   cycles    base cost (not taken for conditional branches)
+#   taken     extra cost when a conditional branch is taken
+#   operands  tuple of (name, bytes, immediate, adjust) per operand
+#   flags     "ZNHC" effects as a 4 char string, e.g. "Z0H-"
+OpcodeTable = namedtuple("OpcodeTable", "mnemonic bytes cycles taken operands flags")
+
+# compiled tables already loaded in this process, keyed by resolved JSON path
+_tables = {}
 
 def load_opcodes(opcode_file):
     try:
@@ -42,7 +62,7 @@ def _process_opcode(opcode: str, entry: dict, target: dict, is_prefixed: bool):
             bytes=op.get("bytes", 0),
             immediate=op.get("immediate", False),
             value=op.get("value"),
-            adjust=op.get("adjust")
+            adjust=_adjust(op)
         )
         for op in entry.get("operands", [])
     ]
@@ -65,6 +85,99 @@ def _process_opcode(opcode: str, entry: dict, target: dict, is_prefixed: bool):
     
     target[opcode_int] = instr
 
+def _adjust(op: dict):
+    # (HL+) / (HL-)
+    if op.get("increment"):
+        return "+"
+    if op.get("decrement"):
+        return "-"
+    return op.get("adjust")
+
+def load_opcode_tables(opcode_file, cache_file=None):
+    # Compact, immutable (prefixed, regular) OpcodeTables. The compiled form
+    # is marshaled next to the JSON and only rebuilt when the JSON's hash
+    # changes, and is shared by every emulator in the process.
+    opcode_file = Path(opcode_file)
+    key = str(opcode_file.resolve())
+    tables = _tables.get(key)
+    if tables is not None:
+        return tables
+
+    try:
+        with open(opcode_file, 'rb') as f:
+            raw = f.read()
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Opcode file not found: {opcode_file}")
+    digest = hashlib.sha1(raw).hexdigest()
+    cache_file = Path(cache_file) if cache_file else opcode_file.with_suffix(".cache")
+
+    compiled = _read_cache(cache_file, digest)
+    if compiled is None:
+        try:
+            data = json.loads(raw)
+        except json.JSONDecodeError as error:
+            raise ValueError(f"Invalid JSON in opcode file: {error}")
+        compiled = (
+            _compile_table(data.get("cbprefixed", {})),
+            _compile_table(data.get("unprefixed", {})),
+        )
+        _write_cache(cache_file, digest, compiled)
+
+    tables = (OpcodeTable(*compiled[0]), OpcodeTable(*compiled[1]))
+    _tables[key] = tables
+    return tables
+
+def _compile_table(entries: dict):
+    mnemonic = ["ILLEGAL"] * 0x100
+    length = [1] * 0x100
+    cycles = [4] * 0x100
+    taken = [0] * 0x100
+    operands = [()] * 0x100
+    flags = ["----"] * 0x100
+    for opcode, entry in entries.items():
+        try:
+            opcode_int = int(opcode.lower().replace("0x", ""), 16)
+        except ValueError:
+            print(f"Warning: Skipping invalid hex opcode: {opcode}")
+            continue
+        cycles_entry = entry.get("cycles", 0)
+        cycles_list = cycles_entry if isinstance(cycles_entry, list) else [cycles_entry]
+        mnemonic[opcode_int] = entry.get("mnemonic", f"UNKNOWN_{opcode}")
+        length[opcode_int] = entry.get("bytes", 1)
+        cycles[opcode_int] = min(cycles_list)
+        taken[opcode_int] = max(cycles_list) - min(cycles_list)
+        operands[opcode_int] = tuple(
+            (op.get("name", "UNKNOWN"), op.get("bytes", 0), op.get("immediate", False), _adjust(op))
+            for op in entry.get("operands", [])
+        )
+        entry_flags = entry.get("flags") or {}
+        flags[opcode_int] = "".join(entry_flags.get(flag, "-") for flag in "ZNHC")
+    return tuple(mnemonic), tuple(length), tuple(cycles), tuple(taken), tuple(operands), tuple(flags)
+
+def _read_cache(cache_file: Path, digest: str):
+    try:
+        with open(cache_file, 'rb') as f:
+            version, cached_digest, compiled = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if version != CACHE_VERSION or cached_digest != digest:
+        return None
+    return compiled
+
+def _write_cache(cache_file: Path, digest: str, compiled):
+    # write to a temp file and rename, so concurrent launches never see a
+    # half written cache. A read-only data dir just means no cache.
+    tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_file, 'wb') as f:
+            f.write(marshal.dumps((CACHE_VERSION, digest, compiled)))
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+
 
 if __name__ == "__main__":
     from pprint import pprint
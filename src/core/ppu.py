@@ -0,0 +1,371 @@
+from bisect import bisect_left, bisect_right
+import numpy as np
+import struct
+
+# Scanline PPU. Timing is computed from the CPU cycle counter instead of
+# being stepped: LY/STAT are derived from it when read, and sync() catches
+# up on everything between the last sync and now, i.e. draws the lines
+# that started since, and raises VBlank/STAT interrupts. Anything that
+# changes what a line looks like (LCD registers, VRAM, OAM) syncs first, so
+# every batch of lines drawn together shares one register state and is
+# drawn with whole-array NumPy operations. The next interrupt source (VBlank
+# or an enabled STAT source) is kept on the scheduler.
+
+LINE_CYCLES = 456
+FRAME_CYCLES = 154 * LINE_CYCLES    # 70224
+MODE3_START = 80        # dots into a visible line: OAM scan done, drawing starts
+HBLANK_START = 252      # mode 3 is 172 dots at its shortest
+VBLANK_LINE = 144
+WIDTH, HEIGHT = 160, 144
+
+# registers, as offsets into 0xFF00
+LCDC, STAT, SCY, SCX, LY, LYC, BGP, OBP0, OBP1, WY, WX = (
+    0x40, 0x41, 0x42, 0x43, 0x44, 0x45, 0x47, 0x48, 0x49, 0x4A, 0x4B)
+IF = 0x0F
+
+# STAT interrupt sources of one frame as (dot, STAT enable bit, line)
+STAT_EVENTS = sorted(
+    [(line * LINE_CYCLES, 0x40, line) for line in range(154)]
+    + [(line * LINE_CYCLES, 0x20, line) for line in range(VBLANK_LINE)]
+    + [(line * LINE_CYCLES + HBLANK_START, 0x08, line) for line in range(VBLANK_LINE)]
+    + [(VBLANK_LINE * LINE_CYCLES, 0x10, VBLANK_LINE)]
+)
+STAT_TIMES = [event[0] for event in STAT_EVENTS]
+
+# tile map byte -> tile number, 0x8000 (unsigned) and 0x8800 (signed) modes
+TILE_INDEX = (
+    np.arange(256, dtype=np.intp),
+    np.array([i + 256 if i < 128 else i for i in range(256)], dtype=np.intp),
+)
+# bit shifts that split a 2bpp row byte into 8 pixels, leftmost first
+SHIFTS = np.arange(7, -1, -1, dtype=np.uint8)
+
+
+class PPU:
+    # savestate section: the timing fields
+    STATE = struct.Struct("<?qHH?IQ?")
+
+    def __init__(self, memory, clock, render_every=1, scheduler=None):
+        self.memory = memory
+        self.clock = clock      # () -> T-cycles
+        self.scheduler = scheduler
+        self.event = None
+        data = memory.data
+        array = np.frombuffer(data, dtype=np.uint8)
+        self.io = data          # registers are read straight from memory
+        self.vram = array[0x8000:0xA000]
+        self.oam = array[0xFE00:0xFEA0].reshape(40, 4)
+        self.maps = (array[0x9800:0x9C00].reshape(32, 32), array[0x9C00:0xA000].reshape(32, 32))
+
+        # =Tile cache=
+        # the 384 tiles of 0x8000 - 0x97FF decoded to 8x8 colour indexes.
+        # A write into a VRAM page marks its 16 tiles stale, they are decoded
+        # again right before the next line is drawn.
+        self.tiles = np.zeros((384, 8, 8), dtype=np.uint8)
+        self.stale = set(range(0x18))   # tile data pages, 0x80 - 0x97
+        self.disarmed = set()           # pages whose write watch has fired
+
+        # =Frame buffers=
+        # shades 0-3 (0 is lightest), reused frame to frame
+        self.framebuffer = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+        self.bg = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)     # BG/window colour index
+        self.obj = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)    # colour | palette << 2 | behind << 3
+        self.xs = np.arange(WIDTH, dtype=np.intp)
+
+        # =Timing=
+        self.enabled = False
+        self.frame_start = 0    # cycle at which the current frame's line 0 began
+        self.line = 0           # lines of the current frame drawn so far
+        self.window_line = 0    # window's own line counter
+        self.vblank = False     # VBlank of the current frame already raised
+        self.stat_t = 0         # first frame dot whose STAT events are unprocessed
+        self.frames = 0         # frames completed (VBlanks raised)
+        # =Frame skip=
+        # timing, LY/STAT and interrupts are exact either way, only the
+        # drawing of skipped frames (and the tile decoding) is left out
+        self.render_every = render_every    # draw every nth frame, 0 draws none (headless)
+        self.requested = False  # draw the next frame whatever render_every says
+        self.drawing = True     # the current frame is being drawn
+        self.drawn = -1         # number of the last frame drawn in full
+
+        for reg in (LCDC, STAT, SCY, SCX, LYC, BGP, OBP0, OBP1, WY, WX):
+            memory.register_io(0xFF00 | reg, write=self._write_reg)
+        memory.register_io(0xFF00 | STAT, read=self._read_stat, write=self._write_reg)
+        memory.register_io(0xFF00 | LY, read=self._read_ly, write=self._write_ly)
+        self.arm()
+
+        # state the boot ROM leaves behind: LCD on, BG on, tiles at 0x8000
+        data[0xFF00 | BGP] = 0xFC
+        self._write_reg(0xFF00 | LCDC, 0x91)
+
+    # =VRAM/OAM watch=
+    def arm(self):
+        for page in range(0x80, 0xA0):
+            self.memory.watch(page, self._vram_write)
+        self.memory.watch(0xFE, self._vram_write)
+
+    def _vram_write(self, page):
+        # the first write into a page since it was last drawn from: finish
+        # the lines that saw the old contents first
+        self.sync()
+        self.disarmed.add(page)
+        if page < 0x98:
+            self.stale.add(page - 0x80)
+
+    def _decode(self):
+        # decode the stale tile pages, 16 tiles each
+        for page in self.stale:
+            rows = self.vram[page << 8:(page + 1) << 8].reshape(16, 8, 2)
+            lo = (rows[:, :, 0, None] >> SHIFTS) & 1
+            hi = (rows[:, :, 1, None] >> SHIFTS) & 1
+            self.tiles[page << 4:(page + 1) << 4] = lo | (hi << 1)
+        self.stale.clear()
+        if self.disarmed:
+            for page in self.disarmed:
+                self.memory.watch(page, self._vram_write)
+            self.disarmed.clear()
+
+    # =Registers=
+    def _read_ly(self, addr):
+        if not self.enabled:
+            return 0
+        return (self.clock() - self.frame_start) % FRAME_CYCLES // LINE_CYCLES
+
+    def _write_ly(self, addr, value):
+        pass    # read-only
+
+    def _read_stat(self, addr):
+        stat = 0x80 | (self.io[addr] & 0x78)
+        if not self.enabled:
+            return stat
+        t = (self.clock() - self.frame_start) % FRAME_CYCLES
+        line, dot = divmod(t, LINE_CYCLES)
+        if line >= VBLANK_LINE:
+            mode = 1
+        elif dot < MODE3_START:
+            mode = 2
+        elif dot < HBLANK_START:
+            mode = 3
+        else:
+            mode = 0
+        if line == self.io[0xFF00 | LYC]:
+            stat |= 0x04
+        return stat | mode
+
+    def _write_reg(self, addr, value):
+        self.sync()
+        reg = addr & 0xFF
+        if reg == STAT:
+            value = (self.io[addr] & 0x87) | (value & 0x78)
+        elif reg == LCDC:
+            on = bool(value & 0x80)
+            if on and not self.enabled:
+                # the LCD starts over at line 0
+                self.frame_start = self.clock()
+                self._new_frame()
+            self.enabled = on
+        self.io[addr] = value
+        if reg in (LCDC, STAT, LYC):
+            self.reschedule()
+
+    # =Timing=
+    def sync(self):
+        # catch up to the CPU: draw lines, raise interrupts
+        if not self.enabled:
+            return
+        now = self.clock()
+        while now - self.frame_start >= FRAME_CYCLES:
+            self._advance(FRAME_CYCLES)
+            self.frame_start += FRAME_CYCLES
+            self._new_frame()
+        self._advance(now - self.frame_start)
+
+    def hblank_after(self, time):
+        # start of the first HBlank at or after time, None with the LCD off
+        if not self.enabled:
+            return None
+        t = time - self.frame_start
+        frame, dot = divmod(t, FRAME_CYCLES)
+        line, dot = divmod(dot, LINE_CYCLES)
+        if line < VBLANK_LINE and dot > HBLANK_START:
+            line += 1
+        if line >= VBLANK_LINE:
+            frame, line = frame + 1, 0
+        return self.frame_start + frame * FRAME_CYCLES + line * LINE_CYCLES + HBLANK_START
+
+    def reschedule(self):
+        # put the next VBlank or enabled STAT source on the scheduler
+        if self.scheduler is None:
+            return
+        self.scheduler.cancel(self.event)
+        self.event = None
+        if self.enabled:
+            self.event = self.scheduler.schedule(self.frame_start + self._next_event(), self._event)
+
+    def _next_event(self):
+        # frame dot (past FRAME_CYCLES for the next frame) of the next
+        # interrupt source not yet processed
+        vblank = VBLANK_LINE * LINE_CYCLES
+        best = vblank + FRAME_CYCLES if self.vblank else vblank
+        stat = self.io[0xFF00 | STAT] & 0x78
+        if stat:
+            lyc = self.io[0xFF00 | LYC]
+            for offset, first in ((0, bisect_left(STAT_TIMES, self.stat_t)), (FRAME_CYCLES, 0)):
+                for dot, source, line in STAT_EVENTS[first:]:
+                    if dot + offset >= best:
+                        return best
+                    if stat & source and (source != 0x40 or line == lyc):
+                        return dot + offset
+        return best
+
+    def _event(self, time):
+        self.sync()
+        self.reschedule()
+
+    def _new_frame(self):
+        self.line = 0
+        self.window_line = 0
+        self.vblank = False
+        self.stat_t = 0
+        every = self.render_every
+        self.drawing = self.requested or bool(every and self.frames % every == 0)
+        self.requested = False
+
+    def request_frame(self):
+        # draw the next frame even if it would be skipped
+        self.requested = True
+
+    def _advance(self, t):
+        # process the current frame up to dot t
+        io = self.io
+        line, dot = divmod(t, LINE_CYCLES)
+        visible = line + (dot >= MODE3_START) if line < VBLANK_LINE else VBLANK_LINE
+        if visible > self.line:
+            if self.drawing:
+                self._draw(self.line, visible)
+            self.line = visible
+        if line >= VBLANK_LINE and not self.vblank:
+            self.vblank = True
+            if self.drawing:
+                self.drawn = self.frames
+            self.frames += 1
+            io[0xFF00 | IF] |= 0x01
+        stat = io[0xFF00 | STAT] & 0x78
+        if stat and t >= self.stat_t:
+            lyc = io[0xFF00 | LYC]
+            for i in range(bisect_left(STAT_TIMES, self.stat_t), bisect_right(STAT_TIMES, t)):
+                _, source, event_line = STAT_EVENTS[i]
+                if stat & source and (source != 0x40 or event_line == lyc):
+                    io[0xFF00 | IF] |= 0x02
+        self.stat_t = max(self.stat_t, t + 1)
+
+    # =Drawing=
+    def screen(self):
+        # the framebuffer holding a whole frame: the one just finished if it
+        # was drawn, otherwise the screen drawn now from the current VRAM
+        # and registers (a skipped frame, or the middle of one)
+        self.sync()
+        if not (self.drawn == self.frames - 1 and (self.vblank or self.line == 0)):
+            window_line = self.window_line
+            self.window_line = 0
+            self._draw(0, HEIGHT)
+            self.window_line = window_line
+        return self.framebuffer
+
+    def _draw(self, first, last):
+        # draw lines first..last-1, all with the current registers
+        if self.stale or self.disarmed:
+            self._decode()
+        io = self.io
+        lcdc = io[0xFF00 | LCDC]
+        lines = np.arange(first, last, dtype=np.intp)
+        bg = self.bg[first:last]
+        xs = self.xs
+        index = TILE_INDEX[0 if lcdc & 0x10 else 1]
+
+        # background
+        if lcdc & 0x01:
+            ys = (lines + io[0xFF00 | SCY]) & 0xFF
+            cols = (xs + io[0xFF00 | SCX]) & 0xFF
+            tile_map = self.maps[(lcdc >> 3) & 1]
+            ids = index[tile_map[(ys >> 3)[:, None], (cols >> 3)[None, :]]]
+            bg[:] = self.tiles[ids, (ys & 7)[:, None], (cols & 7)[None, :]]
+        else:
+            bg[:] = 0
+
+        # window, drawn from WX-7 on every line from WY down
+        wy, wx = io[0xFF00 | WY], io[0xFF00 | WX] - 7
+        if lcdc & 0x21 == 0x21 and wx < WIDTH and last > wy:
+            start = max(first, wy)
+            count = last - start
+            ys = self.window_line + np.arange(count, dtype=np.intp)
+            self.window_line += count
+            cols = xs[max(wx, 0):] - wx
+            tile_map = self.maps[(lcdc >> 6) & 1]
+            ids = index[tile_map[(ys >> 3)[:, None], (cols >> 3)[None, :]]]
+            bg[start - first:, max(wx, 0):] = self.tiles[ids, (ys & 7)[:, None], (cols & 7)[None, :]]
+
+        out = self.framebuffer[first:last]
+        bgp = io[0xFF00 | BGP]
+        bg_shades = np.array([(bgp >> (i * 2)) & 3 for i in range(4)], dtype=np.uint8)
+        if lcdc & 0x02 and self._draw_sprites(lcdc, lines, first, last):
+            obj = self.obj[first:last]
+            obp0, obp1 = io[0xFF00 | OBP0], io[0xFF00 | OBP1]
+            obj_shades = np.array(
+                [((obp1 if i & 4 else obp0) >> ((i & 3) * 2)) & 3 for i in range(16)], dtype=np.uint8)
+            show = (obj & 3 != 0) & ((obj & 8 == 0) | (bg == 0))
+            np.copyto(out, np.where(show, obj_shades[obj], bg_shades[bg]))
+        else:
+            np.take(bg_shades, bg, out=out)
+
+    def _draw_sprites(self, lcdc, lines, first, last):
+        # fill self.obj for the lines, False when no sprite is on them.
+        # At most 10 sprites a line in OAM order; where they overlap the
+        # smaller X wins, then the lower OAM index.
+        oam = self.oam.astype(np.intp)
+        height = 16 if lcdc & 0x04 else 8
+        ys = oam[:, 0] - 16
+        rows = lines[:, None] - ys[None, :]
+        on = (rows >= 0) & (rows < height)
+        on &= np.cumsum(on, axis=1) <= 10
+        shown = np.flatnonzero(on.any(axis=0))
+        if not len(shown):
+            return False
+        obj = self.obj[first:last]
+        obj[:] = 0
+        xs = oam[:, 1] - 8
+        # lowest priority first, each opaque pixel overwrites what is below
+        for i in sorted(shown, key=lambda i: (xs[i], i), reverse=True):
+            at = np.flatnonzero(on[:, i])
+            y, x, tile, attr = ys[i], xs[i], oam[i, 2], oam[i, 3]
+            ty = rows[at, i]
+            if attr & 0x40:
+                ty = height - 1 - ty
+            if height == 16:
+                tile &= 0xFE
+            pixels = self.tiles[tile + (ty >> 3), ty & 7]
+            if attr & 0x20:
+                pixels = pixels[:, ::-1]
+            left, right = max(x, 0), min(x + 8, WIDTH)
+            if left >= right:
+                continue
+            pixels = pixels[:, left - x:right - x]
+            flags = ((attr >> 2) & 4) | ((attr >> 4) & 8)
+            region = obj[at, left:right]
+            obj[at, left:right] = np.where(pixels != 0, pixels | flags, region)
+        return True
+
+    # =Savestate=
+    def get_state(self):
+        return (self.enabled, self.frame_start, self.line, self.window_line,
+                self.vblank, self.stat_t, self.frames, self.requested)
+
+    def set_state(self, state):
+        (self.enabled, self.frame_start, self.line, self.window_line,
+         self.vblank, self.stat_t, self.frames, self.requested) = state
+        # VRAM changed under the tile cache and the framebuffer is not part
+        # of the state: decode everything, draw from the next line on
+        self.stale.update(range(0x18))
+        self.drawing = self.render_every != 0 and self.frames % self.render_every == 0
+        self.drawn = -1
+        self.reschedule()
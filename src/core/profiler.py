@@ -0,0 +1,233 @@
+from .memory import Memory
+import json
+import time
+
+# Opt-in profiling. Nothing in CPU or Memory checks for it: enable() swaps
+# the CPU's dispatch tables for instrumented copies (and flushes the block
+# cache so blocks pick them up) and switches the Memory instance to a
+# counting subclass, disable() puts the originals back.
+
+# address space regions by page, for the memory access summary
+REGIONS = (
+    ("ROM0", 0x00, 0x40),
+    ("ROMX", 0x40, 0x80),
+    ("VRAM", 0x80, 0xA0),
+    ("ERAM", 0xA0, 0xC0),
+    ("WRAM", 0xC0, 0xE0),
+    ("ECHO", 0xE0, 0xFE),
+    ("OAM", 0xFE, 0xFF),
+    ("IO/HRAM", 0xFF, 0x100),
+)
+
+
+class CountingMemory(Memory):
+    # Memory with every access through [] counted per page. Set as the
+    # class of a live Memory while profiling, so the plain class pays
+    # nothing. Peripherals touching memory.data directly are not counted.
+    def __getitem__(self, addr):
+        self.read_counts[addr >> 8] += 1
+        return Memory.__getitem__(self, addr)
+
+    def __setitem__(self, addr, value):
+        self.write_counts[addr >> 8] += 1
+        Memory.__setitem__(self, addr, value)
+
+
+def _name(table, opcode):
+    # "LD A,(HL+)" style disassembly of a table entry
+    operands = []
+    for name, _, immediate, adjust in table.operands[opcode]:
+        name += adjust or ""
+        operands.append(name if immediate else f"({name})")
+    mnemonic = table.mnemonic[opcode]
+    return f"{mnemonic} {','.join(operands)}" if operands else mnemonic
+
+
+class Profiler:
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.memory = cpu.memory
+        self.enabled = False
+        self._saved = None
+        self.reset()
+
+    def reset(self):
+        # per opcode counts and wall time (ns), regular and CB prefixed
+        self.op_counts = [0] * 0x100
+        self.op_time = [0] * 0x100
+        self.cb_counts = [0] * 0x100
+        self.cb_time = [0] * 0x100
+        # (bank << 16) | PC (bank only for ROM) -> [count, ns, op], op is
+        # the opcode or 0x100 + CB opcode last seen there
+        self.hotspots = {}
+        self.reads = [0] * 0x100
+        self.writes = [0] * 0x100
+        self.seconds = 0.0
+        self.cycles = 0
+        self._started = None
+
+    # =Switching=
+    def enable(self):
+        if self.enabled:
+            return
+        cpu = self.cpu
+        self._saved = (cpu.ops, cpu.cb_ops)
+        # PREFIX stays as it is, the CB handler it calls is counted instead
+        cpu.ops = [
+            handler if opcode == 0xCB else
+            self._wrap(handler, opcode, cpu.op_bytes[opcode], self.op_counts, self.op_time)
+            for opcode, handler in enumerate(cpu.ops)
+        ]
+        cpu.cb_ops = [
+            self._wrap(handler, 0x100 + opcode, 2, self.cb_counts, self.cb_time)
+            for opcode, handler in enumerate(cpu.cb_ops)
+        ]
+        cpu.flush_blocks()
+        memory = self.memory
+        memory.read_counts = self.reads
+        memory.write_counts = self.writes
+        memory.__class__ = CountingMemory
+        self._started = (time.perf_counter(), cpu.cycles)
+        self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return
+        cpu = self.cpu
+        cpu.ops, cpu.cb_ops = self._saved
+        cpu.flush_blocks()
+        self.memory.__class__ = Memory
+        started, cycles = self._started
+        self.seconds += time.perf_counter() - started
+        self.cycles += cpu.cycles - cycles
+        self.enabled = False
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.disable()
+
+    def _wrap(self, handler, op, length, counts, times):
+        # handlers run with PC already past the instruction, so its address
+        # is PC - length. The bank is taken before the handler can switch it.
+        cpu = self.cpu
+        memory = self.memory
+        hotspots = self.hotspots
+        index = op & 0xFF
+        clock = time.perf_counter_ns
+
+        def profiled(n):
+            pc = (cpu.PC - length) & 0xFFFF
+            if pc < 0x4000:
+                key = (memory.bank0 << 16) | pc
+            elif pc < 0x8000:
+                key = (memory.bank1 << 16) | pc
+            else:
+                key = pc
+            start = clock()
+            handler(n)
+            elapsed = clock() - start
+            counts[index] += 1
+            times[index] += elapsed
+            spot = hotspots.get(key)
+            if spot is None:
+                hotspots[key] = [1, elapsed, op]
+            else:
+                spot[0] += 1
+                spot[1] += elapsed
+                spot[2] = op
+        return profiled
+
+    # =Report=
+    def _op_name(self, op):
+        if op >= 0x100:
+            return _name(self.cpu.prefixed, op - 0x100)
+        return _name(self.cpu.regular, op)
+
+    def _opcodes(self):
+        # (op, count, ns) for every executed opcode, slowest total first
+        rows = [(op, n, t) for op, (n, t) in enumerate(zip(self.op_counts, self.op_time)) if n]
+        rows += [(0x100 + op, n, t) for op, (n, t) in enumerate(zip(self.cb_counts, self.cb_time)) if n]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows
+
+    def _regions(self):
+        return [
+            (name, sum(self.reads[first:last]), sum(self.writes[first:last]))
+            for name, first, last in REGIONS
+        ]
+
+    def _banks(self):
+        # bank label -> [count, ns]
+        banks = {}
+        for key, (count, ns, _) in self.hotspots.items():
+            label = _location(key).split(":")[0]
+            total = banks.setdefault(label, [0, 0])
+            total[0] += count
+            total[1] += ns
+        return banks
+
+    def as_dict(self):
+        return {
+            "seconds": self.seconds,
+            "cycles": self.cycles,
+            "instructions": sum(self.op_counts) + sum(self.cb_counts),
+            "opcodes": [
+                {"opcode": f"{'CB ' if op >= 0x100 else ''}{op & 0xFF:02X}",
+                 "name": self._op_name(op), "count": n, "ns": t}
+                for op, n, t in self._opcodes()
+            ],
+            "hotspots": [
+                {"address": _location(key), "name": self._op_name(op), "count": n, "ns": t}
+                for key, (n, t, op) in sorted(self.hotspots.items(), key=lambda item: item[1][1], reverse=True)
+            ],
+            "banks": {label: {"count": n, "ns": t} for label, (n, t) in self._banks().items()},
+            "memory": {name: {"reads": r, "writes": w} for name, r, w in self._regions()},
+        }
+
+    def folded(self):
+        # flamegraph.pl / speedscope "folded" stacks: bank;address op ns
+        lines = []
+        for key, (_, ns, op) in sorted(self.hotspots.items()):
+            bank, address = _location(key).split(":")
+            lines.append(f"{bank};{address} {self._op_name(op)} {ns}")
+        return "\n".join(lines) + "\n"
+
+    def report(self, top=20):
+        instructions = sum(self.op_counts) + sum(self.cb_counts)
+        total = (sum(self.op_time) + sum(self.cb_time)) or 1
+        lines = [
+            f"{instructions} instructions, {self.cycles} cycles in {self.seconds:.3f}s (profiled)",
+            "",
+            f"{'opcode':<8}{'instruction':<16}{'count':>12}{'ms':>10}{'%':>7}{'ns/op':>8}",
+        ]
+        for op, n, t in self._opcodes()[:top]:
+            code = f"CB {op & 0xFF:02X}" if op >= 0x100 else f"{op:02X}"
+            lines.append(f"{code:<8}{self._op_name(op):<16}{n:>12}{t / 1e6:>10.2f}"
+                         f"{100 * t / total:>7.1f}{t // n:>8}")
+        lines += ["", f"{'address':<12}{'instruction':<16}{'count':>12}{'ms':>10}{'%':>7}"]
+        spots = sorted(self.hotspots.items(), key=lambda item: item[1][1], reverse=True)
+        for key, (n, t, op) in spots[:top]:
+            lines.append(f"{_location(key):<12}{self._op_name(op):<16}{n:>12}{t / 1e6:>10.2f}"
+                         f"{100 * t / total:>7.1f}")
+        lines += ["", f"{'bank':<12}{'count':>12}{'ms':>10}{'%':>7}"]
+        for label, (n, t) in sorted(self._banks().items(), key=lambda item: item[1][1], reverse=True):
+            lines.append(f"{label:<12}{n:>12}{t / 1e6:>10.2f}{100 * t / total:>7.1f}")
+        lines += ["", f"{'region':<12}{'reads':>12}{'writes':>12}"]
+        for name, r, w in self._regions():
+            lines.append(f"{name:<12}{r:>12}{w:>12}")
+        return "\n".join(lines)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.as_dict(), f, indent=1)
+
+
+def _location(key):
+    # "ROM00:0150", "ROM1F:4A20" or "RAM:C000" for a hotspot key
+    pc = key & 0xFFFF
+    if pc < 0x8000:
+        return f"ROM{key >> 16:02X}:{pc:04X}"
+    return f"RAM:{pc:04X}"
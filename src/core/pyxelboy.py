@@ -1,33 +1,193 @@
-from cpu import CPU
-from memory import Memory
-from opcodes_loader import load_opcodes
+from .apu import APU
+from .cpu import CPU
+from .digest import StateDigest
+from .disasm import load_index, seed_blocks
+from .dma import DMAController
+from .joypad import Joypad
+from .memory import Memory
+from .ppu import PPU
+from .scheduler import Scheduler
+from .serial import Serial
+from .timer import Timer
+from .opcodes_loader import load_opcode_tables
+from . import savestate
 from pathlib import Path
+import mmap
+
+CYCLES_PER_FRAME = 70224    # T-cycles, 154 lines * 456
 
 class PyxelBoy:
-    def __init__(self, rom_path: str | None = None):
+    def __init__(self, rom_path: str | None = None, save_path: str | None = None, render_every: int = 1,
+                 audio: bool | None = None):
         # load Opcode tables
-        opcode_file = Path("data/opcodes.json")
-        prefixed, regular = load_opcodes(opcode_file)
+        opcode_file = Path(__file__).resolve().parents[2] / "data" / "Opcodes.json"
+        prefixed, regular = load_opcode_tables(opcode_file)
         
         self.memory = Memory()
-        self.cpu = CPU(prefixed, regular)
-        # gpu
-        # input
+        self.cpu = CPU(prefixed, regular, self.memory)
+        # peripherals work out their state from the cycle counter and put
+        # their next interrupt on the scheduler
+        clock = lambda: self.cpu.cycles
+        self.scheduler = Scheduler()
+        self.scheduler.wake = self.cpu.limit
+        # draws every nth frame, 0 runs headless (see screenshot())
+        self.ppu = PPU(self.memory, clock, render_every, self.scheduler)
+        self.timer = Timer(self.memory, clock, self.scheduler)
+        self.serial = Serial(self.memory, clock, self.scheduler)
+        # input: set_buttons() between frames, or a movie (see movie.py)
+        self.joypad = Joypad(self.memory, clock, self.scheduler)
+        self.dma = DMAController(self.memory, clock, self.scheduler, self.ppu, self.cpu.stall)
+        # sound is synthesized when the screen is drawn unless told otherwise,
+        # headless runs only keep NR52 and the length counters right
+        self.apu = APU(self.memory, clock, synthesize=render_every != 0 if audio is None else audio)
+        self.digester = None    # see state_digest()
         # running
 
         # =Load ROM into memory=
+        self.code_index = None
         if rom_path:
-            self.load_rom(rom_path)
+            self.load_rom(rom_path, save_path)
 
         self.running = False
+        self.stop_reason = None
 
-    def load_rom(self, rom_path: str):
-        # load rom
-        with open(rom_path, "rb") as f:
-            rom_data = f.read()
-        self.memory.load_rom(rom_data)
+    def load_rom(self, rom_path, save_path: str | None = None, index: bool = False):
+        # map the rom file read-only, banks are windows into the mapping
+        # and the page cache is shared by every emulator running it.
+        # rom_path can also be the ROM itself (bytes or an mmap), used as is.
+        # save_path persists battery backed cart RAM. index=True decodes the
+        # ROM's statically known code (see disasm.py) before it runs.
+        if isinstance(rom_path, (str, Path)):
+            with open(rom_path, "rb") as f:
+                rom_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            rom_data = rom_path
+        self.memory.load_rom(rom_data, clock=lambda: self.cpu.cycles, save_path=save_path)
+        self.dma.map_hdma(bool(self.memory.mbc.header["cgb"] & 0x80))
+        self.cpu.flush_blocks()
+        self.code_index = None
+        if index:
+            self.code_index = load_index(rom_data, self.cpu.regular)
+            seed_blocks(self.cpu, self.code_index)
+        if self.digester is not None:
+            self.digester.reset()
 
     def run(self, cycles: int = 1000):
-        # temp value
-        for _ in range(cycles):
-            self.cpu.cycle(self.memory)
+        # run for a number of T-cycles
+        return self.run_until(cycles=cycles)
+
+    def run_frame(self, frames: int = 1):
+        # run up to the start of the next frame (or the nth one)
+        return self.run_until(frames=frames)
+
+    def run_until(self, cycles=None, frames=None, pc=None, write=None):
+        # Run until the first of:
+        #   cycles  T-cycles have passed
+        #   frames  frame boundaries have been crossed
+        #   pc      PC reaches one of these addresses
+        #   write   write(addr, value) returns True for a memory write
+        # Conditions are checked between blocks, so the cycle/frame targets
+        # can be overshot by one block and a write stops after the block
+        # that made it. Returns (and sets self.stop_reason) "cycles",
+        # "frame", "pc" or "write", or "halt" when the CPU is halted with
+        # nothing left that could wake it.
+        cpu = self.cpu
+        target = None
+        reason = None
+        if cycles is not None:
+            target = cpu.cycles + cycles
+            reason = "cycles"
+        if frames is not None:
+            frame_end = (cpu.cycles // CYCLES_PER_FRAME + frames) * CYCLES_PER_FRAME
+            if target is None or frame_end <= target:
+                target = frame_end
+                reason = "frame"
+        if target is None and pc is None and write is None:
+            raise ValueError("run_until needs at least one stop condition")
+        if target is None:
+            target = float("inf")
+
+        self.stop_reason = None
+        if pc is not None:
+            pcs = {pc} if isinstance(pc, int) else set(pc)
+            cpu.set_breakpoints(pcs)
+        if write is not None:
+            def write_filter(addr, value):
+                if write(addr, value):
+                    self.stop_reason = "write"
+                    cpu.stop()
+            self.memory.set_write_filter(write_filter)
+        scheduler = self.scheduler
+        self.running = True
+        try:
+            # run blocks up to the next event, fire what is due, service
+            # interrupts, repeat
+            while cpu.cycles < target and self.stop_reason is None:
+                cpu.interrupt()
+                until = min(target, scheduler.next_time())
+                if until == float("inf") and (cpu.halted or cpu.stopped):
+                    # nothing scheduled can ever wake the CPU
+                    self.stop_reason = "halt"
+                    break
+                scheduler.horizon = until
+                cpu.run(until)
+                scheduler.horizon = float("inf")
+                scheduler.run_due(cpu.cycles)
+                if pc is not None and cpu.PC in pcs:
+                    self.stop_reason = "pc"
+            self.ppu.sync()
+            if self.apu.synthesize:
+                self.apu.render()
+        finally:
+            # breakpoints stay installed: changing them means re-decoding
+            # blocks, and harness loops tend to reuse the same set
+            self.running = False
+            if write is not None:
+                self.memory.set_write_filter(None)
+            if self.memory.mbc:
+                self.memory.mbc.maybe_flush()
+        if self.stop_reason is None:
+            self.stop_reason = reason
+        return self.stop_reason
+
+    def save_state(self, base=None):
+        # state as bytes, a delta against base when given (see savestate)
+        return savestate.save_state(self, base)
+
+    def load_state(self, state, base=None):
+        savestate.load_state(self, state, base)
+        if self.digester is not None:
+            self.digester.reset()
+
+    def state_digest(self):
+        # the incremental state hasher (see digest.py): .digest() once a
+        # frame costs about as much as the pages written during it
+        if self.digester is None:
+            self.digester = StateDigest(self)
+        return self.digester
+
+    def frame_array(self):
+        # the screen as a read-only 144x160 view of the framebuffer, no copy:
+        # the next frame drawn overwrites it (screenshot() keeps one)
+        view = self.ppu.screen().view()
+        view.flags.writeable = False
+        return view
+
+    def frame_view(self):
+        # the same through the buffer protocol, e.g. for FrameExporter.push()
+        return memoryview(self.ppu.screen()).toreadonly()
+
+    def screenshot(self):
+        # copy of the screen as 144x160 shades, also works when headless
+        return self.ppu.screen().copy()
+
+    def close(self):
+        # write back any dirty save RAM
+        if self.memory.mbc:
+            self.memory.mbc.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
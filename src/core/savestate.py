@@ -0,0 +1,122 @@
+import struct
+import zlib
+import numpy as np
+
+# Savestates as one bytes blob:
+#   header | CPU | PPU | timer | serial | joypad | APU | MBC | DMA sections | 64kb address space | cart RAM
+# The sections are fixed size structs (component.STATE) and the ROM is only
+# identified by a checksum of its header, never stored.
+#
+# A delta state carries the sections in full, but of the memory only the
+# 256 byte pages that differ from a base (full) state, as a bitmask plus the
+# pages. Unchanged pages are taken from the base when it is loaded.
+
+MAGIC = b"PXBS"
+VERSION = 5
+FULL, DELTA = 0, 1
+HEADER = struct.Struct("<4sBBI")    # magic, version, kind, ROM id
+PAGE = 0x100
+
+
+def _components(gb):
+    # DMA goes last, its bus lock has to be applied after the MBC has
+    # mapped its banks
+    components = (gb.cpu, gb.ppu, gb.timer, gb.serial, gb.joypad, gb.apu)
+    mbc = gb.memory.mbc
+    if mbc is not None:
+        components += (mbc,)
+    return components + (gb.dma,)
+
+
+def _regions(gb):
+    # the raw memory a state is made of: address space, then cart RAM
+    mbc = gb.memory.mbc
+    if mbc is None or not len(mbc.ram):
+        return (gb.memory.data,)
+    return (gb.memory.data, mbc.ram)
+
+
+def _rom_id(gb):
+    rom = gb.memory.rom
+    return 0 if rom is None else zlib.crc32(rom[0x134:0x150])
+
+
+def _sections_size(gb):
+    return sum(component.STATE.size for component in _components(gb))
+
+
+def save_state(gb, base=None):
+    # full state, or with base (a full state of the same ROM) a delta
+    # against it
+    gb.ppu.sync()
+    parts = [HEADER.pack(MAGIC, VERSION, FULL if base is None else DELTA, _rom_id(gb))]
+    for component in _components(gb):
+        parts.append(component.STATE.pack(*component.get_state()))
+    regions = _regions(gb)
+    if base is None:
+        parts.extend(regions)
+        return b"".join(parts)
+
+    offset = HEADER.size + _sections_size(gb)
+    changed = []
+    for region in regions:
+        size = len(region)
+        current = np.frombuffer(region, dtype=np.uint8).reshape(-1, PAGE)
+        before = np.frombuffer(base, dtype=np.uint8, count=size, offset=offset).reshape(-1, PAGE)
+        mask = (current != before).any(axis=1)
+        changed.append(mask)
+        parts.append(current[mask].tobytes())
+        offset += size
+    parts.insert(-len(regions), np.packbits(np.concatenate(changed)).tobytes())
+    return b"".join(parts)
+
+
+def load_state(gb, state, base=None):
+    magic, version, kind, rom_id = HEADER.unpack_from(state)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a savestate of this version")
+    if rom_id != _rom_id(gb):
+        raise ValueError("savestate is for a different ROM")
+    if kind == DELTA:
+        if base is None:
+            raise ValueError("delta savestate needs the base state it was made against")
+        # the base has to be a full state of this ROM, anything else would
+        # fill the unchanged pages with garbage
+        if len(base) != HEADER.size + _sections_size(gb) + sum(len(region) for region in _regions(gb)):
+            raise ValueError("base is not a full savestate of this cartridge")
+        magic, version, base_kind, base_rom_id = HEADER.unpack_from(base)
+        if magic != MAGIC or version != VERSION or base_kind != FULL:
+            raise ValueError("base is not a full savestate of this version")
+        if base_rom_id != rom_id:
+            raise ValueError("base savestate is for a different ROM")
+
+    # everything watching memory (block cache, tile cache, save RAM) has to
+    # see the bulk write
+    gb.memory.notify_all()
+    # a running OAM DMA locks the bus again from its own section
+    gb.memory.unlock_bus()
+    regions = _regions(gb)
+    sections = HEADER.size + _sections_size(gb)
+    source = state if kind == FULL else base
+    offset = sections
+    for region in regions:
+        region[:] = source[offset:offset + len(region)]
+        offset += len(region)
+    if kind == DELTA:
+        pages = sum(len(region) for region in regions) // PAGE
+        mask = np.unpackbits(np.frombuffer(state, dtype=np.uint8, count=(pages + 7) // 8, offset=sections))
+        offset = sections + (pages + 7) // 8
+        first = 0
+        for region in regions:
+            count = len(region) // PAGE
+            changed = np.flatnonzero(mask[first:first + count])
+            if len(changed):
+                data = np.frombuffer(state, dtype=np.uint8, count=len(changed) * PAGE, offset=offset)
+                np.frombuffer(region, dtype=np.uint8).reshape(-1, PAGE)[changed] = data.reshape(-1, PAGE)
+                offset += len(changed) * PAGE
+            first += count
+
+    offset = HEADER.size
+    for component in _components(gb):
+        component.set_state(component.STATE.unpack_from(state, offset))
+        offset += component.STATE.size
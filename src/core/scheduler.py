@@ -0,0 +1,49 @@
+import heapq
+
+# Event queue keyed by CPU cycle. The main loop runs the CPU in bulk up to
+# the earliest event, then fires everything that is due, so peripherals
+# cost nothing between their events.
+
+
+class Scheduler:
+    def __init__(self):
+        self.events = []    # heap of [time, seq, callback], callback None once cancelled
+        self.seq = 0
+        # how far the CPU currently runs without looking at the queue. An
+        # event scheduled before it (by an IO write mid-run) calls
+        # wake(time) so the run ends in time for it.
+        self.horizon = float("inf")
+        self.wake = None
+
+    def schedule(self, time, callback):
+        # callback(time) fires once the CPU reaches time, returns a handle
+        # for cancel()
+        event = [time, self.seq, callback]
+        self.seq += 1
+        heapq.heappush(self.events, event)
+        if time < self.horizon and self.wake is not None:
+            self.horizon = time
+            self.wake(time)
+        return event
+
+    def cancel(self, event):
+        if event is not None:
+            event[2] = None
+
+    def next_time(self):
+        # time of the earliest live event, inf when there is none
+        events = self.events
+        while events and events[0][2] is None:
+            heapq.heappop(events)
+        return events[0][0] if events else float("inf")
+
+    def run_due(self, now):
+        # fire every event due at or before now, in time order
+        events = self.events
+        while events and events[0][0] <= now:
+            time, _, callback = heapq.heappop(events)
+            if callback is not None:
+                callback(time)
+
+    def clear(self):
+        self.events.clear()
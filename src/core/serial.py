@@ -0,0 +1,58 @@
+import struct
+
+# Serial port without a link partner: a transfer on the internal clock
+# shifts out SB, shifts in 0xFF and raises the serial interrupt after 8
+# bits at 8192 Hz. Sent bytes are kept in output (test ROMs print there).
+
+SB, SC = 0x01, 0x02
+IF = 0x0F
+TRANSFER_CYCLES = 8 * 512
+
+
+class Serial:
+    # savestate section: cycle the running transfer completes, -1 for none
+    STATE = struct.Struct("<q")
+
+    def __init__(self, memory, clock, scheduler=None):
+        self.io = memory.data
+        self.clock = clock
+        self.scheduler = scheduler
+        self.output = bytearray()
+        self.done_at = -1
+        self.event = None
+        memory.register_io(0xFF00 | SC, read=self._read_sc, write=self._write_sc)
+
+    def _read_sc(self, addr):
+        return self.io[addr] | 0x7E
+
+    def _write_sc(self, addr, value):
+        self.io[addr] = value
+        if value & 0x81 == 0x81:
+            self.output.append(self.io[0xFF00 | SB])
+            self._start(self.clock() + TRANSFER_CYCLES)
+
+    def _start(self, time):
+        self.done_at = time
+        if self.scheduler is not None:
+            self.scheduler.cancel(self.event)
+            self.event = self.scheduler.schedule(time, self._complete)
+
+    def _complete(self, time):
+        self.event = None
+        self.done_at = -1
+        self.io[0xFF00 | SB] = 0xFF
+        self.io[0xFF00 | SC] &= 0x7F
+        self.io[0xFF00 | IF] |= 0x08
+
+    # =Savestate=
+    def get_state(self):
+        return (self.done_at,)
+
+    def set_state(self, state):
+        if self.scheduler is not None:
+            self.scheduler.cancel(self.event)
+        self.event = None
+        if state[0] >= 0:
+            self._start(state[0])
+        else:
+            self.done_at = -1
@@ -0,0 +1,118 @@
+import struct
+
+# DIV/TIMA/TMA/TAC, computed from the CPU cycle counter like the PPU: DIV is
+# the top byte of a 16 bit counter that runs at the CPU clock, TIMA counts
+# the falling edges of one of its bits. Between reads nothing is stepped,
+# only the next TIMA overflow is on the scheduler.
+
+DIV, TIMA, TMA, TAC = 0x04, 0x05, 0x06, 0x07
+IF = 0x0F
+SHIFTS = (10, 4, 6, 8)      # TAC clock select -> TIMA ticks every 1 << shift cycles
+
+
+class Timer:
+    # savestate section: counter_base, tima, tima_time
+    STATE = struct.Struct("<qBq")
+
+    def __init__(self, memory, clock, scheduler=None):
+        self.memory = memory
+        self.io = memory.data
+        self.clock = clock      # () -> T-cycles
+        self.scheduler = scheduler
+        self.counter_base = 0   # cycle at which the 16 bit counter was 0
+        self.tima = 0
+        self.tima_time = 0      # cycle tima was last brought up to date
+        self.event = None
+        self.io[0xFF00 | TAC] = 0xF8
+
+        memory.register_io(0xFF00 | DIV, read=self._read_div, write=self._write_div)
+        memory.register_io(0xFF00 | TIMA, read=self._read_tima, write=self._write_tima)
+        memory.register_io(0xFF00 | TMA, write=self._write_reg)
+        memory.register_io(0xFF00 | TAC, read=self._read_tac, write=self._write_reg)
+
+    @property
+    def running(self):
+        return bool(self.io[0xFF00 | TAC] & 0x04)
+
+    @property
+    def shift(self):
+        return SHIFTS[self.io[0xFF00 | TAC] & 0x03]
+
+    def sync(self, now=None):
+        # count the TIMA ticks up to now, reloading from TMA on overflow
+        if now is None:
+            now = self.clock()
+        if now < self.tima_time:
+            # already counted past now: an overflow event firing after a
+            # TIMA read in the block that overshot it
+            return
+        if self.running:
+            shift = self.shift
+            base = self.counter_base
+            self._tick(((now - base) >> shift) - ((self.tima_time - base) >> shift))
+        self.tima_time = now
+
+    def _tick(self, ticks):
+        while ticks > 0:
+            if self.tima + ticks < 0x100:
+                self.tima += ticks
+                return
+            ticks -= 0x100 - self.tima
+            self.tima = self.io[0xFF00 | TMA]
+            self.io[0xFF00 | IF] |= 0x04
+
+    def reschedule(self):
+        # put the next TIMA overflow on the scheduler
+        if self.scheduler is None:
+            return
+        self.scheduler.cancel(self.event)
+        self.event = None
+        if self.running:
+            shift = self.shift
+            # the edge that takes TIMA from 0xFF to 0
+            edge = ((self.tima_time - self.counter_base) >> shift) + 0x100 - self.tima
+            self.event = self.scheduler.schedule(self.counter_base + (edge << shift), self._overflow)
+
+    def _overflow(self, time):
+        self.sync(time)
+        self.reschedule()
+
+    # =Registers=
+    def _read_div(self, addr):
+        return ((self.clock() - self.counter_base) >> 8) & 0xFF
+
+    def _write_div(self, addr, value):
+        # any write clears the whole counter. If the selected bit was set,
+        # that is a falling edge and TIMA ticks.
+        now = self.clock()
+        self.sync(now)
+        if self.running and (now - self.counter_base) & (1 << (self.shift - 1)):
+            self._tick(1)
+        self.counter_base = now
+        self.tima_time = now
+        self.reschedule()
+
+    def _read_tima(self, addr):
+        self.sync()
+        return self.tima
+
+    def _write_tima(self, addr, value):
+        self.sync()
+        self.tima = value
+        self.reschedule()
+
+    def _read_tac(self, addr):
+        return self.io[addr] | 0xF8
+
+    def _write_reg(self, addr, value):
+        self.sync()
+        self.io[addr] = value
+        self.reschedule()
+
+    # =Savestate=
+    def get_state(self):
+        return (self.counter_base, self.tima, self.tima_time)
+
+    def set_state(self, state):
+        self.counter_base, self.tima, self.tima_time = state
+        self.reschedule()
@@ -0,0 +1,200 @@
+from collections import namedtuple
+from itertools import zip_longest
+import struct
+import zlib
+
+# Execution traces. A Tracer swaps the CPU's dispatch tables for copies that
+# record the state before every instruction (like the Profiler, nothing is
+# checked when tracing is off) into a fixed size ring buffer or a chunked,
+# optionally zlib compressed file. Readers are generators, so traces of any
+# length are diffed one record at a time.
+
+# cycles, PC, SP, registers (B C D E H L F A), 4 bytes at PC
+RECORD = struct.Struct("<QHH8s4s")
+Record = namedtuple("Record", "cycles pc sp regs pcmem")
+
+# file: HEADER, then chunks of CHUNK (payload length) + payload, the payload
+# is a run of RECORDs, zlib compressed when the header says so
+MAGIC = b"PXTR"
+VERSION = 1
+COMPRESSED = 0x01
+HEADER = struct.Struct("<4sBBH")    # magic, version, flags, record size
+CHUNK = struct.Struct("<I")
+CHUNK_RECORDS = 0x10000
+
+
+class RingSink:
+    # the last size records, overwritten oldest first
+    def __init__(self, size=0x100000):
+        self.size = size
+        self.buffer = bytearray(size * RECORD.size)
+        self.count = 0      # records written in total
+
+    def write(self, record):
+        offset = (self.count % self.size) * RECORD.size
+        self.buffer[offset:offset + RECORD.size] = record
+        self.count += 1
+
+    def records(self):
+        # oldest to newest
+        first = max(0, self.count - self.size)
+        for i in range(first, self.count):
+            yield Record._make(RECORD.unpack_from(self.buffer, (i % self.size) * RECORD.size))
+
+    def close(self):
+        pass
+
+
+class FileSink:
+    def __init__(self, path, compress=True, chunk_records=CHUNK_RECORDS):
+        self.file = open(path, "wb")
+        self.compress = compress
+        self.limit = chunk_records * RECORD.size
+        self.buffer = bytearray()
+        self.count = 0
+        self.file.write(HEADER.pack(MAGIC, VERSION, COMPRESSED if compress else 0, RECORD.size))
+
+    def write(self, record):
+        buffer = self.buffer
+        buffer += record
+        if len(buffer) >= self.limit:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        self.count += len(self.buffer) // RECORD.size
+        payload = zlib.compress(self.buffer, 1) if self.compress else bytes(self.buffer)
+        self.file.write(CHUNK.pack(len(payload)))
+        self.file.write(payload)
+        self.buffer.clear()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+class Tracer:
+    def __init__(self, cpu, sink):
+        self.cpu = cpu
+        self.memory = cpu.memory
+        self.sink = sink
+        self.enabled = False
+        self._saved = None
+
+    def enable(self):
+        if self.enabled:
+            return
+        cpu = self.cpu
+        self._saved = (cpu.ops, cpu.cb_ops)
+        # PREFIX stays as it is, the CB handler it calls records instead
+        cpu.ops = [
+            handler if opcode == 0xCB else self._wrap(handler, cpu.op_bytes[opcode])
+            for opcode, handler in enumerate(cpu.ops)
+        ]
+        cpu.cb_ops = [self._wrap(handler, 2) for handler in cpu.cb_ops]
+        cpu.flush_blocks()
+        self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return
+        cpu = self.cpu
+        cpu.ops, cpu.cb_ops = self._saved
+        cpu.flush_blocks()
+        self.enabled = False
+
+    def close(self):
+        self.disable()
+        self.sink.close()
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _wrap(self, handler, length):
+        # handlers run with PC already past the instruction and the cycles
+        # of the ones before it, so PC - length and cycles are its start
+        cpu = self.cpu
+        memory = self.memory
+        pack = RECORD.pack
+        write = self.sink.write
+
+        def traced(n):
+            if cpu.flag_op is not None:
+                cpu.sync_flags()    # F as it is, not as lazy_flags left it
+            pc = (cpu.PC - length) & 0xFFFF
+            pcmem = bytes((memory[pc], memory[(pc + 1) & 0xFFFF],
+                           memory[(pc + 2) & 0xFFFF], memory[(pc + 3) & 0xFFFF]))
+            write(pack(cpu.cycles, pc, cpu.SP, bytes(cpu.regs), pcmem))
+            handler(n)
+        return traced
+
+
+# =Readers=
+def read_trace(path):
+    # yields the Records of a trace file, one chunk in memory at a time
+    with open(path, "rb") as f:
+        magic, version, flags, size = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("Not a PyxelBoy trace")
+        if version != VERSION or size != RECORD.size:
+            raise ValueError(f"Unsupported trace version {version}")
+        while True:
+            head = f.read(CHUNK.size)
+            if not head:
+                return
+            payload = f.read(CHUNK.unpack(head)[0])
+            if flags & COMPRESSED:
+                payload = zlib.decompress(payload)
+            for record in RECORD.iter_unpack(payload):
+                yield Record._make(record)
+
+
+def read_doctor(path):
+    # yields Records from a Gameboy Doctor style log, one line per state:
+    # A:01 F:B0 B:00 C:13 D:00 E:D8 H:01 L:4D SP:FFFE PC:0100 PCMEM:00,C3,13,02
+    # Logs carry no cycle counts, so cycles is None.
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            fields = dict(field.split(":", 1) for field in line.split())
+            regs = bytes(int(fields[name], 16) for name in "BCDEHLFA")
+            pcmem = bytes(int(byte, 16) for byte in fields["PCMEM"].split(","))
+            yield Record(None, int(fields["PC"], 16), int(fields["SP"], 16), regs, pcmem)
+
+
+def read_any(path):
+    # a trace file, or else a Gameboy Doctor log
+    with open(path, "rb") as f:
+        binary = f.read(len(MAGIC)) == MAGIC
+    return read_trace(path) if binary else read_doctor(path)
+
+
+def format_doctor(record):
+    b, c, d, e, h, l, f, a = record.regs
+    return (f"A:{a:02X} F:{f:02X} B:{b:02X} C:{c:02X} D:{d:02X} E:{e:02X} H:{h:02X} L:{l:02X} "
+            f"SP:{record.sp:04X} PC:{record.pc:04X} PCMEM:{','.join(f'{x:02X}' for x in record.pcmem)}")
+
+
+def diff(left, right, cycles=False, limit=1):
+    # yields (index, left record, right record) for up to limit mismatching
+    # records (None for every mismatch with limit=None). A record missing
+    # because one trace ended is None. Cycles are only compared when asked
+    # and both sides have them.
+    mismatches = 0
+    for index, (a, b) in enumerate(zip_longest(left, right)):
+        if a is not None and b is not None:
+            same = (a.pc == b.pc and a.sp == b.sp and a.regs == b.regs and a.pcmem == b.pcmem
+                    and (not cycles or a.cycles is None or b.cycles is None or a.cycles == b.cycles))
+            if same:
+                continue
+        yield index, a, b
+        mismatches += 1
+        if limit is not None and mismatches >= limit:
+            return
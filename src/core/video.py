@@ -0,0 +1,155 @@
+from .ppu import FRAME_CYCLES, WIDTH, HEIGHT
+from pathlib import Path
+import numpy as np
+import queue
+import struct
+import threading
+import zlib
+
+# Frame streams off the emulation thread. FrameExporter.push() copies the
+# framebuffer (23kb of shades 0-3) into a bounded queue and a writer thread
+# turns it into grey pixels and writes it out as one of:
+#   raw   8-bit grey frames back to back (ffmpeg -f rawvideo -pix_fmt gray -s 160x144)
+#   y4m   YUV4MPEG2 with a mono plane at the Game Boy's 59.73 fps
+#   png   a directory of frame_NNNNNN.png
+# A frame identical to the one before it only queues a repeat marker: raw
+# and y4m write the last encoded frame again to keep the frame rate, png
+# only writes the frames that changed (the numbering keeps the timing). A full queue blocks
+# push() until the writer catches up, or with drop=True loses the frame.
+
+SHADES = np.array([0xFF, 0xAA, 0x55, 0x00], dtype=np.uint8)    # shade 0 is lightest
+FORMATS = ("raw", "y4m", "png")
+CLOCK = 4194304     # T-cycles per second
+_STOP = object()
+
+
+def grey(frame):
+    # shades (any buffer of HEIGHT x WIDTH bytes) -> 8-bit grey array
+    return SHADES[np.frombuffer(frame, dtype=np.uint8).reshape(HEIGHT, WIDTH)]
+
+
+def encode_png(frame):
+    # 8-bit greyscale PNG of a frame of shades
+    pixels = grey(frame)
+    rows = np.zeros((HEIGHT, WIDTH + 1), dtype=np.uint8)     # filter byte 0 per row
+    rows[:, 1:] = pixels
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", WIDTH, HEIGHT, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows.tobytes(), 6))
+            + chunk(b"IEND", b""))
+
+
+def write_png(path, frame):
+    with open(path, "wb") as f:
+        f.write(encode_png(frame))
+
+
+def format_for(path):
+    # the format a path asks for: .y4m, .raw / .gray, else a png directory
+    suffix = Path(path).suffix.lower()
+    if suffix == ".y4m":
+        return "y4m"
+    if suffix in (".raw", ".gray"):
+        return "raw"
+    return "png"
+
+
+class FrameExporter:
+    def __init__(self, path, format=None, queue_size=16, dedupe=True, drop=False):
+        self.path = Path(path)
+        self.format = format or format_for(path)
+        if self.format not in FORMATS:
+            raise ValueError(f"unknown frame format {self.format!r}")
+        self.dedupe = dedupe
+        self.drop = drop
+        self.queue = queue.Queue(queue_size)
+        self.last = None        # bytes of the last frame pushed
+        self.frames = 0         # frames pushed
+        self.written = 0        # distinct frames encoded
+        self.duplicates = 0
+        self.dropped = 0
+        self.error = None       # what stopped the writer thread
+        if self.format == "png":
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.file = None
+        else:
+            self.file = open(self.path, "wb")
+            if self.format == "y4m":
+                self.file.write(f"YUV4MPEG2 W{WIDTH} H{HEIGHT} F{CLOCK}:{FRAME_CYCLES} Ip A1:1 Cmono\n".encode())
+        self.thread = threading.Thread(target=self._write, name="frame-exporter", daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def push(self, frame):
+        # queue frame (a buffer of HEIGHT x WIDTH shades, e.g.
+        # gb.frame_view()), copied so the emulator can draw over it
+        if self.error is not None:
+            raise self.error
+        number = self.frames
+        self.frames += 1
+        data = bytes(frame)
+        if self.dedupe and data == self.last:
+            self.duplicates += 1
+            item = (number, None)       # repeat the last frame
+        else:
+            item = (number, data)
+        if self.drop:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+                return
+        else:
+            self.queue.put(item)
+        if item[1] is not None:
+            self.last = data
+
+    def close(self):
+        # write out everything queued and wait for the writer
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.error is not None:
+            raise self.error
+
+    def _write(self):
+        previous = None     # encoded bytes of the last frame written
+        try:
+            while True:
+                item = self.queue.get()
+                if item is _STOP:
+                    return
+                number, data = item
+                if data is None:
+                    # a duplicate: png has nothing to write
+                    if previous is not None and self.file is not None:
+                        self.file.write(previous)
+                    continue
+                self.written += 1
+                if self.format == "png":
+                    (self.path / f"frame_{number:06d}.png").write_bytes(encode_png(data))
+                    continue
+                previous = grey(data).tobytes()
+                if self.format == "y4m":
+                    previous = b"FRAME\n" + previous
+                self.file.write(previous)
+        except Exception as e:
+            self.error = e
+            # keep push() from blocking on a queue nobody empties
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
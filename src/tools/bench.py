@@ -0,0 +1,182 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from src.core.pyxelboy import PyxelBoy
+
+# Micro benchmarks on synthetic ROMs, one per instruction family, e.g.
+#   python -m src.tools.bench --frames 120 --out bench.json
+#   python -m src.tools.bench --compare bench.json
+#
+# Every ROM is a single loop at 0x150: reset HL to WRAM, run the family's
+# opcodes (repeated up to BODY_BYTES), jump back. Interrupts stay off, so
+# the numbers are the CPU and Memory paths alone.
+
+BODY_BYTES = 0x1000
+HL_BASE = 0xC100
+REG_H, REG_L, REG_HL = 4, 5, 6
+
+
+def _registers(exclude=()):
+    return [r for r in range(8) if r not in exclude]
+
+
+def _ld_r_r():
+    # 0x40 - 0x7F between registers, no (HL) and no HALT
+    return [bytes([0x40 | dst << 3 | src])
+            for dst in _registers((REG_HL,)) for src in _registers((REG_HL,))]
+
+
+def _alu():
+    # ADD ADC SUB SBC AND XOR OR CP A,r (0x80 - 0xBF) + their A,n forms
+    ops = [bytes([0x80 | op << 3 | src]) for op in range(8) for src in _registers((REG_HL,))]
+    return ops + [bytes([0xC6 | op << 3, 0x5A]) for op in range(8)]
+
+
+def _inc_dec():
+    return [bytes([0x04 | r << 3 | dec]) for r in _registers((REG_HL,)) for dec in (0, 1)]
+
+
+def _hl_memory():
+    # the (HL) forms. Nothing here writes H or L, so HL stays in WRAM.
+    ops = [bytes([0x70 | src]) for src in _registers((REG_HL,))]                 # LD (HL),r
+    ops += [bytes([0x46 | dst << 3]) for dst in _registers((REG_H, REG_L, REG_HL))]  # LD r,(HL)
+    ops += [bytes([0x86 | op << 3]) for op in range(8)]                          # ALU A,(HL)
+    ops += [b"\x34", b"\x35", b"\x36\xA5"]                                      # INC/DEC/LD (HL)
+    return ops
+
+
+def _cb():
+    # every CB opcode except the ones that modify H or L
+    return [bytes([0xCB, op]) for op in range(0x100)
+            if op < 0x40 and (op & 7) not in (REG_H, REG_L)
+            or 0x40 <= op < 0x80
+            or op >= 0x80 and (op & 7) not in (REG_H, REG_L)]
+
+
+WORKLOADS = {
+    "ld_r_r": _ld_r_r,
+    "alu": _alu,
+    "inc_dec": _inc_dec,
+    "hl_memory": _hl_memory,
+    "cb": _cb,
+}
+
+
+def make_rom(ops):
+    # 32kb ROM only cartridge running ops in a loop
+    rom = bytearray(0x8000)
+    rom[0x100:0x104] = b"\x00\xC3\x50\x01"      # NOP; JP 0x150
+    rom[0x134:0x143] = b"PXBENCH".ljust(15, b"\0")
+    code = bytearray(b"\x21" + HL_BASE.to_bytes(2, "little"))     # LD HL,HL_BASE
+    while len(code) < BODY_BYTES:
+        for op in ops:
+            code += op
+    code += b"\xC3\x50\x01"                     # JP 0x150
+    rom[0x150:0x150 + len(code)] = code
+    checksum = 0
+    for byte in rom[0x134:0x14D]:
+        checksum = (checksum - byte - 1) & 0xFF
+    rom[0x14D] = checksum
+    return bytes(rom)
+
+
+def run_workload(name, frames=60, repeat=3, render_every=0):
+    # best of repeat runs of frames frames, plus the time to get a loaded
+    # emulator
+    rom = make_rom(WORKLOADS[name]())
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        gb = PyxelBoy(render_every=render_every, audio=False)
+        gb.load_rom(rom)
+        startup = time.perf_counter() - start
+        start = time.perf_counter()
+        gb.run_frame(frames)
+        seconds = time.perf_counter() - start
+        result = {
+            "workload": name,
+            "frames": frames,
+            "seconds": seconds,
+            "startup": startup,
+            "instructions": gb.cpu.opcodes,
+            "cycles": gb.cpu.cycles,
+            "instr_per_sec": gb.cpu.opcodes / seconds,
+            "cycles_per_sec": gb.cpu.cycles / seconds,
+            "fps": frames / seconds,
+        }
+        if best is None or seconds < best["seconds"]:
+            best = result
+    return best
+
+
+def _revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                             text=True, cwd=Path(__file__).resolve().parent)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_bench(names=None, frames=60, repeat=3, render_every=0):
+    start = time.perf_counter()
+    PyxelBoy()      # first construction compiles or loads the opcode tables
+    cold = time.perf_counter() - start
+    return {
+        "revision": _revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "render_every": render_every,
+        "startup_cold": cold,
+        "results": [run_workload(name, frames, repeat, render_every) for name in names or WORKLOADS],
+    }
+
+
+def report(bench, baseline=None):
+    old = {r["workload"]: r for r in baseline["results"]} if baseline else {}
+    lines = [f"rev {bench['revision']}  python {bench['python']}  cold startup {bench['startup_cold'] * 1e3:.1f}ms",
+             f"{'workload':<12}{'Minstr/s':>10}{'Mcycles/s':>11}{'fps':>8}{'startup ms':>12}"
+             + (f"{'vs base':>9}" if old else "")]
+    for r in bench["results"]:
+        line = (f"{r['workload']:<12}{r['instr_per_sec'] / 1e6:>10.3f}{r['cycles_per_sec'] / 1e6:>11.2f}"
+                f"{r['fps']:>8.1f}{r['startup'] * 1e3:>12.2f}")
+        if r["workload"] in old:
+            line += f"{r['instr_per_sec'] / old[r['workload']]['instr_per_sec']:>8.2f}x"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the CPU on synthetic ROMs")
+    parser.add_argument("workloads", nargs="*",
+                        help=f"any of {', '.join(WORKLOADS)} (default: all)")
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per workload, the best counts")
+    parser.add_argument("--render-every", type=int, default=0, help="0 runs headless")
+    parser.add_argument("--out", help="write the results as JSON here")
+    parser.add_argument("--compare", help="a previous --out to compare against")
+    args = parser.parse_args(argv)
+    unknown = set(args.workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error(f"unknown workloads: {', '.join(sorted(unknown))}")
+
+    bench = run_bench(args.workloads, args.frames, args.repeat, args.render_every)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print(report(bench, baseline))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(bench, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+import argparse
+import sys
+from pathlib import Path
+
+from src.core.disasm import INDEX_DIR, analyze, load_index, rom_key
+from src.core.opcodes_loader import load_opcode_tables
+
+# Static disassembly of a ROM, e.g.
+#   python -m src.tools.disasm ROMs/game.gb                  (build the index, print stats)
+#   python -m src.tools.disasm ROMs/game.gb --list > game.asm
+#   python -m src.tools.disasm ROMs/game.gb --calls
+#
+# The index is kept in data/index keyed by the ROM's title, checksums and crc,
+# PyxelBoy.load_rom(..., index=True) and `trace dump --rom` read it from
+# there. --rebuild analyses the ROM again instead of using a stored index.
+
+OPCODES = Path(__file__).resolve().parents[2] / "data" / "Opcodes.json"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Disassemble a ROM and index its code")
+    parser.add_argument("rom")
+    parser.add_argument("--list", action="store_true", help="print the disassembly")
+    parser.add_argument("--calls", action="store_true", help="print call targets and their callers")
+    parser.add_argument("--rebuild", action="store_true", help="analyse the ROM even if it is indexed")
+    parser.add_argument("--dir", default=INDEX_DIR, help="index directory")
+    args = parser.parse_args(argv)
+
+    prefixed, regular = load_opcode_tables(OPCODES)
+    with open(args.rom, "rb") as f:
+        rom = f.read()
+    if args.rebuild:
+        index = analyze(rom, regular)
+        index.save(Path(args.dir) / f"{rom_key(rom)}.idx")
+    else:
+        index = load_index(rom, regular, args.dir)
+
+    if args.list:
+        for line in index.listing(regular, prefixed):
+            print(line)
+    if args.calls:
+        for target, sites in sorted(index.calls.items()):
+            callers = sorted({index.symbol(site) for site in sites})
+            print(f"{index.label(target)}: {len(sites)} calls from {', '.join(callers)}")
+    code = sum(length for _, _, length in index.instructions.values())
+    print(f"{index.rom_key}: {len(index.instructions)} instructions ({code} bytes), "
+          f"{len(index.blocks)} blocks, {len(index.calls)} call targets, "
+          f"{len(index.indirect)} indirect jumps", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+import argparse
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import random
+import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from src.core.opcodes_loader import load_opcode_tables
+from src.core.pyxelboy import PyxelBoy
+
+# Runs ROMs headless across a process pool, e.g.
+#   python -m src.tools.farm ROMs/ --frames 600 --seeds 8 --out results.jsonl
+#
+# The parent maps every ROM and compiles the opcode tables before the pool
+# forks, so workers inherit both (the ROM pages stay shared in the page
+# cache) and a task is only (ROM path, seed).
+
+ROM_SUFFIXES = {".gb", ".gbc"}
+OPCODES = Path(__file__).resolve().parents[2] / "data" / "Opcodes.json"
+
+_roms = {}      # path -> read-only mmap of the ROM, filled before the fork
+
+
+def _map_roms(paths):
+    for path in paths:
+        if path not in _roms:
+            with open(path, "rb") as f:
+                _roms[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _init_worker(paths):
+    # forked workers already have everything, spawned ones map it again
+    _map_roms(paths)
+    load_opcode_tables(OPCODES)
+
+
+def run_one(path, seed=None, frames=600, checksum_every=60):
+    # run one ROM for a number of frames and summarise the run. A seed
+    # fills WRAM/HRAM with random bytes first, like real power-up RAM.
+    start = time.perf_counter()
+    result = {"rom": path, "seed": seed}
+    try:
+        gb = PyxelBoy(render_every=checksum_every, audio=False)     # headless, no sound
+        gb.load_rom(_roms[path])
+        if seed is not None:
+            rng = random.Random(seed)
+            gb.memory.wram[:] = rng.randbytes(len(gb.memory.wram))
+            gb.memory.hram[:] = rng.randbytes(len(gb.memory.hram))
+        checksums = []
+        for frame in range(1, frames + 1):
+            gb.run_frame()
+            if checksum_every and frame % checksum_every == 0:
+                checksums.append(zlib.crc32(gb.ppu.screen()))
+        result.update(
+            state=hashlib.sha1(gb.save_state()).hexdigest(),
+            frames=checksums,
+            cycles=gb.cpu.cycles,
+            instructions=gb.cpu.opcodes,
+        )
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def run_farm(paths, seeds=(None,), frames=600, checksum_every=60, workers=None):
+    # yields the result of every (ROM, seed) run as it finishes
+    paths = [str(path) for path in paths]
+    _init_worker(paths)
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+    with ProcessPoolExecutor(
+        max_workers=workers or os.cpu_count(),
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(paths,),
+    ) as pool:
+        futures = [
+            pool.submit(run_one, path, seed, frames, checksum_every)
+            for path in paths
+            for seed in seeds
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def find_roms(target):
+    target = Path(target)
+    if target.is_dir():
+        return sorted(p for p in target.rglob("*") if p.suffix.lower() in ROM_SUFFIXES)
+    return [target]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run ROMs headless in parallel")
+    parser.add_argument("target", help="a ROM or a directory of ROMs")
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--seeds", type=int, default=0,
+                        help="runs per ROM with seeded power-up RAM (0: one unseeded run)")
+    parser.add_argument("--checksum-every", type=int, default=60,
+                        help="frames between framebuffer checksums (0: none)")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--out", help="write JSON lines here instead of stdout")
+    args = parser.parse_args(argv)
+
+    roms = find_roms(args.target)
+    seeds = range(args.seeds) if args.seeds else (None,)
+    out = open(args.out, "w") if args.out else sys.stdout
+    start = time.perf_counter()
+    runs = failed = 0
+    try:
+        for result in run_farm(roms, seeds, args.frames, args.checksum_every, args.workers):
+            runs += 1
+            failed += "error" in result
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"{runs} runs ({failed} failed) in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,39 @@
+import argparse
+import sys
+
+from src.core.profiler import Profiler
+from src.core.pyxelboy import PyxelBoy
+
+# Runs a ROM headless with the profiler on, e.g.
+#   python -m src.tools.profile ROMs/game.gb --frames 600 --json prof.json --folded prof.folded
+#
+# The folded output feeds flamegraph.pl or speedscope directly.
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Profile a ROM per opcode, address and memory region")
+    parser.add_argument("rom")
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--warmup", type=int, default=0,
+                        help="frames to run unprofiled first")
+    parser.add_argument("--top", type=int, default=20, help="rows per table")
+    parser.add_argument("--json", help="write the full profile here")
+    parser.add_argument("--folded", help="write folded stacks here")
+    args = parser.parse_args(argv)
+
+    gb = PyxelBoy(args.rom, render_every=0)
+    if args.warmup:
+        gb.run_frame(args.warmup)
+    with Profiler(gb.cpu) as profiler:
+        gb.run_frame(args.frames)
+    print(profiler.report(args.top))
+    if args.json:
+        profiler.save(args.json)
+    if args.folded:
+        with open(args.folded, "w") as f:
+            f.write(profiler.folded())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,46 @@
+import argparse
+import sys
+import time
+
+from src.core.movie import Movie, replay
+from src.core.pyxelboy import PyxelBoy
+
+# Replays input movies headless and checks them against their recorded
+# checkpoints, e.g.
+#   python -m src.tools.replay ROMs/game.gb runs/intro.pxmv
+#   python -m src.tools.replay ROMs/game.gb runs/intro.pxmv --update
+#
+# Exits with 1 when the replay diverges, for build checks. --update stores
+# the checkpoints of this replay instead (every --interval frames).
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay and verify an input movie")
+    parser.add_argument("rom")
+    parser.add_argument("movie")
+    parser.add_argument("--update", action="store_true", help="rewrite the movie's checkpoints")
+    parser.add_argument("--interval", type=int, help="frames between checkpoints, with --update")
+    args = parser.parse_args(argv)
+
+    movie = Movie.load(args.movie)
+    if args.interval is not None:
+        movie.interval = args.interval
+    gb = PyxelBoy(args.rom, render_every=0)
+    start = time.perf_counter()
+    diverged = replay(gb, movie, update=args.update)
+    seconds = time.perf_counter() - start
+    speed = len(movie) / seconds / 60 if seconds else float("inf")
+    print(f"{len(movie)} frames in {seconds:.2f}s ({speed:.1f}x real time)", file=sys.stderr)
+    if args.update:
+        movie.save(args.movie)
+        print(f"{len(movie.checkpoints)} checkpoints written")
+        return 0
+    if diverged is not None:
+        print(f"diverged by frame {diverged}")
+        return 1
+    print("ok")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+import argparse
+import sys
+from pathlib import Path
+
+from src.core.disasm import load_index
+from src.core.opcodes_loader import load_opcode_tables
+from src.core.pyxelboy import PyxelBoy
+from src.core.trace import FileSink, Tracer, diff, format_doctor, read_any
+
+# Record, dump and compare execution traces, e.g.
+#   python -m src.tools.trace record ROMs/cpu_instrs.gb --frames 600 --out run.trace
+#   python -m src.tools.trace dump run.trace > run.log       (Gameboy Doctor format)
+#   python -m src.tools.trace dump run.trace --rom ROMs/cpu_instrs.gb   (with symbols)
+#   python -m src.tools.trace diff run.trace reference.log --context 3
+#
+# diff takes either format on both sides and streams them, so it stops at
+# the first divergence without reading the rest of either file.
+
+OPCODES = Path(__file__).resolve().parents[2] / "data" / "Opcodes.json"
+
+
+def record(args):
+    gb = PyxelBoy(args.rom, render_every=0)
+    with Tracer(gb.cpu, FileSink(args.out, compress=not args.raw)) as tracer:
+        gb.run_frame(args.frames)
+    print(f"{tracer.sink.count} instructions traced to {args.out}", file=sys.stderr)
+    return 0
+
+
+def dump(args):
+    index = None
+    if args.rom:
+        # symbols from the ROM's code index (see src/tools/disasm.py)
+        _, regular = load_opcode_tables(OPCODES)
+        with open(args.rom, "rb") as f:
+            index = load_index(f.read(), regular)
+    for i, rec in enumerate(read_any(args.trace)):
+        if args.limit is not None and i >= args.limit:
+            break
+        if index is None:
+            print(format_doctor(rec))
+            continue
+        key = index.locate(rec.pc)
+        symbol = index.symbol(key) if key is not None else None
+        print(f"{format_doctor(rec)}  ; {symbol or '?'}")
+    return 0
+
+
+def compare(args):
+    recent = []     # the last records of left, up to and including the compared one
+    left, right = read_any(args.left), read_any(args.right)
+
+    def remember(records):
+        for rec in records:
+            recent.append(rec)
+            del recent[:-(args.context + 1)]
+            yield rec
+
+    found = False
+    for index, a, b in diff(remember(left), right, cycles=args.cycles, limit=args.limit):
+        found = True
+        print(f"mismatch at instruction {index}:")
+        for rec in recent[:-1] if a is not None else recent[1:]:
+            print(f"    {format_doctor(rec)}")
+        print(f"  < {format_doctor(a) if a else '(end of trace)'}")
+        print(f"  > {format_doctor(b) if b else '(end of trace)'}")
+    if not found:
+        print("traces match")
+    return 1 if found else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Execution traces")
+    commands = parser.add_subparsers(dest="command", required=True)
+    p = commands.add_parser("record", help="run a ROM headless and trace it")
+    p.add_argument("rom")
+    p.add_argument("--frames", type=int, default=60)
+    p.add_argument("--out", required=True)
+    p.add_argument("--raw", action="store_true", help="don't compress chunks")
+    p.set_defaults(func=record)
+    p = commands.add_parser("dump", help="print a trace in Gameboy Doctor format")
+    p.add_argument("trace")
+    p.add_argument("--limit", type=int)
+    p.add_argument("--rom", help="annotate records with the ROM's symbols")
+    p.set_defaults(func=dump)
+    p = commands.add_parser("diff", help="find where two traces diverge")
+    p.add_argument("left")
+    p.add_argument("right")
+    p.add_argument("--cycles", action="store_true", help="compare cycle counts too")
+    p.add_argument("--context", type=int, default=5, help="matching records to show before")
+    p.add_argument("--limit", type=int, default=1, help="mismatches to report")
+    p.set_defaults(func=compare)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,51 @@
+import argparse
+import sys
+import time
+
+from src.core.movie import Movie
+from src.core.pyxelboy import PyxelBoy
+from src.core.video import FORMATS, FrameExporter
+
+# Records the screen of a headless run, e.g.
+#   python -m src.tools.video ROMs/game.gb --frames 600 --out run.y4m
+#   python -m src.tools.video ROMs/game.gb runs/intro.pxmv --out frames/    (png per frame)
+#
+# The format follows --out (.y4m, .raw / .gray, else a png directory) unless
+# --format says otherwise. With a movie its inputs drive the run and
+# --frames defaults to its length.
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the frames of a run")
+    parser.add_argument("rom")
+    parser.add_argument("movie", nargs="?", help="input movie to play")
+    parser.add_argument("--frames", type=int)
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--format", choices=FORMATS)
+    parser.add_argument("--every", type=int, default=1, help="export every nth frame")
+    parser.add_argument("--no-dedupe", action="store_true", help="encode repeated frames again")
+    args = parser.parse_args(argv)
+
+    gb = PyxelBoy(args.rom, render_every=args.every, audio=False)
+    frames = args.frames if args.frames is not None else 600
+    if args.movie:
+        movie = Movie.load(args.movie)
+        if movie.state:
+            gb.load_state(movie.state)
+        gb.joypad.play(movie.inputs, movie.start_frame)
+        if args.frames is None:
+            frames = len(movie)
+    start = time.perf_counter()
+    with FrameExporter(args.out, args.format, dedupe=not args.no_dedupe) as exporter:
+        for frame in range(1, frames + 1):
+            gb.run_frame()
+            if frame % args.every == 0:
+                exporter.push(gb.frame_view())
+    seconds = time.perf_counter() - start
+    print(f"{exporter.frames} frames ({exporter.written} distinct) to {args.out} in {seconds:.2f}s",
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
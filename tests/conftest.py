@@ -0,0 +1,29 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from src.core.opcodes_loader import load_opcode_tables  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def opcodes():
+    # (prefixed, regular) opcode tables
+    return load_opcode_tables(ROOT / "data" / "Opcodes.json")
+
+
+def make_rom(code=b"", size=0x8000, cartridge_type=0x00, rom_size=0x00, ram_size=0x00):
+    # a ROM that jumps from 0x100 to code at 0x150, with a valid header checksum
+    rom = bytearray(size)
+    rom[0x100:0x104] = bytes([0x00, 0xC3, 0x50, 0x01])     # NOP; JP 0150
+    rom[0x134:0x13E] = b"TESTROM".ljust(10, b"\0")
+    rom[0x147], rom[0x148], rom[0x149] = cartridge_type, rom_size, ram_size
+    checksum = 0
+    for byte in rom[0x134:0x14D]:
+        checksum = (checksum - byte - 1) & 0xFF
+    rom[0x14D] = checksum
+    rom[0x150:0x150 + len(code)] = code
+    return bytes(rom)
@@ -0,0 +1,46 @@
+from conftest import make_rom
+from src.core.digest import StateDigest, diff
+from src.core.pyxelboy import PyxelBoy
+
+# MBC5 + 32kb RAM (4 banks), the CPU only spins
+ROM = make_rom(bytes([0x18, 0xFE]), size=0x10000, cartridge_type=0x1B, rom_size=0x01, ram_size=0x03)
+
+
+def _gb():
+    gb = PyxelBoy(ROM, render_every=0, audio=False)
+    gb.memory[0x0000] = 0x0A        # RAM enable
+    gb.run_frame()
+    return gb
+
+
+def test_incremental_digest_matches_full_rehash():
+    gb = _gb()
+    digest = gb.state_digest()
+    for value in range(1, 4):
+        gb.memory[0xC000 + value * 0x111] = value
+        gb.memory[0x8000 + value] = value
+        gb.run_frame()
+        assert digest.digest() == StateDigest(gb).digest()
+
+
+def test_digest_sees_the_same_page_in_two_ram_banks():
+    gb = _gb()
+    digest = gb.state_digest()
+    digest.digest()
+    gb.memory[0xA105] = 0x11        # bank 0
+    gb.memory[0x4000] = 1
+    gb.memory[0xA105] = 0x22        # same page, bank 1
+    gb.memory[0x4000] = 2
+    gb.memory[0xA1FF] = 0x33        # and bank 2
+    gb.memory[0x4000] = 0
+    assert digest.digest() == StateDigest(gb).digest()
+
+
+def test_diff_names_what_differs():
+    a, b = _gb(), _gb()
+    assert diff(a, b) == []
+    b.memory[0xC123] = 5
+    b.memory[0x4000] = 3
+    b.memory[0xA010] = 7
+    b.cpu.PC += 1
+    assert diff(a, b) == ["cpu.PC", "mbc[1]", "WRAM:C100", "SRAM:6000"]
@@ -0,0 +1,27 @@
+from conftest import make_rom
+from src.core.disasm import analyze, format_instruction, load_index, rom_key
+
+# RR B; BIT 7,H; STOP; JR -2
+CODE = bytes([0xCB, 0x18, 0xCB, 0x7C, 0x10, 0x00, 0x18, 0xFE])
+
+
+def test_prefixed_and_stop_are_two_bytes(opcodes):
+    prefixed, regular = opcodes
+    index = analyze(make_rom(CODE), regular)
+    code = {key: index.instructions[key] for key in index.instructions if key >= 0x150}
+    assert sorted(code) == [0x150, 0x152, 0x154, 0x156]
+    lines = [format_instruction(regular, prefixed, opcode, n, key) for key, (opcode, n, _) in sorted(code.items())]
+    assert lines == ["RR B", "BIT 7,H", "STOP $00", "JR $0156"]
+    # the only edge out of the loop is its own jump
+    assert index.blocks[0x156] == (0x156, (0x156,))
+
+
+def test_roms_with_the_same_header_get_their_own_index(opcodes, tmp_path):
+    _, regular = opcodes
+    first = make_rom(CODE)
+    second = make_rom(bytes([0x18, 0xFE]))
+    assert rom_key(first) != rom_key(second)
+    load_index(first, regular, tmp_path)
+    index = load_index(second, regular, tmp_path)
+    assert index.rom_key == rom_key(second)
+    assert 0x152 not in index.instructions
@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+from conftest import make_rom
+from src.core.cpu import CPU, B, F, A
+from src.core.memory import Memory
+
+# every 8-bit ALU handler of a table driven and a lazy CPU against the
+# eager one, over all operands and the incoming flags that matter
+
+ALU = ["ADD", "ADC", "SUB", "SBC", "AND", "XOR", "OR", "CP"]
+
+
+@pytest.fixture(scope="module")
+def cpus(opcodes):
+    prefixed, regular = opcodes
+    return (CPU(prefixed, regular, Memory(), flag_tables=False),
+            CPU(prefixed, regular, Memory(), flag_tables=True),
+            CPU(prefixed, regular, Memory(), lazy_flags=True))
+
+
+def _mismatches(cpus, opcode, cases, immediate):
+    # (a, value, f) cases where A, B or F end up different
+    found = []
+    for a, value, f in cases:
+        results = []
+        for cpu in cpus:
+            regs = cpu.regs
+            regs[A], regs[B], regs[F] = a, value, f
+            cpu.ops[opcode](value if immediate else 0)
+            results.append((regs[A], regs[B], cpu.sync_flags()))
+        if results.count(results[0]) != len(results):
+            found.append((a, value, f))
+            if len(found) == 10:
+                break
+    return found
+
+
+@pytest.mark.parametrize("immediate", [False, True], ids=["r", "n"])
+@pytest.mark.parametrize("row", range(8), ids=ALU)
+def test_alu_flags_match_eager(cpus, row, immediate):
+    # A,B (0x80 + row * 8) or A,n (0xC6 + row * 8), carry in for ADC/SBC
+    opcode = (0xC6 if immediate else 0x80) + row * 8
+    carries = (0x00, 0x10, 0xF0) if ALU[row] in ("ADC", "SBC") else (0x00, 0xF0)
+    cases = ((a, value, f) for a in range(256) for value in range(256) for f in carries)
+    assert _mismatches(cpus, opcode, cases, immediate) == []
+
+
+@pytest.mark.parametrize("opcode", [0x04, 0x05], ids=["INC", "DEC"])
+def test_inc_dec_flags_match_eager(cpus, opcode):
+    cases = ((0, value, f) for value in range(256) for f in range(0, 0x100, 0x10))
+    assert _mismatches(cpus, opcode, cases, False) == []
+
+
+# a loop whose flags are read back by DAA, SBC, PUSH AF and JR cc
+PROGRAM = bytes([
+    0x21, 0x00, 0xC0,       # LD HL,C000
+    0x11, 0x00, 0x00,       # LD DE,0000
+    # loop 0x156
+    0x7E,                   # LD A,(HL)
+    0x83,                   # ADD A,E
+    0x27,                   # DAA
+    0x5F,                   # LD E,A
+    0x2A,                   # LD A,(HL+)
+    0x9A,                   # SBC A,D
+    0xF5,                   # PUSH AF
+    0xC1,                   # POP BC
+    0x51,                   # LD D,C
+    0xFE, 0x80,             # CP 80
+    0x38, 0x01,             # JR C,+1
+    0x14,                   # INC D
+    0x7C,                   # LD A,H
+    0xFE, 0xC2,             # CP C2
+    0x20, 0xED,             # JR NZ,loop
+    0x76,                   # HALT
+])
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_lazy_flags_run_like_eager(opcodes, seed):
+    prefixed, regular = opcodes
+    rom = make_rom(PROGRAM)
+    wram = random.Random(seed).randbytes(0x2000)
+    results = []
+    for mode in ({"flag_tables": False}, {"lazy_flags": True}):
+        memory = Memory()
+        memory.load_rom(rom)
+        memory.wram[:] = wram
+        cpu = CPU(prefixed, regular, memory, **mode)
+        cpu.SP = 0xFFFE
+        while not cpu.halted:
+            cpu.run(cpu.cycles + 10_000)
+        assert cpu.flag_op is None
+        results.append((cpu.get_state(), bytes(memory.wram)))
+    assert results[0] == results[1]
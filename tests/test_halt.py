@@ -0,0 +1,42 @@
+from conftest import make_rom
+from src.core.pyxelboy import PyxelBoy
+
+# DI, only VBlank enabled, spin until its IF bit is set, then HALT
+HALT_CODE = bytes([
+    0xF3,                   # DI
+    0x3E, 0x01,             # LD A,01
+    0xE0, 0xFF,             # LDH (IE),A
+    # 0x155
+    0xF0, 0x0F,             # LDH A,(IF)
+    0xE6, 0x01,             # AND 01
+    0x28, 0xFA,             # JR Z,155
+    0x76,                   # HALT
+    0x00,                   # NOP       0x15C
+    0x18, 0xFE,             # JR -2
+])
+
+
+def test_halt_with_an_interrupt_pending_goes_on():
+    gb = PyxelBoy(make_rom(HALT_CODE), render_every=0, audio=False)
+    gb.run_until(pc=0x15B)
+    cycles = gb.cpu.cycles
+    gb.run_until(pc=0x15C)
+    assert not gb.cpu.halted
+    assert gb.cpu.cycles - cycles <= 8
+
+
+def test_only_the_joypad_ends_stop():
+    gb = PyxelBoy(make_rom(bytes([0xF3, 0x10, 0x00, 0x18, 0xFE])), render_every=0, audio=False)   # DI; STOP; JR -2
+    gb.run_frame()
+    cpu, memory = gb.cpu, gb.memory
+    assert cpu.stopped and cpu.PC == 0x153
+    sp = cpu.SP
+    cpu.ime = True
+    memory[0xFFFF] = 0x14               # timer and joypad
+    memory[0xFF0F] = 0x04               # timer
+    gb.run_frame()
+    assert cpu.stopped and cpu.PC == 0x153 and cpu.SP == sp and cpu.ime
+    assert memory[0xFF0F] & 0x04
+    memory[0xFF0F] |= 0x10
+    gb.run_frame()
+    assert not cpu.stopped
@@ -0,0 +1,80 @@
+import random
+
+import numpy as np
+
+from conftest import make_rom
+from src.core.cpu import CPU
+from src.core.lockstep import Lockstep
+from src.core.memory import Memory
+
+# every instance runs the same code on its own WRAM, so which way each
+# RET cc goes differs between instances (and between calls)
+CODE = bytes([
+    0x31, 0xFE, 0xFF,       # LD SP,FFFE
+    0x21, 0x00, 0xC0,       # LD HL,C000
+    # loop 0x156
+    0x7E,                   # LD A,(HL)
+    0xCD, 0x80, 0x01,       # CALL 0180
+    0x77,                   # LD (HL),A
+    0x23,                   # INC HL
+    0x7C,                   # LD A,H
+    0xFE, 0xC1,             # CP C1
+    0x20, 0xF5,             # JR NZ,loop
+    0x76,                   # HALT
+])
+SUBROUTINE = bytes([        # 0x180
+    0xE6, 0x03,             # AND 03
+    0xC8,                   # RET Z
+    0x3D,                   # DEC A
+    0xC0,                   # RET NZ
+    0xA7,                   # AND A
+    0xD0,                   # RET NC
+    0x37,                   # SCF
+    0xD8,                   # RET C
+    0xC9,                   # RET
+])
+
+
+def _rom():
+    code = CODE + bytes(0x30 - len(CODE)) + SUBROUTINE
+    return make_rom(code)
+
+
+def _wram(i):
+    return random.Random(i).randbytes(0x2000)
+
+
+def test_lockstep_matches_scalar_cpu(opcodes):
+    prefixed, regular = opcodes
+    rom = _rom()
+    count = 16
+    engine = Lockstep(prefixed, regular, rom, count)
+    for i in range(count):
+        engine.memory[i, 0xC000:0xE000] = np.frombuffer(_wram(i), dtype=np.uint8)
+    engine.run(10**6)
+    assert engine.done.all() and not engine.errors
+
+    for i in range(count):
+        memory = Memory()
+        memory.load_rom(rom)
+        memory.wram[:] = _wram(i)
+        cpu = CPU(prefixed, regular, memory)
+        while not cpu.halted:
+            cpu.cycle()
+        assert list(engine.regs[i]) == cpu.regs
+        assert (engine.PC[i], engine.SP[i], engine.cycles[i]) == (cpu.PC, cpu.SP, cpu.cycles)
+        assert bytes(engine.memory[i, 0xC000:0xE000]) == bytes(memory.wram)
+
+
+def test_conditional_return_taken_and_not_taken(opcodes):
+    prefixed, regular = opcodes
+    # CALL; XOR A; RET Z (taken) and CALL; OR 1; RET Z (not taken)
+    code = bytes([0x31, 0xFE, 0xFF, 0xCD, 0x80, 0x01, 0x47, 0x76])     # LD SP; CALL 0180; LD B,A; HALT
+    subroutine = bytes([0xA9, 0xC8, 0x3E, 0x55, 0xC9])     # XOR C; RET Z; LD A,55; RET
+    rom = make_rom(code + bytes(0x30 - len(code)) + subroutine)
+    engine = Lockstep(prefixed, regular, rom, 2)
+    engine.regs[1, 1] = 0x01    # C: instance 1 doesn't take RET Z
+    engine.run(10**4)
+    assert engine.done.all() and not engine.errors
+    assert list(engine.regs[:, 0]) == [0x00, 0x55]      # B
+    assert list(engine.PC) == [0x158, 0x158]
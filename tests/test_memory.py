@@ -0,0 +1,35 @@
+from conftest import make_rom
+from src.core.pyxelboy import PyxelBoy
+
+
+def _gb():
+    # MBC5, 4 ROM banks starting with their number at 0x4000, 32kb RAM
+    rom = bytearray(make_rom(size=0x10000, cartridge_type=0x1B, rom_size=0x01, ram_size=0x03))
+    for bank in range(4):
+        rom[bank * 0x4000] = bank
+    gb = PyxelBoy(bytes(rom), render_every=0, audio=False)
+    memory = gb.memory
+    memory.mbc.ram[0x2000] = 0x22       # RAM bank 1
+    return memory
+
+
+def test_bank_switch_while_locked_keeps_the_lock():
+    memory = _gb()
+    assert memory[0x4000] == 1
+    memory.lock_bus()
+    memory.map_rom(0, 2)
+    memory.map_ram(memory.mbc.ram[0x2000:0x4000])
+    assert memory[0x4000] == 0xFF
+    assert memory[0xA000] == 0xFF
+    memory.unlock_bus()
+    assert memory[0x4000] == 2
+    assert memory[0xA000] == 0x22
+
+
+def test_ram_disabled_while_locked():
+    memory = _gb()
+    memory.map_ram(memory.mbc.ram[0x2000:0x4000])
+    memory.lock_bus()
+    memory.map_ram(None)
+    memory.unlock_bus()
+    assert memory[0xA000] == 0xFF
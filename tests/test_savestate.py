@@ -0,0 +1,44 @@
+import pytest
+
+from conftest import make_rom
+from src.core.pyxelboy import PyxelBoy
+
+ROM = make_rom(bytes([0x3C, 0xEA, 0x00, 0xC0, 0x18, 0xFB]))     # INC A; LD (C000),A; JR -5
+
+
+def _gb(rom=ROM):
+    gb = PyxelBoy(rom, render_every=0, audio=False)
+    gb.run_frame()
+    return gb
+
+
+def test_delta_round_trip():
+    gb = _gb()
+    base = gb.save_state()
+    gb.run_frame()
+    delta = gb.save_state(base)
+    expected = gb.save_state()
+    gb.run_frame()
+    gb.load_state(delta, base)
+    assert gb.save_state() == expected
+
+
+def test_delta_refuses_a_wrong_base():
+    gb = _gb()
+    base = gb.save_state()
+    gb.run_frame()
+    delta = gb.save_state(base)
+    other = bytearray(ROM)
+    other[0x134:0x13E] = b"OTHERROM\0\0"
+    wrong = {
+        "delta": delta,
+        "other ROM": _gb(bytes(other)).save_state(),
+        "truncated": base[:-1],
+        "bad magic": b"XXXX" + base[4:],
+    }
+    before = gb.save_state()
+    for name, bad in wrong.items():
+        with pytest.raises(ValueError):
+            gb.load_state(delta, bad)
+        # refused before anything was loaded
+        assert gb.save_state() == before, name
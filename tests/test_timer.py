@@ -0,0 +1,31 @@
+from conftest import make_rom
+from src.core.pyxelboy import PyxelBoy
+
+# TIMA at 16 cycles a tick, TMA 0, polled in long blocks: the overflow
+# events fire after reads in the same block have already counted past them
+POLL = bytes([0xF0, 0x05, 0x22] * 8)    # (LDH A,(TIMA); LD (HL+),A) x 8
+CODE = bytes([
+    0xF3,                   # DI
+    0xAF,                   # XOR A
+    0xE0, 0xFF,             # LDH (IE),A
+    0xE0, 0x06,             # LDH (TMA),A
+    0xE0, 0x05,             # LDH (TIMA),A
+    0xE0, 0x04,             # LDH (DIV),A
+    0x3E, 0x05,             # LD A,05
+    0xE0, 0x07,             # LDH (TAC),A
+    # loop 0x15E
+    0x21, 0x00, 0xC0,       # LD HL,C000
+]) + POLL + bytes([0x18, 0xFE - 3 - len(POLL)])   # JR loop
+
+
+def test_tima_polled_across_overflows():
+    gb = PyxelBoy(make_rom(CODE), render_every=0)
+    gb.run_until(pc=0x15E)
+    timer = gb.timer
+    start = gb.memory[0xFF05] - ((gb.cpu.cycles - timer.counter_base) >> 4)
+    for _ in range(20):
+        gb.run_until(cycles=10_000)
+        # with TMA 0 an overflow is just a wrap around
+        ticks = (gb.cpu.cycles - timer.counter_base) >> 4
+        assert gb.memory[0xFF05] == (start + ticks) & 0xFF
+        assert timer.tima_time <= gb.cpu.cycles